@@ -28,6 +28,8 @@ from extensions import (
     socketio, oauth, HAS_AUTHLIB, ADMIN_EMAIL, csrf
 )
 from models import UserRepository
+from scheduler import download_scheduler
+from proxy_pool import proxy_pool
 
 # Импорт блюпринтов
 from blueprints.auth import auth_bp
@@ -38,6 +40,7 @@ from blueprints.download import download_bp
 from blueprints.history import history_bp
 from blueprints.notification import notification_bp
 from blueprints.admin import admin_bp
+from blueprints.batch import batch_bp
 
 # Настройка логирования вместо принтов
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -65,9 +68,16 @@ app.register_blueprint(download_bp)
 app.register_blueprint(history_bp)
 app.register_blueprint(notification_bp)
 app.register_blueprint(admin_bp)
+app.register_blueprint(batch_bp)
 
 socketio.init_app(app)
 
+# Подбираем задачи скачивания, оставшиеся от предыдущего запуска (деплой/падение)
+download_scheduler.start_recovery()
+
+# Периодическая проверка прокси из пула
+proxy_pool.start_health_checks()
+
 # Включаем CSRF защиту
 csrf.init_app(app)
 
@@ -0,0 +1,212 @@
+import os
+import time
+import itertools
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Общая полоса процесса на все загрузки, байт/с (0 — без общего распределителя, как раньше:
+# статичный ratelimit для бесплатных и без ограничений для Premium)
+BANDWIDTH_TOTAL = int(os.getenv('BANDWIDTH_TOTAL', 25 * 1024 * 1024))
+# Веса тарифов: при конкуренции Premium получает в BANDWIDTH_PREMIUM_WEIGHT раз больше бесплатных
+BANDWIDTH_WEIGHTS = {
+    'premium': float(os.getenv('BANDWIDTH_PREMIUM_WEIGHT', 4)),
+    'free': float(os.getenv('BANDWIDTH_FREE_WEIGHT', 1)),
+}
+# Как часто перераспределять полосу по измеренной скорости (начало и конец загрузки — сразу)
+BANDWIDTH_REALLOC_INTERVAL = float(os.getenv('BANDWIDTH_REALLOC_INTERVAL', 1.0))
+# Запас ведра токенов в секундах скорости: короткие всплески не тормозятся
+BANDWIDTH_BURST = 0.5
+# Меньше этого поток не получает никогда, чтобы соединение с источником не рвалось по таймауту
+BANDWIDTH_MIN_RATE = 16 * 1024
+
+
+def water_fill(capacity, items):
+    """Взвешенное max-min распределение: items — [(ключ, вес, спрос или None)], спрос None — сколько дадут.
+
+    Кто просит меньше своей доли, получает свой спрос, остаток делится между остальными
+    пропорционально весам. Если спрос всех удовлетворен, остаток все равно раздается по
+    весам — распределение не оставляет полосу простаивать.
+    """
+    result = {}
+    pending = list(items)
+    remaining = capacity
+    while pending:
+        total_weight = sum(weight for _, weight, _ in pending) or 1
+        share = remaining / total_weight
+        satisfied = [(key, weight, demand) for key, weight, demand in pending
+                     if demand is not None and demand <= weight * share]
+        if not satisfied:
+            for key, weight, _ in pending:
+                result[key] = weight * share
+            return result
+        for key, _, demand in satisfied:
+            result[key] = demand
+            remaining -= demand
+        pending = [item for item in pending if item not in satisfied]
+    if remaining > 0 and items:
+        total_weight = sum(weight for _, weight, _ in items) or 1
+        for key, weight, _ in items:
+            result[key] += remaining * weight / total_weight
+    return result
+
+
+class Flow:
+    """Одна загрузка в распределителе: свое ведро токенов со скоростью, которую назначил распределитель."""
+    def __init__(self, allocator, flow_id, tier, user):
+        self.allocator = allocator
+        self.id = flow_id
+        self.tier = tier
+        self.user = user
+        self.rate = 0.0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.total_bytes = 0
+        self.window_bytes = 0
+        self.measured = 0.0
+        self.throttled = True    # новый поток считается ненасытным, пока не измерена его скорость
+        self.slept = 0.0         # сколько секунд поток ждал распределителя
+        self.seen = {}
+        self.seen_lock = threading.Lock()
+
+    def consume(self, nbytes):
+        self.allocator.consume(self, nbytes)
+
+    def hook(self, d):
+        """Хук прогресса yt-dlp: списывает прирост downloaded_bytes (по каждому файлу отдельно).
+
+        Вызывается из потоков фрагментов одновременно, поэтому прирост считается под блокировкой,
+        а сон в consume — уже без нее, чтобы не задерживать остальные потоки дольше нужного.
+        """
+        if d.get('status') != 'downloading':
+            return
+        key = d.get('tmpfilename') or d.get('filename')
+        current = d.get('downloaded_bytes') or 0
+        with self.seen_lock:
+            previous = self.seen.get(key)
+            # Значения из разных потоков могут прийти не по порядку — меньшее уже учтено
+            if previous is not None and current <= previous:
+                return
+            self.seen[key] = current
+        # Первое значение — точка отсчета: при продолжении загрузки в нем уже есть скачанное раньше
+        if previous is not None:
+            self.consume(current - previous)
+
+    def close(self):
+        self.allocator.release(self)
+
+
+class BandwidthAllocator:
+    """Распределитель полосы процесса между загрузками с взвешенной справедливостью.
+
+    Полоса делится иерархически: между тарифами по весам, внутри тарифа поровну между
+    пользователями, у пользователя — поровну между его загрузками. Распределение
+    сохраняет работу: если загрузке хватает меньшего (медленный источник), ее спрос
+    ограничивается измеренной скоростью, а остаток достается остальным. Поэтому
+    бесплатная загрузка на пустом сервере получает всю полосу, а при нагрузке —
+    свою долю. Перераспределение происходит при старте и завершении загрузки и раз
+    в BANDWIDTH_REALLOC_INTERVAL; ограничение — ведро токенов, поток, превысивший
+    скорость, спит в хуке прогресса (а вместе с ним и чтение из сокета).
+    """
+    def __init__(self, total=BANDWIDTH_TOTAL, weights=None, interval=BANDWIDTH_REALLOC_INTERVAL,
+                 burst=BANDWIDTH_BURST, min_rate=BANDWIDTH_MIN_RATE):
+        self.total = total
+        self.weights = weights or BANDWIDTH_WEIGHTS
+        self.interval = interval
+        self.burst = burst
+        self.min_rate = min_rate
+        self.flows = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.last_realloc = time.monotonic()
+        self.throttled_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.total > 0
+
+    def open(self, tier, user=None):
+        """Регистрирует загрузку и сразу перераспределяет полосу. user — ключ справедливости внутри тарифа."""
+        with self.lock:
+            flow_id = next(self.ids)
+            flow = Flow(self, flow_id, tier if tier in self.weights else 'free', user if user is not None else f'flow:{flow_id}')
+            self.flows[flow_id] = flow
+            self._reallocate(time.monotonic())
+            return flow
+
+    def release(self, flow):
+        with self.lock:
+            if self.flows.pop(flow.id, None):
+                self._reallocate(time.monotonic())
+
+    def consume(self, flow, nbytes):
+        if not self.enabled:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_realloc >= self.interval:
+                self._reallocate(now, measure=True)
+            rate = max(flow.rate, self.min_rate)
+            flow.tokens = min(flow.tokens + (now - flow.updated) * rate, rate * self.burst)
+            flow.updated = now
+            flow.tokens -= nbytes
+            flow.total_bytes += nbytes
+            flow.window_bytes += nbytes
+            delay = -flow.tokens / rate if flow.tokens < 0 else 0
+            if delay > 0:
+                flow.throttled = True
+                flow.slept += delay
+                self.throttled_seconds += delay
+        if delay > 0:
+            # Долг больше нескольких секунд (крупный прирост за один вызов) отсыпается по частям
+            time.sleep(min(delay, 5))
+
+    def _reallocate(self, now, measure=False):
+        # Вызывается под self.lock. Скорость меряется только на полном окне: при старте и
+        # завершении загрузки доли пересчитываются по прежним измерениям
+        if measure:
+            elapsed = now - self.last_realloc
+            for flow in self.flows.values():
+                flow.measured = flow.window_bytes / elapsed
+                flow.window_bytes = 0
+            self.last_realloc = now
+        if not self.enabled or not self.flows:
+            return
+
+        def demand(flow):
+            # Поток, который упирался в свою скорость, возьмет сколько дадут; остальным — измеренное с запасом
+            return None if flow.throttled else max(flow.measured * 1.25, self.min_rate)
+
+        tree = {}
+        for flow in self.flows.values():
+            tree.setdefault(flow.tier, {}).setdefault(flow.user, []).append(flow)
+
+        def group_demand(flows):
+            demands = [demand(f) for f in flows]
+            return None if None in demands else sum(demands)
+
+        tier_rates = water_fill(self.total, [(tier, self.weights[tier], group_demand([f for fs in users.values() for f in fs]))
+                                             for tier, users in tree.items()])
+        for tier, users in tree.items():
+            user_rates = water_fill(tier_rates[tier], [(user, 1, group_demand(flows)) for user, flows in users.items()])
+            for user, flows in users.items():
+                flow_rates = water_fill(user_rates[user], [(f.id, 1, demand(f)) for f in flows])
+                for f in flows:
+                    f.rate = flow_rates[f.id]
+                    if measure:
+                        f.throttled = False
+
+    def stats(self):
+        with self.lock:
+            tiers = {}
+            for flow in self.flows.values():
+                tier = tiers.setdefault(flow.tier, {'flows': 0, 'allocated': 0, 'measured': 0})
+                tier['flows'] += 1
+                tier['allocated'] += int(flow.rate)
+                tier['measured'] += int(flow.measured)
+            return {'total': self.total, 'flows': len(self.flows), 'tiers': tiers,
+                    'throttled_seconds': round(self.throttled_seconds, 1)}
+
+
+bandwidth = BandwidthAllocator()
@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from extensions import task_manager
+from services import download_service, get_friendly_error
+from url_keys import canonical_key
+
+logger = logging.getLogger(__name__)
+
+# Сколько ссылок можно отправить одним пакетом
+BATCH_MAX_URLS = int(os.getenv('BATCH_MAX_URLS', 50))
+# Сколько ссылок пакета одновременно проверять через yt-dlp (общий пул для всех пакетов)
+BATCH_INFO_WORKERS = int(os.getenv('BATCH_INFO_WORKERS', 4))
+# Как часто пересчитывать общий прогресс пакетов
+BATCH_POLL_INTERVAL = 1.0
+
+TERMINAL_STATUSES = ('finished', 'error')
+
+
+class BatchItemError(Exception):
+    """Ссылку пакета нельзя скачать; сообщение показывается пользователю как есть."""
+
+
+def parse_urls(raw, limit=BATCH_MAX_URLS):
+    """Ссылки из текста (по одной в строке, через пробел или запятую) или списка, без повторов одного ролика."""
+    if isinstance(raw, str):
+        raw = raw.replace(',', ' ').split()
+    urls, seen = [], set()
+    for url in raw or ():
+        url = str(url).strip()
+        if not url.startswith(('http://', 'https://')):
+            continue
+        key = canonical_key(url)
+        if key in seen:
+            continue
+        seen.add(key)
+        urls.append(url)
+    return urls[:limit] if limit else urls
+
+
+class BatchManager:
+    """Пакет ссылок как одна группа задач.
+
+    Группа — это обычная задача (mode='batch'): ее можно опрашивать через /progress/<id>
+    и на нее можно подписаться через subscribe_task. Информация о ссылках получается
+    параллельно в общем ограниченном пуле BATCH_INFO_WORKERS потоков, после чего каждая
+    ссылка ставится в обычную очередь скачиваний как отдельная задача. Один фоновый поток
+    раз в BATCH_POLL_INTERVAL собирает состояние задач пакета и публикует в группу только
+    изменения, поэтому клиенту не нужно следить за каждой задачей отдельно.
+    """
+    def __init__(self, service=None, tasks=None, workers=BATCH_INFO_WORKERS, interval=BATCH_POLL_INTERVAL):
+        self.service = service or download_service
+        self.tasks = tasks or task_manager
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='batch-info')
+        self.interval = interval
+        self.groups = {}    # group_id -> список элементов пакета
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def create(self, urls, enqueue, release=None):
+        """Создает группу и ставит ссылки на проверку.
+
+        enqueue(url, title) ставит ролик в очередь и возвращает id его задачи
+        (или бросает BatchItemError). release(url), если задан, вызывается для ссылки,
+        которая так и не попала в очередь. Возвращает id группы.
+        """
+        group_id = self.tasks.create_task()
+        items = [{'url': url, 'status': 'pending', 'title': None, 'task_id': None, 'progress': 0, 'error': None}
+                 for url in urls]
+        with self.lock:
+            self.groups[group_id] = items
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self._watch_loop, daemon=True)
+                self.watcher.start()
+        self.tasks.update_task(group_id, mode='batch', status='queued', total=len(items), done=0, failed=0,
+                               items=[dict(item) for item in items])
+        for item in items:
+            self.executor.submit(self._prepare, item, enqueue, release)
+        return group_id
+
+    def _prepare(self, item, enqueue, release=None):
+        url = item['url']
+        item['status'] = 'extracting'
+        try:
+            # Информация могла уже быть получена через /get_info или другой пакет
+            summary = self.tasks.get_cached_info(url)
+            if summary is None:
+                info = self.service.lookup_info(url)
+                if info.get('_type') == 'playlist':
+                    raise BatchItemError('Плейлисты скачиваются отдельно (ZIP).')
+                if (info.get('age_limit') or 0) >= 18:
+                    raise BatchItemError('Скачивание видео с возрастным ограничением (18+) запрещено.')
+                summary = self.service.video_summary(info)
+                self.tasks.cache_info(url, summary)
+            item['title'] = summary.get('title')
+            item['task_id'] = enqueue(url, item['title'])
+            item['status'] = 'queued'
+        except BatchItemError as e:
+            item.update(status='error', error=str(e))
+        except Exception as e:
+            item.update(status='error', error=get_friendly_error(e))
+        if item['status'] == 'error' and release:
+            try:
+                release(url)
+            except Exception as e:
+                logger.error(f"Batch release error for {url}: {e}")
+
+    def _aggregate(self, items):
+        """Состояние группы из состояний ее задач."""
+        view = []
+        for item in items:
+            entry = dict(item)
+            if item['task_id']:
+                task = self.tasks.get_task(item['task_id']) or {'status': 'error', 'error': 'Задача истекла'}
+                entry['status'] = task.get('status', entry['status'])
+                entry['progress'] = 100 if entry['status'] == 'finished' else task.get('progress') or 0
+                entry['error'] = task.get('error')
+            view.append(entry)
+        done = sum(1 for e in view if e['status'] == 'finished')
+        failed = sum(1 for e in view if e['status'] == 'error')
+        total = len(view)
+        progress = round(sum(e['progress'] for e in view if e['status'] != 'error') / max(total - failed, 1), 1)
+        if done + failed == total:
+            status = 'finished' if done else 'error'
+        elif any(e['status'] in ('downloading', 'processing') for e in view):
+            status = 'downloading'
+        else:
+            status = 'queued'
+        state = {'status': status, 'progress': progress, 'done': done, 'failed': failed, 'items': view}
+        if status == 'error':
+            state['error'] = 'Ни одну ссылку пакета скачать не удалось'
+        return state
+
+    def _watch_loop(self):
+        published = {}
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                groups = list(self.groups.items())
+            for group_id, items in groups:
+                try:
+                    state = self._aggregate(items)
+                except Exception as e:
+                    logger.error(f"Batch {group_id} aggregation error: {e}")
+                    continue
+                # Публикуем только изменившиеся поля
+                previous = published.get(group_id, {})
+                changed = {k: v for k, v in state.items() if previous.get(k) != v}
+                if changed:
+                    self.tasks.update_task(group_id, **changed)
+                    published[group_id] = state
+                if state['status'] in TERMINAL_STATUSES:
+                    with self.lock:
+                        self.groups.pop(group_id, None)
+                    published.pop(group_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {'groups': len(self.groups), 'items': sum(len(items) for items in self.groups.values())}
+
+
+batch_manager = BatchManager()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Подсчет размеров для кнопок качества: прежние повторные проходы по списку форматов
+против индекса FormatIndex, построенного за один проход.
+
+Списки форматов синтетические (как у YouTube: готовые файлы, видео без звука в
+нескольких кодеках и контейнерах, аудио), длина растет до нескольких тысяч — так
+выглядят ролики с HLS/DASH-вариантами и много-языковыми дорожками.
+
+    python benchmarks/bench_format_index.py [число_итераций]
+"""
+import os
+import sys
+import time
+import random
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from format_index import FormatIndex, QUALITY_LADDER
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+SIZES = (30, 300, 3000)
+
+
+def make_formats(count, seed=0):
+    rnd = random.Random(seed)
+    heights = list(QUALITY_LADDER) + [1088, 1072]
+    codecs = [('avc1.64001F', 'mp4'), ('vp09.00.40.08', 'webm'), ('av01.0.08M.08', 'mp4')]
+    formats = []
+    for i in range(count):
+        kind = rnd.random()
+        if kind < 0.2:
+            formats.append({'format_id': str(i), 'vcodec': 'none', 'acodec': rnd.choice(['mp4a.40.2', 'opus']),
+                            'ext': rnd.choice(['m4a', 'webm']), 'abr': rnd.choice([48, 64, 129.5, 160])})
+        elif kind < 0.3:
+            formats.append({'format_id': str(i), 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'ext': 'mp4',
+                            'height': rnd.choice([360, 720]), 'tbr': rnd.uniform(300, 2500)})
+        else:
+            vcodec, ext = rnd.choice(codecs)
+            f = {'format_id': str(i), 'vcodec': vcodec, 'acodec': 'none', 'ext': ext,
+                 'height': str(rnd.choice(heights)) if rnd.random() < 0.1 else rnd.choice(heights)}
+            if rnd.random() < 0.5:
+                f['filesize'] = rnd.randint(10 ** 6, 10 ** 9)
+            else:
+                f['vbr'] = rnd.uniform(100, 20000)
+            formats.append(f)
+    return formats
+
+
+def legacy_total_sizes(info, heights):
+    """Прежний calculate_sizes: отдельные проходы для высоты, аудио и по два на каждую ступень."""
+    formats = info.get('formats', [])
+    duration = info.get('duration')
+
+    max_height = 0
+    for f in formats:
+        h = f.get('height')
+        if h:
+            try: max_height = max(max_height, int(h))
+            except: pass
+
+    try: duration = float(duration) if duration else 0
+    except: duration = 0
+
+    def get_size(f):
+        size = f.get('filesize') or f.get('filesize_approx')
+        if size: return size
+        if duration:
+            tbr = f.get('tbr')
+            if tbr: return int(tbr * 1000 / 8 * duration)
+            vbr = f.get('vbr')
+            abr = f.get('abr')
+            if vbr:
+                return int((vbr + (abr or 0)) * 1000 / 8 * duration)
+        return 0
+
+    audio_size = 0
+    for f in formats:
+        if f.get('acodec') != 'none' and f.get('vcodec') == 'none':
+            audio_size = max(audio_size, get_size(f))
+
+    def calc_total_size(height, prefer_mp4=True):
+        best_premerged = 0
+        for f in formats:
+            h = f.get('height', 0) or 0
+            try: h = int(h)
+            except: h = 0
+            if prefer_mp4 and f.get('ext') != 'mp4' and f.get('ext') != 'm4a':
+                continue
+            if abs(h - height) < 20 and f.get('vcodec') != 'none' and f.get('acodec') != 'none':
+                best_premerged = max(best_premerged, get_size(f))
+        if best_premerged > 0: return best_premerged
+        v_size_only = 0
+        for f in formats:
+            h = f.get('height', 0) or 0
+            try: h = int(h)
+            except: h = 0
+            if prefer_mp4 and f.get('ext') != 'mp4': continue
+            if abs(h - height) < 20 and f.get('vcodec') != 'none' and f.get('acodec') == 'none':
+                v_size_only = max(v_size_only, get_size(f))
+        return v_size_only + audio_size if v_size_only > 0 else 0
+
+    result = {h: calc_total_size(h) for h in heights}
+    result['best'] = calc_total_size(max_height) or calc_total_size(1080)
+    result['audio'] = audio_size
+    return result
+
+
+def indexed_total_sizes(info, heights):
+    index = FormatIndex(info.get('formats'), info.get('duration'))
+    result = {h: index.total_size(h) for h in heights}
+    result['best'] = index.total_size(index.max_height) or index.total_size(1080)
+    result['audio'] = index.audio_size
+    return result
+
+
+def measure(func, info, heights):
+    timings = []
+    for _ in range(ITERATIONS):
+        started = time.perf_counter()
+        func(info, heights)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+if __name__ == '__main__':
+    print(f"⏱  Итераций: {ITERATIONS}")
+    print("=" * 72)
+    for count in SIZES:
+        info = {'duration': 600, 'formats': make_formats(count)}
+        for label, heights in (('кнопки', (720, 1080)), ('лестница', QUALITY_LADDER)):
+            assert legacy_total_sizes(info, heights) == indexed_total_sizes(info, heights), 'результаты расходятся'
+            old = measure(legacy_total_sizes, info, heights)
+            new = measure(indexed_total_sizes, info, heights)
+            print(f"{count:>5} форматов, {label:<8}  было: {old:8.3f} мс   индекс: {new:8.3f} мс   x{old / new:5.1f}")
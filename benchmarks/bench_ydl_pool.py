@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Сравнение накладных расходов: новый YoutubeDL на каждый запрос против экземпляра из пула.
+
+Сеть не используется — измеряется только подготовка: разбор параметров, загрузка cookies,
+создание экстрактора YouTube и HTTP-обработчиков, то есть то, что yt-dlp делает
+до первого сетевого запроса.
+
+    python benchmarks/bench_ydl_pool.py [число_итераций]
+"""
+import os
+import sys
+import time
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp
+from ydl_pool import YdlPool
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+BASE_OPTS = {
+    'quiet': True,
+    'merge_output_format': 'mp4',
+    'extractor_args': {'youtube': {'lang': ['en'], 'player_skip': ['android']}},
+}
+
+
+def prepare(ydl):
+    # То, что yt-dlp делает при первом extract_info до обращения в сеть
+    ydl.get_info_extractor('Youtube')
+    ydl._request_director
+
+
+def run_fresh():
+    timings = []
+    for i in range(ITERATIONS):
+        started = time.perf_counter()
+        opts = dict(BASE_OPTS, outtmpl=f'downloads/bench{i}_%(title)s.%(ext)s', format='bestvideo[height<=720]+bestaudio/best')
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            prepare(ydl)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def run_pooled():
+    pool = YdlPool()
+    timings = []
+    for i in range(ITERATIONS):
+        started = time.perf_counter()
+        overrides = {'outtmpl': f'downloads/bench{i}_%(title)s.%(ext)s', 'format': 'bestvideo[height<=720]+bestaudio/best',
+                     'progress_hooks': [lambda d: None], 'ratelimit': 500 * 1024}
+        with pool.checkout('free', BASE_OPTS, overrides) as ydl:
+            prepare(ydl)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name, timings):
+    ms = [t * 1000 for t in timings]
+    print(f"{name:<10} первый: {ms[0]:8.2f} мс   медиана: {statistics.median(ms):8.2f} мс   "
+          f"p95: {sorted(ms)[int(len(ms) * 0.95) - 1]:8.2f} мс")
+
+
+if __name__ == '__main__':
+    print(f"⏱  Итераций: {ITERATIONS}")
+    print("=" * 60)
+    report('Новый', run_fresh())
+    report('Пул', run_pooled())
@@ -1,5 +1,7 @@
 from flask import Blueprint, request, jsonify, render_template, session, redirect, url_for
-from extensions import get_db, ADMIN_EMAIL, socketio, AVATAR_FOLDER
+from extensions import get_db, ADMIN_EMAIL, socketio, AVATAR_FOLDER, reaper, storage
+from bandwidth import bandwidth
+from fragments import fragment_tuner
 from datetime import datetime, timedelta
 import sqlite3
 import os
@@ -121,17 +123,24 @@ def stats():
         # Общее количество скачиваний
         total_downloads = conn.execute('SELECT COUNT(*) FROM history').fetchone()[0]
         
-        # Топ 10 популярных видео (по URL)
+        # Топ 10 популярных видео (по каноническому ключу ролика, чтобы youtu.be и watch?v= считались вместе)
         top_videos = conn.execute('''
-            SELECT title, url, COUNT(*) as count 
+            SELECT title, url, COUNT(*) as count, MAX(id) as last_id 
             FROM history 
-            GROUP BY url 
+            GROUP BY COALESCE(video_key, url) 
             ORDER BY count DESC 
             LIMIT 10
         ''').fetchall()
         
     return render_template('admin_stats.html', stats=stats_data, chart_data=chart_data, total_downloads=total_downloads, top_videos=top_videos)
 
+@admin_bp.route('/runtime_stats')
+def runtime_stats():
+    """Состояние фоновых механизмов процесса: удаление по сроку, место под загрузки, распределение полосы,
+    параллельность фрагментов."""
+    return jsonify({'reaper': reaper.stats(), 'storage': storage.stats(), 'bandwidth': bandwidth.stats(),
+                    'fragments': fragment_tuner.stats()})
+
 @admin_bp.route('/send_notification', methods=['POST'])
 def send_notification():
     data = request.json
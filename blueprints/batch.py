@@ -0,0 +1,65 @@
+from flask import Blueprint, request, jsonify, session
+from extensions import check_limit, task_manager
+from batches import batch_manager, parse_urls, BatchItemError, BATCH_MAX_URLS
+from blueprints.download import free_plan_error, today_count, add_history, remove_history, queue_download
+from models import UserRepository
+
+batch_bp = Blueprint('batch', __name__)
+
+@batch_bp.route('/batch', methods=['POST'])
+def create_batch():
+    """Пакет ссылок: JSON {"urls": [...], "quality": "720"} или форма с urls (по одной в строке).
+
+    Возвращает id группы; прогресс всего пакета — /progress/<group_id> или subscribe_task.
+    """
+    if check_limit('heavy'):
+        return jsonify({'error': 'Слишком много одновременных загрузок. Подождите минуту.'}), 429
+    if 'user_id' not in session:
+        return jsonify({'error': 'Для скачивания войдите в аккаунт (лимит 5 видео в день).'}), 401
+    user_id = session['user_id']
+
+    data = request.get_json(silent=True) or request.form
+    urls = parse_urls(data.get('urls'), limit=None)
+    quality = data.get('quality', 'best')
+    if not urls:
+        return jsonify({'error': "Пожалуйста, вставьте ссылки!"}), 400
+    if len(urls) > BATCH_MAX_URLS:
+        return jsonify({'error': f'Не больше {BATCH_MAX_URLS} ссылок за один раз.'}), 400
+
+    is_premium = UserRepository.is_premium(UserRepository.get_user(user_id))
+    if not is_premium:
+        error = free_plan_error('', quality)
+        if error:
+            return jsonify({'error': error}), 403
+        remaining = 5 - today_count(user_id)
+        if len(urls) > remaining:
+            return jsonify({'error': f'Дневной лимит: можно скачать еще {max(remaining, 0)} из 5. Купите Premium для безлимита!'}), 403
+
+    # Записи в историю делаются сразу, в запросе: ссылки проверяются в фоне, и без этого
+    # параллельные запросы успели бы пройти проверку лимита до появления записей
+    history_ids = {url: add_history(user_id, url) for url in urls}
+    if not is_premium:
+        used = today_count(user_id)
+        if used > 5:
+            remove_history(history_ids.values())
+            remaining = 5 - (used - len(urls))
+            return jsonify({'error': f'Дневной лимит: можно скачать еще {max(remaining, 0)} из 5. Купите Premium для безлимита!'}), 403
+
+    def enqueue(url, title):
+        # Вызывается из пула проверки ссылок, вне контекста запроса
+        if not is_premium:
+            error = free_plan_error(url, quality)
+            if error:
+                raise BatchItemError(error)
+        task_id = task_manager.create_task()
+        body, status = queue_download(task_id, url, quality, user_id, is_premium, history_ids[url])
+        if status != 200:
+            raise BatchItemError(body.get('error'))
+        return task_id
+
+    def release(url):
+        # Ссылка не попала в очередь — возвращаем ее место в дневном лимите
+        remove_history([history_ids.get(url)])
+
+    group_id = batch_manager.create(urls, enqueue, release)
+    return jsonify({'group_id': group_id, 'total': len(urls)})
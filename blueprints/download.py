@@ -1,9 +1,18 @@
-from flask import Blueprint, request, jsonify, session, send_file
-from extensions import check_limit, task_manager, get_db
-from services import download_service, PROXY_URL
+from flask import Blueprint, request, jsonify, session, Response
+from flask_socketio import join_room
+from extensions import check_limit, task_manager, get_db, socketio, storage
+from task_events import task_room
+from services import download_service, get_friendly_error
+from scheduler import download_scheduler, QueueFullError
+from media_cache import media_cache
+from fragments import ConnectionsBusyError
+from streaming import STREAMING_ENABLED, STREAM_QUALITIES, STREAM_START_TIMEOUT, find_ffmpeg
+from file_serving import serve_file, content_disposition
+from playlists import playlist_registry, playlist_browser, page_items
+from url_keys import canonical_key
 from models import UserRepository
 import os
-import threading
+import mimetypes
 from datetime import datetime
 
 download_bp = Blueprint('download', __name__)
@@ -35,68 +44,167 @@ def get_info():
         
         cached_data = task_manager.get_cached_info(url)
         if cached_data:
-            return jsonify(cached_data)
+            return jsonify(dict(cached_data, stream_qualities=stream_qualities()))
 
-        info = download_service.get_video_info(url, proxy=PROXY_URL)
+        # Для плейлиста yt-dlp получает только первую страницу списка, остальные — через /playlist_page
+        info = download_service.lookup_info(url, playlist_items=page_items(1))
             
         if info.get('age_limit') is not None and info.get('age_limit') >= 18:
             return jsonify({'error': 'Скачивание видео с возрастным ограничением (18+) запрещено.'}), 400
 
         if info.get('_type') == 'playlist':
-            count = info.get('playlist_count') or len(info.get('entries', []))
-            
-            entries_list = []
-            for entry in info.get('entries', []):
-                if entry:
-                    entries_list.append({
-                        'id': entry.get('id'),
-                        'title': entry.get('title', 'Без названия'),
-                        'duration': entry.get('duration')
-                    })
+            page = playlist_browser.page(url, 1, info=info)
+            count = page['count'] or (f"{len(page['entries'])}+" if page['next_cursor'] else len(page['entries']))
 
             return jsonify({
-                'title': f"Плейлист: {info.get('title', 'Без названия')}",
+                'title': f"Плейлист: {page['title']}",
                 'thumbnail': '',
                 'duration': f"{count} видео",
                 'is_playlist': True,
-                'entries': entries_list,
+                'entries': page['entries'],
+                'next_cursor': page['next_cursor'],
                 'sizes': {
                     'best': 'Скачать всё (ZIP)',
                     'audio': 'Только аудио (ZIP)'
                 }
             })
 
-        sizes = download_service.calculate_sizes(info)
-
-        duration = info.get('duration')
-        duration_str = info.get('duration_string', '')
-        if duration:
-            try:
-                d = int(duration)
-                h = d // 3600
-                m = (d % 3600) // 60
-                s = d % 60
-                
-                parts = []
-                if h > 0: parts.append(f"{h} h")
-                if m > 0: parts.append(f"{m} min")
-                if s > 0 or (h==0 and m==0): parts.append(f"{s} sec")
-                
-                duration_str = " ".join(parts)
-            except: pass
-
-        result_data = {
-            'title': info.get('title', 'Без названия'),
-            'thumbnail': info.get('thumbnail', ''),
-            'duration': duration_str,
-            'sizes': sizes
-        }
+        result_data = download_service.video_summary(info)
         
         task_manager.cache_info(url, result_data)
         
-        return jsonify(result_data)
+        return jsonify(dict(result_data, stream_qualities=stream_qualities()))
+    except Exception as e:
+        return jsonify({'error': get_friendly_error(e)}), 500
+
+@download_bp.route('/playlist_page', methods=['POST'])
+def playlist_page():
+    """Следующая страница плейлиста (cursor — номер первого ролика) или повтор текущей за дополненными данными."""
+    url = request.form.get('url')
+    if not url:
+        return jsonify({'error': 'Пустая ссылка'}), 400
+    try:
+        cursor = max(1, int(request.form.get('cursor', 1)))
+    except ValueError:
+        return jsonify({'error': 'Неверный номер страницы'}), 400
+
+    # Закэшированная страница (в том числе повторы за дополненными данными) yt-dlp не запускает
+    if not playlist_browser.is_cached(url, cursor) and check_limit('global'):
+        return jsonify({'error': 'Слишком много запросов. Подождите немного.'}), 429
+    try:
+        return jsonify(playlist_browser.page(url, cursor))
+    except Exception as e:
+        return jsonify({'error': get_friendly_error(e)}), 500
+
+def download_limits(is_premium):
+    """Ограничения тарифа: (ratelimit, limit_height, sleep_interval)."""
+    if is_premium:
+        return None, None, 0
+    return 500 * 1024, 720, 2
+
+def free_plan_error(video_url, quality, playlist=False):
+    """Что недоступно бесплатному тарифу для этой ссылки и качества; None — можно скачивать."""
+    if 'list=' in video_url or playlist:
+        return 'Скачивание плейлистов доступно только в Premium. Для скачивания одного видео удалите "list=..." из ссылки.'
+    if quality == 'best':
+        return 'Лучшее качество (Original) доступно только в Premium. Выберите 720p.'
+    if quality == '1080':
+        return 'Качество 1080p доступно только в Premium'
+    return None
+
+def today_count(user_id):
+    # Проверка лимита вручную для надежности (совпадение с форматом записи)
+    with get_db() as conn:
+        today_str = datetime.now().strftime('%Y-%m-%d')
+        return conn.execute("SELECT COUNT(*) FROM history WHERE user_id = ? AND timestamp LIKE ?", (user_id, f'{today_str}%')).fetchone()[0]
+
+def add_history(user_id, video_url):
+    """Фикс лимита: запись в историю делается СРАЗУ, до начала скачивания."""
+    if not user_id:
+        return None
+    try:
+        with get_db() as conn:
+            # Используем стандартный формат даты SQL, чтобы проверка лимита работала корректно
+            cur = conn.execute('INSERT INTO history (user_id, title, url, video_key, timestamp) VALUES (?, ?, ?, ?, ?)', 
+                         (user_id, 'Скачивание...', video_url, canonical_key(video_url), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+            return cur.lastrowid
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        print(f"History save error: {e}")
+        return None
+
+def remove_history(history_ids):
+    """Откат записей истории, чтобы несостоявшиеся скачивания не тратили дневной лимит."""
+    history_ids = [h for h in history_ids if h]
+    if not history_ids:
+        return
+    try:
+        with get_db() as conn:
+            conn.executemany('DELETE FROM history WHERE id = ?', [(h,) for h in history_ids])
+            conn.commit()
+    except Exception: pass
+
+def stream_qualities():
+    """Качества, которые сервер сейчас может отдавать потоком (клиент просит mode=stream только для них)."""
+    if not (STREAMING_ENABLED and find_ffmpeg() and download_service.stream_available()):
+        return []
+    return list(STREAM_QUALITIES)
+
+def reject_download(task_id, history_id, error):
+    task_manager.update_task(task_id, status='error', error=error)
+    # Откатываем записи в истории (свою и присоединившихся), чтобы не тратить лимит пользователей
+    followers = download_service.leave_inflight(task_id)
+    remove_history([history_id] + [f_hid for _, f_hid in followers])
+
+def queue_download(task_id, video_url, quality, user_id, is_premium, history_id, stream=False):
+    """Запускает скачивание одного ролика: кэш, потоковый режим, присоединение к идущей загрузке или очередь.
+
+    Возвращает (тело ответа, HTTP-код).
+    """
+    ratelimit, limit_height, sleep_interval = download_limits(is_premium)
+
+    # Файл уже есть в кэше — задача завершается мгновенно, без yt-dlp
+    cached = media_cache.lookup(download_service.request_key(video_url, quality, limit_height), task_id=task_id)
+    if cached:
+        task_manager.update_task(task_id, status='finished', progress=100, filename=cached['path'],
+                                 download_name=cached['download_name'], cache_key=cached['key'])
+        if history_id and cached.get('title'):
+            try:
+                with get_db() as conn:
+                    conn.execute('UPDATE history SET title = ? WHERE id = ?', (cached['title'], history_id))
+                    conn.commit()
+            except Exception: pass
+        return {'task_id': task_id, 'queue_position': 0}, 200
+
+    # Потоковый режим: файл отдается по /stream/<task_id> прямо во время скачивания, без очереди.
+    # Только по запросу клиента, для разрешенных качеств и пока есть место в лимите потоков —
+    # иначе обычная очередь с кэшем, резервом места и продолжением после перезапуска
+    if stream and quality in stream_qualities() and 'list=' not in video_url:
+        task_manager.update_task(task_id, status='stream_ready', mode='stream', url=video_url, quality=quality,
+                                 limit_height=limit_height, ratelimit=ratelimit, history_id=history_id, user_id=user_id)
+        download_service.expect_stream(task_id)
+        return {'task_id': task_id, 'stream_url': f'/stream/{task_id}'}, 200
+
+    # Такой же ролик в таком же качестве уже качается — присоединяемся к нему вместо повторной загрузки
+    leader_id = download_service.join_inflight(task_id, video_url, quality, limit_height, ratelimit, history_id)
+    if leader_id:
+        task = download_scheduler.with_position(task_id, task_manager.get_task(task_id)) or {}
+        return {'task_id': task_id, 'queue_position': task.get('queue_position', 0)}, 200
+
+    # Оценка размера (по данным /get_info) резервируется воркером перед стартом загрузки
+    estimate = download_service.estimate_size(video_url, quality, limit_height)
+    if not storage.fits(estimate):
+        reject_download(task_id, history_id, 'Недостаточно места на сервере')
+        return {'error': 'Файл слишком большой для сервера. Выберите качество пониже.'}, 507
+
+    # Ставим скачивание в очередь пула воркеров (Premium обслуживается в приоритете)
+    try:
+        download_scheduler.submit(task_id, 'download', video_url, quality, user_id, ratelimit, limit_height, sleep_interval, history_id, estimate, premium=is_premium)
+    except QueueFullError:
+        reject_download(task_id, history_id, 'Сервер перегружен')
+        return {'error': 'Сервер перегружен: слишком много загрузок в очереди. Попробуйте через минуту.'}, 503
+    
+    return {'task_id': task_id, 'queue_position': download_scheduler.position(task_id)}, 200
 
 @download_bp.route('/start_download', methods=['POST'])
 def start_download():
@@ -116,74 +224,140 @@ def start_download():
             user = UserRepository.get_user(session['user_id'])
         is_premium = UserRepository.is_premium(user)
 
-    ratelimit = None
-    limit_height = None
-    sleep_interval = 0
-
     if not is_premium:
         if 'user_id' not in session:
             return jsonify({'error': 'Для скачивания войдите в аккаунт (лимит 5 видео в день).'}), 401
-            
-        # Проверка лимита вручную для надежности
-        with get_db() as conn:
-            today_str = datetime.now().strftime('%Y-%m-%d')
-            count = conn.execute("SELECT COUNT(*) FROM history WHERE user_id = ? AND timestamp LIKE ?", (session['user_id'], f'{today_str}%')).fetchone()[0]
 
-        if count >= 5:
+        if today_count(session['user_id']) >= 5:
             return jsonify({'error': 'Дневной лимит исчерпан (5/5). Купите Premium для безлимита!'}), 403
         
-        if 'list=' in video_url:
-             return jsonify({'error': 'Скачивание плейлистов доступно только в Premium. Для скачивания одного видео удалите "list=..." из ссылки.'}), 403
-
-        if quality == 'best':
-            return jsonify({'error': 'Лучшее качество (Original) доступно только в Premium. Выберите 720p.'}), 403
-        if quality == '1080':
-            return jsonify({'error': 'Качество 1080p доступно только в Premium'}), 403
-        
-        ratelimit = 500 * 1024
-        limit_height = 720
-        sleep_interval = 2
-        
-    task_manager.cleanup()
+        error = free_plan_error(video_url, quality, request.form.get('playlist') == '1')
+        if error:
+            return jsonify({'error': error}), 403
 
     task_id = task_manager.create_task()
+    history_id = add_history(user_id, video_url)
 
-    # Фикс лимита: Записываем в историю СРАЗУ в основном потоке
-    history_id = None
-    if user_id:
+    # Плейлист: ролики качаются параллельно, а ZIP отдается по /get_file/<task_id> по мере готовности
+    if request.form.get('playlist') == '1':
+        task_manager.update_task(task_id, mode='playlist', url=video_url, quality=quality)
+        playlist_registry.create(task_id, user=user_id)
         try:
-            with get_db() as conn:
-                # Используем стандартный формат даты SQL, чтобы проверка лимита работала корректно
-                cur = conn.execute('INSERT INTO history (user_id, title, url, timestamp) VALUES (?, ?, ?, ?)', 
-                             (user_id, 'Скачивание...', video_url, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-                conn.commit()
-                history_id = cur.lastrowid
-        except Exception as e:
-            print(f"History save error: {e}")
+            download_scheduler.submit(task_id, 'playlist', video_url, quality, history_id, premium=is_premium)
+        except QueueFullError:
+            playlist_registry.remove(task_id)
+            reject_download(task_id, history_id, 'Сервер перегружен')
+            return jsonify({'error': 'Сервер перегружен: слишком много загрузок в очереди. Попробуйте через минуту.'}), 503
+        return jsonify({'task_id': task_id, 'zip_url': f'/get_file/{task_id}', 'queue_position': download_scheduler.position(task_id)})
 
-    # Запускаем скачивание в отдельном потоке, чтобы не блокировать интерфейс
-    thread = threading.Thread(target=download_service.background_download, args=(task_id, video_url, quality, user_id, ratelimit, limit_height, sleep_interval, history_id))
-    thread.start() 
-    
-    return jsonify({'task_id': task_id})
+    body, status = queue_download(task_id, video_url, quality, user_id, is_premium, history_id,
+                                  stream=request.form.get('mode') == 'stream')
+    return jsonify(body), status
 
 @download_bp.route('/progress/<task_id>')
 def get_progress(task_id):
     task = task_manager.get_task(task_id)
     if not task:
         return jsonify({'error': 'Task not found'}), 404
-    return jsonify(task)
+    return jsonify(download_scheduler.with_position(task_id, task))
+
+@socketio.on('subscribe_task')
+def subscribe_task(data):
+    """Подписка на прогресс задачи: клиент получает события task_progress и текущее состояние в ответ."""
+    task_id = (data or {}).get('task_id')
+    task = task_manager.get_task(task_id) if task_id else None
+    if not task:
+        return {'error': 'Task not found'}
+    join_room(task_room(task_id))
+    # Присоединенная к чужой загрузке задача получает прогресс лидера
+    if task.get('leader_id'):
+        join_room(task_room(task['leader_id']))
+    return download_scheduler.with_position(task_id, task)
+
+@download_bp.route('/stream/<task_id>')
+def stream_file(task_id):
+    # Ссылка одноразовая: каждый запрос запускал бы скачивание заново
+    task, refused = download_service.claim_stream(task_id)
+    if refused == 'missing':
+        return "Файл не найден (задача истекла или не существует)", 404
+    if refused == 'used':
+        return "Ссылка уже использована. Начните скачивание заново.", 410
+    if refused == 'busy':
+        return "Сервер перегружен: слишком много потоковых загрузок. Попробуйте через минуту.", 503
+
+    try:
+        stream, download_name, info = download_service.open_stream(task_id, task['url'], task['quality'],
+                                                                   task.get('limit_height'), task.get('ratelimit'),
+                                                                   user=task.get('user_id'))
+    except Exception as e:
+        task_manager.update_task(task_id, status='error', error=get_friendly_error(e))
+        # Ни одного байта не отдали — запись в истории не должна тратить лимит
+        if task.get('history_id') and task.get('status') == 'stream_ready':
+            try:
+                with get_db() as conn:
+                    conn.execute('DELETE FROM history WHERE id = ?', (task['history_id'],))
+                    conn.commit()
+            except Exception: pass
+        # Все соединения заняты — временная перегрузка, а не ошибка источника
+        return get_friendly_error(e), 503 if isinstance(e, ConnectionsBusyError) else 502
+
+    if task.get('history_id'):
+        try:
+            with get_db() as conn:
+                conn.execute('UPDATE history SET title = ? WHERE id = ?', (info.get('title', 'Video'), task['history_id']))
+                conn.commit()
+        except Exception: pass
+
+    # Размер заранее неизвестен, поэтому ответ идет частями (chunked) по мере скачивания
+    response = Response(stream, mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream', direct_passthrough=True)
+    response.headers['Content-Disposition'] = content_disposition(download_name)
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx не должен копить поток у себя
+    return response
+
+def playlist_zip(task_id):
+    archive = playlist_registry.get(task_id)
+    if not archive:
+        return "Архив не найден (задача истекла или уже завершена)", 404
+    # Ждем список роликов, чтобы назвать архив по плейлисту и сразу сообщить об ошибке
+    archive.listed.wait(STREAM_START_TIMEOUT)
+    task = task_manager.get_task(task_id) or {}
+    if task.get('status') == 'error':
+        return task.get('error') or 'Ошибка загрузки плейлиста', 502
+    if not archive.attach():
+        return "Архив уже скачивается в другом окне", 409
+
+    response = Response(archive.stream(), mimetype='application/zip', direct_passthrough=True)
+    response.headers['Content-Disposition'] = content_disposition(f"{archive.title or 'playlist'}.zip")
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @download_bp.route('/get_file/<task_id>')
 def get_file(task_id):
     task = task_manager.get_task(task_id)
-    if not task or not task['filename']:
+    if task and task.get('mode') == 'playlist':
+        return playlist_zip(task_id)
+    if not task or not task.get('filename'):
         return "Файл не найден (задача истекла или не существует)", 404
 
+    # Пока файл отдается клиенту, он не может быть вытеснен ни из кэша, ни из учета места
+    cache_key = task.get('cache_key')
+    if cache_key:
+        if not media_cache.acquire(cache_key):
+            cache_key = None
+        release = (lambda: media_cache.release(cache_key)) if cache_key else None
+    else:
+        # Присоединенная задача отдает файл лидера
+        owner = task.get('leader_id') or task_id
+        release = (lambda: storage.release(owner)) if storage.acquire(owner) else None
+
     try:
         if not os.path.exists(task['filename']):
+            if release: release()
             return "Файл физически отсутствует на сервере (возможно, был удален)", 404
 
-        return send_file(task['filename'], as_attachment=True, download_name=task.get('download_name'))
+        # Ссылка снимается, когда передача закончена или прервана
+        return serve_file(task['filename'], task.get('download_name') or os.path.basename(task['filename']),
+                          on_close=release)
     except Exception as e:
+        if release: release()
         return f"Ошибка отправки файла: {e}", 500
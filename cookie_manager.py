@@ -0,0 +1,159 @@
+import os
+import time
+import shutil
+import zlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Файлы cookies разных аккаунтов через запятую (пути относительно папки проекта)
+COOKIE_FILES = [p.strip() for p in os.getenv('COOKIE_FILES', 'cookies.txt').split(',') if p.strip()]
+# Как часто проверять mtime файлов (сек). Между проверками файлы не трогаются вообще
+COOKIE_CHECK_INTERVAL = int(os.getenv('COOKIE_CHECK_INTERVAL', 30))
+# Сколько не использовать аккаунт после проверки "я не робот" (сек)
+COOKIE_COOLDOWN = int(os.getenv('COOKIE_COOLDOWN', 600))
+# Меньше этого числа cookies — файл считаем пустым (экспорт без входа в аккаунт)
+COOKIE_MIN_COUNT = 4
+# Куда класть рабочие копии файлов: yt-dlp при закрытии сохраняет cookies обратно в cookiefile,
+# и запись в исходный файл меняла бы его mtime (версию) — пул YoutubeDL пересоздавался бы постоянно
+COOKIE_COPY_DIR = os.getenv('COOKIE_COPY_DIR', os.path.join(BASE_DIR, 'data', 'cookies'))
+
+
+def count_cookies(path):
+    """Считает cookies в файле формата Netscape (7 полей через табуляцию)."""
+    count = 0
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#HttpOnly_'):
+                line = line[len('#HttpOnly_'):]
+            elif not line or line.startswith('#'):
+                continue
+            if len(line.split('\t')) == 7:
+                count += 1
+    return count
+
+
+class CookieManager:
+    """Пул файлов cookies (аккаунтов) с перечиткой по mtime и паузой после бот-проверок.
+
+    Файлы проверяются и разбираются один раз; повторно — только если изменился mtime,
+    а сам mtime смотрится не чаще раза в COOKIE_CHECK_INTERVAL. Запросы раздаются
+    наименее использованному рабочему аккаунту; аккаунт, на котором YouTube
+    потребовал проверку "я не робот", отдыхает COOKIE_COOLDOWN секунд.
+
+    YoutubeDL получает не сам файл, а его копию для текущей версии (working_copy):
+    то, что yt-dlp пишет в cookiefile, не меняет версию исходного файла.
+    """
+    def __init__(self, paths=None, check_interval=COOKIE_CHECK_INTERVAL, cooldown=COOKIE_COOLDOWN, copy_dir=COOKIE_COPY_DIR):
+        paths = COOKIE_FILES if paths is None else paths
+        self.check_interval = check_interval
+        self.cooldown = cooldown
+        self.copy_dir = copy_dir
+        self.jars = {}     # путь -> состояние файла
+        self.copies = {}   # рабочая копия -> исходный путь
+        for path in paths:
+            path = path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+            self.jars[path] = {'mtime': None, 'count': 0, 'valid': False, 'uses': 0,
+                               'failures': 0, 'cooldown_until': 0, 'copy': None}
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Перечитывает файлы, у которых изменился mtime."""
+        now = time.time()
+        with self.lock:
+            if not force and now - self.checked < self.check_interval:
+                return
+            self.checked = now
+        for path, jar in self.jars.items():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                if jar['valid']:
+                    logger.warning(f"Cookies file disappeared: {path}")
+                jar.update(mtime=None, count=0, valid=False)
+                continue
+            if mtime == jar['mtime']:
+                continue
+            try:
+                count = count_cookies(path)
+            except OSError as e:
+                logger.warning(f"Could not read cookies file {path}: {e}")
+                count = 0
+            jar.update(mtime=mtime, count=count, valid=count >= COOKIE_MIN_COUNT)
+            self._copy(path, jar)
+            logger.info(f"Loaded cookies file {os.path.basename(path)} with {count} cookies")
+
+    def _copy(self, path, jar):
+        """Снимает рабочую копию новой версии файла; копии прежних версий (и прошлых запусков) удаляются."""
+        prefix = f"{zlib.crc32(path.encode('utf-8')):08x}-"
+        copy = os.path.join(self.copy_dir, f"{prefix}{int(jar['mtime'] * 1000)}-{os.path.basename(path)}")
+        try:
+            os.makedirs(self.copy_dir, exist_ok=True)
+            shutil.copyfile(path, copy)
+        except OSError as e:
+            logger.warning(f"Could not copy cookies file {path}: {e}")
+            copy = None
+        with self.lock:
+            if jar['copy']:
+                self.copies.pop(jar['copy'], None)
+            jar['copy'] = copy
+            if copy:
+                self.copies[copy] = path
+        for name in os.listdir(self.copy_dir) if os.path.isdir(self.copy_dir) else []:
+            old = os.path.join(self.copy_dir, name)
+            if name.startswith(prefix) and old != copy:
+                try: os.remove(old)
+                except OSError: pass
+
+    def _jar(self, path):
+        # Принимает и исходный путь, и рабочую копию
+        return self.jars.get(path) or self.jars.get(self.copies.get(path))
+
+    def working_copy(self, path):
+        """Файл, который передается в YoutubeDL как cookiefile (копия текущей версии)."""
+        jar = self._jar(path)
+        return (jar and jar['copy']) or path
+
+    def acquire(self):
+        """Возвращает путь к наименее использованному рабочему файлу cookies или None."""
+        self.refresh()
+        now = time.time()
+        with self.lock:
+            ready = [(jar['uses'], path) for path, jar in self.jars.items()
+                     if jar['valid'] and jar['cooldown_until'] <= now]
+            if not ready:
+                return None
+            _, path = min(ready)
+            self.jars[path]['uses'] += 1
+            return path
+
+    def version(self, path):
+        """Версия файла (mtime при последней загрузке) — меняется, только когда обновили исходный файл."""
+        jar = self._jar(path)
+        return jar['mtime'] if jar else None
+
+    def report_failure(self, path, error_class):
+        """Бот-проверка на аккаунте — отправляем его отдыхать, запросы уйдут на остальные."""
+        jar = self._jar(path)
+        if not jar or error_class != 'bot':
+            return
+        with self.lock:
+            jar['failures'] += 1
+            jar['cooldown_until'] = time.time() + self.cooldown
+        logger.warning(f"Cookies {os.path.basename(self.copies.get(path, path))} hit bot check, cooling down for {self.cooldown}s")
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return [{'file': os.path.basename(path), 'cookies': jar['count'], 'valid': jar['valid'],
+                     'uses': jar['uses'], 'failures': jar['failures'],
+                     'cooldown': max(0, int(jar['cooldown_until'] - now))}
+                    for path, jar in self.jars.items()]
+
+
+cookie_manager = CookieManager()
@@ -129,8 +129,6 @@ def start_download():
         ratelimit = 500 * 1024
         limit_height = 720
         sleep_interval = 2
-        
-    task_manager.cleanup()
 
     task_id = task_manager.create_task()
 
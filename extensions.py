@@ -1,11 +1,10 @@
 import os
 import time
+import json
 import threading
 import uuid
 import logging
 import sqlite3
-import shutil
-import stat
 try:
     import psycopg2
     import psycopg2.extras
@@ -17,6 +16,12 @@ from flask import request
 from flask_socketio import SocketIO
 from dotenv import load_dotenv
 from flask_wtf.csrf import CSRFProtect
+from task_backends import MemoryTaskBackend, make_task_backend
+from url_keys import canonical_key
+from info_cache import InfoCache, INFO_CACHE_DB
+from task_events import TaskEventPublisher
+from storage import StorageManager
+from reaper import ExpiryReaper
 
 load_dotenv()
 
@@ -26,12 +31,20 @@ logger = logging.getLogger(__name__)
 
 # Environment Variables
 ADMIN_EMAIL = os.getenv('ADMIN_EMAIL', "").strip()
+# Где хранить состояние задач: memory, sqlite или redis. sqlite/redis переживают перезапуск процесса
+# и видны внешним читателям (мониторинг, админка), но не делают сервис многопроцессным: очередь,
+# inflight, индекс медиакэша, плейлисты и комнаты Socket.IO живут в процессе — воркер gunicorn один (Procfile).
+TASK_BACKEND = os.getenv('TASK_BACKEND', 'memory')
+TASK_BACKEND_URL = os.getenv('TASK_BACKEND_URL')
 
 # Folders
 DOWNLOAD_FOLDER = 'downloads'
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
 
+# Кэш готовых файлов живет внутри downloads/, но по времени не чистится (у него свой бюджет)
+MEDIA_CACHE_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'cache')
+
 AVATAR_FOLDER = 'avatars'
 if not os.path.exists(AVATAR_FOLDER):
     os.makedirs(AVATAR_FOLDER)
@@ -43,6 +56,8 @@ if not os.path.exists(STATIC_FOLDER):
 
 # SocketIO
 socketio = SocketIO(cors_allowed_origins="*")
+# Прогресс задач отправляется клиентам через Socket.IO (опрос /progress остается запасным вариантом)
+task_events = TaskEventPublisher(socketio)
 csrf = CSRFProtect()
 
 # OAuth
@@ -120,11 +135,16 @@ def init_db():
 
     c.execute(f'''CREATE TABLE IF NOT EXISTS history 
                  (id {pk_type}, user_id INTEGER, title TEXT, url TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    add_column_safe(c, 'history', 'video_key TEXT')
     c.execute(f'''CREATE TABLE IF NOT EXISTS notifications 
                  (id {pk_type}, message TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     c.execute('''CREATE TABLE IF NOT EXISTS hidden_notifications 
                  (user_id INTEGER, notification_id INTEGER)''')
     add_column_safe(c, 'notifications', 'user_id INTEGER')
+    # Постоянная очередь задач скачивания (переживает перезапуск/деплой)
+    c.execute('''CREATE TABLE IF NOT EXISTS download_jobs 
+                 (task_id TEXT PRIMARY KEY, kind TEXT, params TEXT, lane TEXT, status TEXT, state TEXT,
+                  owner TEXT, heartbeat REAL, created_at REAL, updated_at REAL)''')
     conn.commit()
     conn.close()
 
@@ -152,76 +172,247 @@ def check_limit(limit_type='global'):
     ip = request.remote_addr
     return not limiter.is_allowed(ip, limit_type)
 
-# Функция для принудительного удаления (если файл занят или read-only)
-def remove_readonly(func, path, _):
-    os.chmod(path, stat.S_IWRITE)
-    func(path)
+# Job Store
+JOB_HEARTBEAT_INTERVAL = int(os.getenv('JOB_HEARTBEAT_INTERVAL', 10))
+JOB_ORPHAN_TIMEOUT = int(os.getenv('JOB_ORPHAN_TIMEOUT', 60))
+ACTIVE_JOB_STATUSES = ('starting', 'queued', 'downloading', 'processing')
+
+class JobStore:
+    """Хранит задачи скачивания в БД, чтобы после перезапуска их можно было подобрать и доделать.
+
+    Переходы статусов пишутся фоновым потоком (write-behind), поэтому частые
+    обновления прогресса не добавляют задержки и вообще не попадают в БД.
+    """
+    def __init__(self, db=None):
+        # Фабрика соединений (контекстный менеджер); по умолчанию — основная БД приложения
+        self.db = db or get_db
+        self.instance_id = str(uuid.uuid4())
+        self.pending = {}
+        self.cond = threading.Condition()
+        self._writer = None
+
+    def _ensure_writer(self):
+        with self.cond:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+                self._writer.start()
+
+    def create(self, tid, kind, args, lane, state):
+        """Синхронно сохраняет новую задачу: после ответа клиенту она уже не потеряется."""
+        now = time.time()
+        with self.db() as conn:
+            conn.execute('INSERT INTO download_jobs (task_id, kind, params, lane, status, state, owner, heartbeat, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (tid, kind, json.dumps(list(args)), lane, state.get('status'), json.dumps(state, default=str), self.instance_id, now, now, now))
+            conn.commit()
+        self._ensure_writer()
+
+    def record(self, tid, state):
+        """Ставит снимок задачи в очередь на запись (последний снимок побеждает)."""
+        with self.cond:
+            self.pending[tid] = state
+            self.cond.notify()
+        self._ensure_writer()
+
+    def get(self, tid):
+        with self.cond:
+            if tid in self.pending:
+                return dict(self.pending[tid])
+        try:
+            with self.db() as conn:
+                row = conn.execute('SELECT state FROM download_jobs WHERE task_id = ?', (tid,)).fetchone()
+        except Exception:
+            return None
+        return json.loads(row['state']) if row else None
+
+    def claim_orphans(self, timeout=JOB_ORPHAN_TIMEOUT):
+        """Забирает незавершенные задачи, владелец которых перестал подавать признаки жизни."""
+        now = time.time()
+        claimed = []
+        placeholders = ', '.join('?' * len(ACTIVE_JOB_STATUSES))
+        with self.db() as conn:
+            rows = conn.execute(f'SELECT * FROM download_jobs WHERE status IN ({placeholders}) AND heartbeat < ?',
+                                (*ACTIVE_JOB_STATUSES, now - timeout)).fetchall()
+            for row in rows:
+                # Compare-and-set: если задачу уже забрал другой процесс, rowcount будет 0
+                cur = conn.execute('UPDATE download_jobs SET owner = ?, heartbeat = ? WHERE task_id = ? AND owner = ? AND heartbeat = ?',
+                                   (self.instance_id, now, row['task_id'], row['owner'], row['heartbeat']))
+                if cur.rowcount == 1:
+                    claimed.append({
+                        'task_id': row['task_id'],
+                        'kind': row['kind'],
+                        'args': json.loads(row['params'] or '[]'),
+                        'lane': row['lane'],
+                        'state': json.loads(row['state'] or '{}'),
+                    })
+            conn.commit()
+        if claimed:
+            self._ensure_writer()
+        return claimed
+
+    def active_ids(self):
+        """id незавершенных задач (свои и брошенные упавшим процессом) — их рабочие папки нельзя удалять."""
+        placeholders = ', '.join('?' * len(ACTIVE_JOB_STATUSES))
+        try:
+            with self.db() as conn:
+                rows = conn.execute(f'SELECT task_id FROM download_jobs WHERE status IN ({placeholders})',
+                                    ACTIVE_JOB_STATUSES).fetchall()
+        except Exception as e:
+            logger.error(f"Job store read error: {e}")
+            return set()
+        return {row['task_id'] for row in rows}
+
+    def purge(self, older_than):
+        placeholders = ', '.join('?' * len(ACTIVE_JOB_STATUSES))
+        with self.db() as conn:
+            conn.execute(f'DELETE FROM download_jobs WHERE updated_at < ? AND status NOT IN ({placeholders})',
+                         (older_than, *ACTIVE_JOB_STATUSES))
+            conn.commit()
+
+    def _writer_loop(self):
+        last_beat = 0
+        while True:
+            with self.cond:
+                if not self.pending:
+                    self.cond.wait(JOB_HEARTBEAT_INTERVAL)
+                batch, self.pending = self.pending, {}
+            now = time.time()
+            try:
+                with self.db() as conn:
+                    if batch:
+                        # Пишем только свои задачи: если задачу забрал другой процесс, наши записи игнорируются
+                        conn.executemany('UPDATE download_jobs SET status = ?, state = ?, updated_at = ?, heartbeat = ? WHERE task_id = ? AND owner = ?',
+                                         [(state.get('status'), json.dumps(state, default=str), now, now, tid, self.instance_id) for tid, state in batch.items()])
+                    if now - last_beat >= JOB_HEARTBEAT_INTERVAL:
+                        placeholders = ', '.join('?' * len(ACTIVE_JOB_STATUSES))
+                        conn.execute(f'UPDATE download_jobs SET heartbeat = ? WHERE owner = ? AND status IN ({placeholders})',
+                                     (now, self.instance_id, *ACTIVE_JOB_STATUSES))
+                        last_beat = now
+                    conn.commit()
+            except Exception as e:
+                logger.error(f"Job store write error: {e}")
+                # Возвращаем непросохшие снимки обратно, не затирая более свежие
+                with self.cond:
+                    for tid, state in batch.items():
+                        self.pending.setdefault(tid, state)
+                time.sleep(1)
+
+job_store = JobStore()
 
 # Task Manager
+# Сколько живет задача после создания
+TASK_TTL = 3600
+# Полный проход по хранилищам — только страховка для того, чего нет в куче сроков
+# (задачи других процессов, записи кэша на диске от прошлого запуска, старые строки очереди)
+CLEANUP_SWEEP_INTERVAL = int(os.getenv('CLEANUP_SWEEP_INTERVAL', 3600))
+
 class TaskManager:
-    def __init__(self):
-        self.tasks = {}
-        self.info_cache = {}
-        self.lock = threading.Lock()
+    def __init__(self, jobs=None, backend=None, info_cache=None, events=None, storage=None, reaper=None):
+        # Бэкенд хранит состояние задач: в памяти процесса или в общем хранилище для нескольких воркеров
+        self.backend = backend or MemoryTaskBackend()
+        # Кэш информации о видео (по умолчанию только в памяти, без диска)
+        self.info_cache = info_cache or InfoCache()
+        self.jobs = jobs
+        # Публикация изменений задач подписанным клиентам (None — только опрос)
+        self.events = events
+        # Учет файлов в downloads/ (None — файлы задач не удаляются)
+        self.storage = storage
+        # Фоновое удаление задач по сроку (None — только полным проходом cleanup)
+        self.reaper = reaper
         threading.Thread(target=self._cleanup_loop, daemon=True).start()
 
+    @property
+    def tasks(self):
+        # Прямой доступ к словарю задач есть только у бэкенда в памяти
+        return self.backend.tasks
+
     def create_task(self):
-        with self.lock:
-            tid = str(uuid.uuid4())
-            self.tasks[tid] = {'status': 'starting', 'progress': '0', 'start_time': time.time()}
-            return tid
+        tid = str(uuid.uuid4())
+        now = time.time()
+        self.backend.create(tid, {'status': 'starting', 'progress': 0, 'start_time': now})
+        self._schedule_expiry(tid, now)
+        return tid
+
+    def _schedule_expiry(self, tid, start_time):
+        if self.reaper:
+            self.reaper.schedule('task', tid, start_time + TASK_TTL, self._reap_task)
+
+    def _reap_task(self, tid):
+        # Задачу могли восстановить из очереди с новым start_time — тогда она еще жива
+        return 0 if self.backend.discard(tid, time.time() - TASK_TTL) else None
 
     def get_task(self, tid):
-        with self.lock:
-            return self.tasks.get(tid)
+        task = self.backend.get(tid)
+        # Задачи нет в хранилище (например, после перезапуска) — читаем последнее сохраненное состояние
+        if task is None and self.jobs:
+            task = self.jobs.get(tid)
+        # Задача присоединена к такой же загрузке (single-flight) — показываем прогресс и файл лидера
+        if task and task.get('leader_id'):
+            leader = self.get_task(task['leader_id'])
+            if leader:
+                return dict(leader, leader_id=task['leader_id'])
+        return task
 
     def update_task(self, tid, **kwargs):
-        with self.lock:
-            if tid in self.tasks:
-                self.tasks[tid].update(kwargs)
+        # В БД сохраняем только смену статуса/результата и присоединившихся, прогресс остается в бэкенде
+        persist = self.jobs and ('status' in kwargs or 'filename' in kwargs or 'followers' in kwargs)
+        snapshot = self.backend.update(tid, kwargs, snapshot=persist)
+        if snapshot is None:
+            # Задачи нет (истекла или не создавалась) — сообщать подписчикам не о чем
+            return
+        if persist:
+            self.jobs.record(tid, snapshot)
+        if self.events:
+            self.events.publish(tid, kwargs)
+
+    def restore_task(self, tid, state):
+        """Возвращает в хранилище задачу, подобранную из постоянной очереди."""
+        now = time.time()
+        self.backend.create(tid, dict(state, start_time=now))
+        self._schedule_expiry(tid, now)
+        # Присоединенные задачи своей записи в БД не имеют — поднимаем их из состояния лидера
+        for fid, _ in state.get('followers') or []:
+            self.backend.create(fid, {'status': state.get('status'), 'leader_id': tid, 'start_time': now})
+            self._schedule_expiry(fid, now)
 
     def get_cached_info(self, url):
-        with self.lock:
-            cache = self.info_cache.get(url)
-            if cache:
-                # Кэш валиден 1 час
-                if time.time() - cache['timestamp'] < 3600:
-                    return cache['data']
-                else:
-                    del self.info_cache[url]
-            return None
+        # Разные формы одной ссылки (youtu.be, shorts, &t=, &si=) попадают в одну запись
+        return self.info_cache.get(canonical_key(url))
 
     def cache_info(self, url, data):
-        with self.lock:
-            self.info_cache[url] = {'data': data, 'timestamp': time.time()}
+        # Кэш валиден 1 час (INFO_CACHE_TTL)
+        self.info_cache.set(canonical_key(url), data)
 
     def cleanup(self):
-        with self.lock:
-            current_time = time.time()
-            old_tasks = [tid for tid, task in self.tasks.items() if current_time - task['start_time'] > 3600]
-            for tid in old_tasks:
-                del self.tasks[tid]
-            
-            # Очистка старого кэша
-            old_cache = [url for url, cache in self.info_cache.items() if current_time - cache['timestamp'] > 3600]
-            for url in old_cache:
-                del self.info_cache[url]
+        """Полный проход по всем хранилищам. Обычное истечение делает reaper, в запросах это не вызывается."""
+        current_time = time.time()
+        try: self.backend.expire(current_time - TASK_TTL)
+        except Exception as e: logger.error(f"Task expiry error: {e}")
+
+        # Очистка старого кэша
+        self.info_cache.expire()
+
+        if self.jobs:
+            try: self.jobs.purge(current_time - TASK_TTL)
+            except Exception: pass
         
-        # Очистка файлов
-        try:
-            for filename in os.listdir(DOWNLOAD_FOLDER):
-                filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-                if os.path.getmtime(filepath) < current_time - 3600:
-                    try:
-                        if os.path.isfile(filepath): os.remove(filepath)
-                        elif os.path.isdir(filepath): shutil.rmtree(filepath, onerror=remove_readonly)
-                    except Exception: pass
-        except Exception: pass
+        # Очистка файлов: по индексу учета места, без обхода каталога
+        if self.storage:
+            try: self.storage.expire(current_time)
+            except Exception as e: logger.error(f"Storage expiry error: {e}")
 
     def _cleanup_loop(self):
         while True:
             self.cleanup()
-            time.sleep(600)
+            time.sleep(CLEANUP_SWEEP_INTERVAL if self.reaper else 600)
+
+init_db()
+
+# Сроки задач, записей кэша информации и файлов — в одной куче с фоновым потоком
+reaper = ExpiryReaper()
+
+# Место под загрузки в downloads/ (кэш готовых файлов учитывается своим бюджетом).
+# Рабочие папки незавершенных задач закреплены до их продолжения после перезапуска
+storage = StorageManager(DOWNLOAD_FOLDER, skip=(MEDIA_CACHE_FOLDER,), reaper=reaper, pinned=job_store.active_ids())
 
-task_manager = TaskManager()
-init_db()
\ No newline at end of file
+task_manager = TaskManager(jobs=job_store, backend=make_task_backend(TASK_BACKEND, TASK_BACKEND_URL), info_cache=InfoCache(INFO_CACHE_DB, reaper=reaper),
+                           events=task_events, storage=storage, reaper=reaper)
\ No newline at end of file
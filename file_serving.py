@@ -0,0 +1,156 @@
+import os
+import mimetypes
+import unicodedata
+import logging
+from urllib.parse import quote
+from flask import request, Response
+from werkzeug.http import parse_range_header, http_date, parse_date
+from extensions import DOWNLOAD_FOLDER
+
+logger = logging.getLogger(__name__)
+
+# Кто отдает файлы: '' — сам Python, 'nginx' — X-Accel-Redirect, 'apache' — X-Sendfile
+FILE_OFFLOAD = os.getenv('FILE_OFFLOAD', '').lower()
+# internal-location nginx, указывающий на папку downloads/:
+#   location /protected-downloads/ {
+#       internal;
+#       alias /app/downloads/;
+#   }
+FILE_OFFLOAD_PREFIX = os.getenv('FILE_OFFLOAD_PREFIX', '/protected-downloads/')
+FILE_CHUNK_SIZE = 256 * 1024
+
+
+def content_disposition(download_name):
+    """Content-Disposition: ASCII-имя для старых браузеров и полное имя в filename* (RFC 5987)."""
+    stem, ext = os.path.splitext(download_name)
+    ascii_name = (unicodedata.normalize('NFKD', stem).encode('ascii', 'ignore').decode('ascii').replace('"', '').strip() or 'video') + ext
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}"
+
+
+class TrackedFile:
+    """Файл, который при закрытии вызывает on_close (например, снимает ссылку на запись кэша).
+
+    Наружу отдается fileno(), поэтому gunicorn может передать его через os.sendfile.
+    read() не выдает больше limit байт: не все file_wrapper ограничивают передачу
+    Content-Length (werkzeug читает до конца файла), а ответ 206 не должен выходить за диапазон.
+    """
+    def __init__(self, f, on_close=None, limit=None):
+        self.f = f
+        self.on_close = on_close
+        self.remaining = limit
+
+    def read(self, size=-1):
+        if self.remaining is None:
+            return self.f.read(size)
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        chunk = self.f.read(size) if size else b''
+        self.remaining -= len(chunk)
+        return chunk
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+    def tell(self):
+        return self.f.tell()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+        on_close, self.on_close = self.on_close, None
+        if on_close:
+            on_close()
+
+
+class FileRange:
+    """Итератор по диапазону файла — когда сервер не дает wsgi.file_wrapper (dev-сервер, eventlet.wsgi)."""
+    def __init__(self, f, length, chunk_size=FILE_CHUNK_SIZE):
+        self.f = f
+        self.remaining = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        while self.remaining > 0:
+            chunk = self.f.read(min(self.chunk_size, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.f.close()
+
+
+def _range_applies(if_range, etag, mtime):
+    """If-Range: диапазон действует, только если файл не менялся с момента первой части."""
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    date = parse_date(if_range)
+    return date is not None and int(date.timestamp()) >= int(mtime)
+
+
+def _empty_response(status, headers, mimetype=None, on_close=None):
+    response = Response(b'', status=status, mimetype=mimetype, headers=headers)
+    if on_close:
+        response.call_on_close(on_close)
+    return response
+
+
+def serve_file(path, download_name, mimetype=None, on_close=None):
+    """Отдает файл с поддержкой Range/If-Range без копирования через Python, где это возможно.
+
+    - FILE_OFFLOAD=nginx/apache: ответ без тела с X-Accel-Redirect/X-Sendfile, файл отдает веб-сервер;
+    - иначе файл передается через wsgi.file_wrapper (gunicorn использует os.sendfile),
+      а при его отсутствии — чанками по FILE_CHUNK_SIZE.
+    on_close вызывается, когда передача закончена или прервана.
+    """
+    st = os.stat(path)
+    size = st.st_size
+    etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+    headers = {
+        'Content-Disposition': content_disposition(download_name),
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': 'private, max-age=0',
+    }
+    mimetype = mimetype or mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+
+    if FILE_OFFLOAD in ('nginx', 'apache'):
+        if FILE_OFFLOAD == 'nginx':
+            rel = os.path.relpath(path, DOWNLOAD_FOLDER).replace(os.sep, '/')
+            headers['X-Accel-Redirect'] = FILE_OFFLOAD_PREFIX + quote(rel)
+        else:
+            headers['X-Sendfile'] = os.path.abspath(path)
+        # Range, If-Range и сама передача — на стороне веб-сервера. Он открывает файл сразу
+        # после получения заголовков, поэтому вытеснение из кэша после on_close передачу не оборвет
+        return _empty_response(200, headers, mimetype, on_close)
+
+    if request.headers.get('If-None-Match') == etag:
+        return _empty_response(304, headers, on_close=on_close)
+
+    start, length, status = 0, size, 200
+    range_header = request.headers.get('Range')
+    if range_header and _range_applies(request.headers.get('If-Range'), etag, st.st_mtime):
+        rng = parse_range_header(range_header)
+        # Несколько диапазонов (multipart/byteranges) не поддерживаем — по RFC можно ответить целым файлом
+        if rng is not None and len(rng.ranges) == 1:
+            bounds = rng.range_for_length(size)
+            if bounds is None:
+                headers['Content-Range'] = f'bytes */{size}'
+                return _empty_response(416, headers, on_close=on_close)
+            start, stop = bounds
+            length, status = stop - start, 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+
+    f = TrackedFile(open(path, 'rb'), on_close, limit=length)
+    f.seek(start)
+    headers['Content-Length'] = str(length)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    # file_wrapper сервера отдает файл с текущей позиции: sendfile gunicorn — ровно Content-Length байт,
+    # остальные читают через read(), который ограничен длиной ответа
+    body = file_wrapper(f, FILE_CHUNK_SIZE) if file_wrapper else FileRange(f, length)
+    return Response(body, status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
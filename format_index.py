@@ -0,0 +1,123 @@
+# Ступени качества видео (высота кадра) и аудио (кбит/с)
+QUALITY_LADDER = (144, 240, 360, 480, 720, 1080, 1440, 2160, 4320)
+AUDIO_LADDER = (48, 64, 96, 128, 160, 192, 256, 320)
+# Формат считается ступенью height, если его высота отличается меньше чем на столько (1088p, 1072p и т.п.)
+HEIGHT_TOLERANCE = 20
+# Контейнеры, которые склеиваются в MP4 без перекодирования
+MP4_EXTS = ('mp4', 'm4a')
+
+
+def _int(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def estimate_size(f, duration):
+    """Размер формата в байтах: из метаданных, иначе по битрейту и длительности; 0 — неизвестно."""
+    size = f.get('filesize') or f.get('filesize_approx')
+    if size:
+        return size
+    if duration:
+        tbr = f.get('tbr')
+        if tbr:
+            return int(tbr * 1000 / 8 * duration)
+        # Если нет общего битрейта, пробуем сложить видео + аудио
+        vbr = f.get('vbr')
+        if vbr:
+            return int((vbr + (f.get('abr') or 0)) * 1000 / 8 * duration)
+    return 0
+
+
+class FormatIndex:
+    """Таблица форматов ролика, построенная за один проход по info['formats'].
+
+    Для каждой высоты запоминается наибольший размер готового файла (видео+аудио)
+    и видео без звука — отдельно для MP4-совместимых контейнеров и для любых, —
+    а для ступеней аудио — наибольший размер дорожки. Запрос размера для ступени
+    качества смотрит только на эти таблицы (несколько различных высот), а не на весь
+    список форматов, поэтому вся лестница качеств (144p–4320p и аудио) считается
+    за O(n) от числа форматов.
+    """
+    def __init__(self, formats, duration=None):
+        try: duration = float(duration) if duration else 0
+        except (TypeError, ValueError): duration = 0
+        self.formats = formats
+        self.max_height = 0
+        self.audio_size = 0
+        # Наибольший размер по высоте: готовые файлы видео+аудио и видео без звука,
+        # отдельно для MP4-совместимых контейнеров и для любых
+        self.muxed = {True: {}, False: {}}
+        self.video = {True: {}, False: {}}
+        self.audio = {}       # ступень аудио (кбит/с) -> наибольший размер
+
+        # Один проход; повторяющиеся битрейты аудио разбираются один раз
+        rungs = {}
+        muxed_any, muxed_mp4 = self.muxed[False], self.muxed[True]
+        video_any, video_mp4 = self.video[False], self.video[True]
+        audio = self.audio
+        for f in formats or ():
+            size = f.get('filesize') or f.get('filesize_approx') or (estimate_size(f, duration) if duration else 0)
+            height = f.get('height') or 0
+            if height.__class__ is not int:
+                height = _int(height)
+            vcodec, acodec, ext = f.get('vcodec'), f.get('acodec'), f.get('ext')
+            if height > self.max_height:
+                self.max_height = height
+
+            if vcodec != 'none' and acodec != 'none':
+                if size > muxed_any.get(height, -1): muxed_any[height] = size
+                if ext in MP4_EXTS and size > muxed_mp4.get(height, -1): muxed_mp4[height] = size
+            elif vcodec != 'none':
+                if size > video_any.get(height, -1): video_any[height] = size
+                if ext == 'mp4' and size > video_mp4.get(height, -1): video_mp4[height] = size
+            elif acodec != 'none':
+                if size > self.audio_size:
+                    self.audio_size = size
+                abr = f.get('abr') or f.get('tbr')
+                if abr:
+                    rung = rungs.get(abr)
+                    if rung is None:
+                        rung = rungs[abr] = min(AUDIO_LADDER, key=lambda r: abs(r - abr))
+                    if size > audio.get(rung, -1): audio[rung] = size
+            # Раскадровки (storyboard) и прочие форматы без дорожек пропускаются
+
+    @classmethod
+    def for_info(cls, info):
+        """Индекс строится один раз на словарь info и хранится в нем же."""
+        index = info.get('_format_index')
+        if index is None or index.formats is not info.get('formats'):
+            index = cls(info.get('formats'), info.get('duration'))
+            info['_format_index'] = index
+        return index
+
+    @staticmethod
+    def _near(table, height):
+        return max((size for h, size in table.items() if abs(h - height) < HEIGHT_TOLERANCE), default=0)
+
+    def total_size(self, height, prefer_mp4=True):
+        """Размер скачивания для высоты: готовый файл, а если его нет — видео + лучшее аудио."""
+        muxed = self._near(self.muxed[prefer_mp4], height)
+        if muxed > 0:
+            return muxed
+        video = self._near(self.video[prefer_mp4], height)
+        return video + self.audio_size if video > 0 else 0
+
+    def ladder(self):
+        """Все доступные ступени качества: {'144': байты, ..., '2160': байты, 'audio_128': байты}.
+
+        Если у ступени нет MP4-совместимых форматов (например, 4K только в VP9/WebM),
+        размер считается по любым контейнерам.
+        """
+        result = {}
+        for height in QUALITY_LADDER:
+            if height - HEIGHT_TOLERANCE >= self.max_height:
+                break
+            size = self.total_size(height) or self.total_size(height, prefer_mp4=False)
+            if size:
+                result[str(height)] = size
+        for rung in sorted(self.audio):
+            if self.audio[rung]:
+                result[f'audio_{rung}'] = self.audio[rung]
+        return result
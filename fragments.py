@@ -0,0 +1,332 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Общий предел одновременных исходящих соединений загрузок на процесс (задачи, элементы плейлистов, потоки)
+FRAGMENT_CONNECTIONS_TOTAL = int(os.getenv('FRAGMENT_CONNECTIONS_TOTAL', 16))
+# Границы параллельности фрагментов одной загрузки по тарифам (бесплатным много соединений не нужно)
+FRAGMENT_CONCURRENCY_MIN = int(os.getenv('FRAGMENT_CONCURRENCY_MIN', 1))
+FRAGMENT_CONCURRENCY_MAX = {
+    'premium': int(os.getenv('FRAGMENT_CONCURRENCY_MAX', 8)),
+    'free': int(os.getenv('FRAGMENT_CONCURRENCY_FREE_MAX', 2)),
+}
+# С какой параллельности начинать, пока для источника ничего не известно
+FRAGMENT_CONCURRENCY_START = int(os.getenv('FRAGMENT_CONCURRENCY_START', 3))
+# Окно измерения скорости и ошибок: решение «больше/меньше соединений» принимается раз в окно
+FRAGMENT_WINDOW = float(os.getenv('FRAGMENT_WINDOW', 2.0))
+# Рост считается улучшением, только если скорость выросла больше чем на 10%
+FRAGMENT_GAIN = 1.1
+# Буфер чтения — примерно четверть секунды скорости одного соединения, в этих пределах
+FRAGMENT_BUFFER_DEFAULT = 1024 * 1024
+FRAGMENT_BUFFER_MIN = 64 * 1024
+FRAGMENT_BUFFER_MAX = 4 * 1024 * 1024
+FRAGMENT_BUFFER_SECONDS = 0.25
+# Сколько источников (сайт + прокси) помнить
+FRAGMENT_SOURCES = 256
+
+# Признаки ошибок фрагментов в сообщениях yt-dlp: повторы, отказ и ограничение частоты запросов
+ERROR_MARKERS = ('got error', 'retrying fragment', 'skipping fragment', 'http error 403', 'http error 429')
+
+
+# Протоколы, которые yt-dlp качает одним HTTP-соединением (в том числе DASH-дорожки YouTube)
+SINGLE_CONNECTION_PROTOCOLS = ('http', 'https')
+
+
+class ConnectionsBusyError(Exception):
+    """В общем бюджете нет свободных соединений, а ждать нельзя (потоковая отдача)."""
+
+
+def is_fragmented(info):
+    """Качается ли хоть одна из выбранных дорожек фрагментами (HLS, DASH-сегменты и т.п.)."""
+    formats = info.get('requested_formats') or [info]
+    return any((f.get('protocol') or 'https') not in SINGLE_CONNECTION_PROTOCOLS for f in formats)
+
+
+def source_key(url, proxy=None):
+    """Источник, для которого запоминается подходящая параллельность: сайт и прокси (у них разные пределы)."""
+    host = (urlparse(url).hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return f"{host}|{proxy or 'direct'}"
+
+
+class ConnectionBudget:
+    """Общий на процесс бюджет исходящих соединений загрузок (фрагменты, обычные загрузки, потоки).
+
+    Загрузка получает хотя бы одно соединение (ждет, пока оно освободится), а дополнительные —
+    сколько осталось в бюджете. Планировщик подписывается на освобождение и не берет новые
+    задачи, пока бюджет исчерпан: задачи ждут в очереди с сохранением приоритетов, а не в воркере.
+    """
+    def __init__(self, total=FRAGMENT_CONNECTIONS_TOTAL):
+        self.total = max(1, total)
+        self.held = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+        self.listeners = []
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def available(self):
+        with self.cond:
+            return self.total - self.held
+
+    def acquire(self, desired):
+        """Берет от 1 до desired соединений, при пустом бюджете ждет первого. Возвращает, сколько выдано."""
+        with self.cond:
+            self.waiting += 1
+            try:
+                while self.held >= self.total:
+                    self.cond.wait()
+            finally:
+                self.waiting -= 1
+            granted = max(1, min(desired, self.total - self.held))
+            self.held += granted
+            return granted
+
+    def try_acquire(self, count):
+        """Берет ровно count соединений без ожидания; False — столько свободных нет."""
+        with self.cond:
+            if self.total - self.held < count:
+                return False
+            self.held += count
+            return True
+
+    def resize(self, held, desired):
+        """Меняет число удерживаемых соединений: уменьшение — всегда, увеличение — сколько есть свободных."""
+        if desired > held:
+            with self.cond:
+                extra = max(0, min(desired - held, self.total - self.held))
+                self.held += extra
+            return held + extra
+        if desired < held:
+            self.release(held - desired)
+        return min(held, desired)
+
+    def release(self, count):
+        if count <= 0:
+            return
+        with self.cond:
+            self.held = max(0, self.held - count)
+            self.cond.notify_all()
+        for callback in self.listeners:
+            callback()
+
+    def stats(self):
+        with self.cond:
+            return {'total': self.total, 'held': self.held, 'waiting': self.waiting}
+
+
+class FragmentLogger:
+    """Логгер для YoutubeDL: считает ошибки фрагментов для контроллера и пишет сообщения в logging."""
+    def __init__(self, controller):
+        self.controller = controller
+
+    def _check(self, message):
+        text = str(message).lower()
+        if any(marker in text for marker in ERROR_MARKERS):
+            self.controller.report_error()
+
+    def debug(self, message):
+        # Повторы фрагментов yt-dlp сообщает через to_screen, а он при заданном логгере пишет в debug
+        self._check(message)
+        logger.debug(message)
+
+    def info(self, message):
+        logger.info(message)
+
+    def warning(self, message):
+        self._check(message)
+        logger.warning(message)
+
+    def error(self, message):
+        self._check(message)
+        logger.error(message)
+
+
+class FragmentController:
+    """Параллельность фрагментов одной загрузки по схеме AIMD.
+
+    Раз в FRAGMENT_WINDOW по хуку прогресса меряются скорость и число завершенных фрагментов,
+    по логгеру — повторы и ошибки 403/429. Ошибки в окне — параллельность уменьшается вдвое;
+    окно без ошибок, в котором скорость заметно выросла, — на одно соединение больше; скорость
+    не растет или загрузку тормозит распределитель полосы — без изменений. yt-dlp создает пул
+    потоков фрагментов в начале каждой дорожки, поэтому новое значение записывается в живые
+    параметры YoutubeDL и действует со следующей дорожки (аудио после видео), а итог
+    запоминается для источника и достается следующим загрузкам с него.
+
+    Из бюджета сначала берется одно соединение: обычная HTTP-загрузка больше не открывает.
+    Когда форматы выбраны (match_filter перед загрузкой), для фрагментных протоколов
+    параллельность поднимается до подобранной.
+    """
+    def __init__(self, tuner, key, tier='premium', flow=None):
+        self.tuner = tuner
+        self.key = key
+        self.minimum = max(1, FRAGMENT_CONCURRENCY_MIN)
+        self.maximum = max(self.minimum, FRAGMENT_CONCURRENCY_MAX.get(tier, FRAGMENT_CONCURRENCY_MAX['free']))
+        learned = tuner.learned(key)
+        self.window = float(min(max(learned['window'] if learned else FRAGMENT_CONCURRENCY_START, self.minimum), self.maximum))
+        self.buffersize = learned['buffersize'] if learned else FRAGMENT_BUFFER_DEFAULT
+        self.flow = flow
+        self.params = None
+        self.held = 0
+        self.concurrency = 0
+        self.track = 0          # с какой параллельностью стартовала текущая дорожка
+        self.fragmented = False # выбранные форматы качаются фрагментами (иначе соединение одно)
+        self.lock = threading.Lock()
+        self.seen = {}
+        self.indexes = {}
+        self.window_started = time.monotonic()
+        self.window_bytes = 0
+        self.window_fragments = 0
+        self.window_errors = 0
+        self.window_slept = flow.slept if flow else 0.0
+        self.previous = None
+        self.logger = FragmentLogger(self)
+
+    def start(self):
+        """Берет соединение из общего бюджета и возвращает параметры для YoutubeDL."""
+        self.held = self.tuner.connections.acquire(1)
+        self.concurrency = self.track = 1
+        self.tuner.opened(self)
+        return {'concurrent_fragment_downloads': self.concurrency, 'buffersize': self.buffersize,
+                'logger': self.logger, 'match_filter': self.match_filter}
+
+    def attach(self, params):
+        """Живые параметры экземпляра YoutubeDL: из них берутся настройки следующей дорожки."""
+        self.params = params
+
+    def match_filter(self, info, incomplete=False):
+        """match_filter YoutubeDL: вызывается с выбранными форматами прямо перед загрузкой; ничего не отсеивает."""
+        if not incomplete and is_fragmented(info):
+            with self.lock:
+                self.fragmented = True
+                # Пул потоков первой дорожки еще не создан — он возьмет новое значение
+                self._apply()
+                self.track = self.concurrency
+        return None
+
+    def report_error(self):
+        with self.lock:
+            self.window_errors += 1
+
+    def hook(self, d):
+        """Хук прогресса yt-dlp: вызывается из потоков фрагментов, поэтому под блокировкой."""
+        if d.get('status') != 'downloading':
+            return
+        key = d.get('tmpfilename') or d.get('filename')
+        with self.lock:
+            current = d.get('downloaded_bytes') or 0
+            previous = self.seen.get(key)
+            self.seen[key] = current
+            if previous is None:
+                # Новая дорожка: пул фрагментов создан с текущим значением параметра
+                self.track = self.concurrency
+            elif current > previous:
+                self.window_bytes += current - previous
+            index = d.get('fragment_index')
+            if index is not None:
+                self.fragmented = True
+                if index > self.indexes.get(key, index):
+                    self.window_fragments += index - self.indexes[key]
+                self.indexes[key] = max(index, self.indexes.get(key, index))
+            now = time.monotonic()
+            if now - self.window_started >= FRAGMENT_WINDOW:
+                self._evaluate(now)
+
+    def _evaluate(self, now):
+        # Вызывается под self.lock
+        elapsed = now - self.window_started
+        throughput = self.window_bytes / elapsed
+        errors, fragments = self.window_errors, self.window_fragments
+        slept = self.flow.slept - self.window_slept if self.flow else 0.0
+        self.window_started = now
+        self.window_bytes = self.window_fragments = self.window_errors = 0
+        self.window_slept = self.flow.slept if self.flow else 0.0
+        if not self.fragmented or (not fragments and not errors):
+            # Обычная загрузка одним файлом или фрагменты еще не завершались — решать не по чему
+            return
+        if errors:
+            self.window = max(self.minimum, self.window / 2)
+            self.tuner.count('decreases', errors=errors)
+        elif slept > elapsed * 0.1:
+            # Скорость ограничивает распределитель полосы, лишние соединения ничего не дадут
+            pass
+        elif self.previous is None or throughput > self.previous * FRAGMENT_GAIN:
+            if self.window < self.maximum:
+                self.window = min(self.maximum, self.window + 1)
+                self.tuner.count('increases')
+        self.previous = throughput
+        if throughput and self.concurrency:
+            per_connection = throughput / max(self.track, 1)
+            self.buffersize = int(min(max(per_connection * FRAGMENT_BUFFER_SECONDS, FRAGMENT_BUFFER_MIN), FRAGMENT_BUFFER_MAX))
+        self._apply()
+
+    def _apply(self):
+        # В бюджете держим максимум из того, чем качает текущая дорожка, и того, что получит следующая
+        target = int(self.window) if self.fragmented else 1
+        self.held = self.tuner.connections.resize(self.held, max(target, self.track))
+        self.concurrency = max(1, min(target, self.held))
+        if self.params is not None:
+            self.params['concurrent_fragment_downloads'] = self.concurrency
+            self.params['buffersize'] = self.buffersize
+
+    def close(self):
+        with self.lock:
+            held, self.held = self.held, 0
+        self.tuner.connections.release(held)
+        self.tuner.closed(self)
+
+
+class FragmentTuner:
+    """Параллельность фрагментов по источникам и общий бюджет соединений процесса."""
+    def __init__(self, connections=None, sources=FRAGMENT_SOURCES):
+        self.connections = connections or ConnectionBudget()
+        self.sources = OrderedDict()
+        self.max_sources = sources
+        self.active = set()
+        self.lock = threading.Lock()
+        self.counters = {'downloads': 0, 'increases': 0, 'decreases': 0, 'errors': 0}
+
+    def controller(self, url, proxy=None, tier='premium', flow=None):
+        return FragmentController(self, source_key(url, proxy), tier, flow)
+
+    def learned(self, key):
+        with self.lock:
+            return dict(self.sources[key]) if key in self.sources else None
+
+    def opened(self, controller):
+        with self.lock:
+            self.active.add(controller)
+            self.counters['downloads'] += 1
+
+    def closed(self, controller):
+        with self.lock:
+            self.active.discard(controller)
+            if not controller.fragmented:
+                # По загрузке одним соединением о параллельности источника ничего не узнали
+                return
+            self.sources[controller.key] = {'window': controller.window, 'buffersize': controller.buffersize}
+            self.sources.move_to_end(controller.key)
+            while len(self.sources) > self.max_sources:
+                self.sources.popitem(last=False)
+
+    def count(self, name, errors=0):
+        with self.lock:
+            self.counters[name] += 1
+            self.counters['errors'] += errors
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, active=len(self.active), sources=len(self.sources),
+                        concurrency=sum(c.concurrency for c in self.active),
+                        connections=self.connections.stats())
+
+
+fragment_connections = ConnectionBudget()
+fragment_tuner = FragmentTuner(fragment_connections)
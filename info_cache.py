@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Ограничения кэша информации о видео (можно переопределить в .env)
+INFO_CACHE_MAX_ENTRIES = int(os.getenv('INFO_CACHE_MAX_ENTRIES', 2000))
+INFO_CACHE_MAX_BYTES = int(os.getenv('INFO_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', 3600))
+INFO_CACHE_DB = os.getenv('INFO_CACHE_DB', os.path.join('data', 'info_cache.db'))
+# Сколько самых свежих записей поднимать с диска в память при старте
+INFO_CACHE_WARMUP = int(os.getenv('INFO_CACHE_WARMUP', 500))
+# Время последнего обращения пишется на диск пачкой не чаще раза в столько секунд
+INFO_CACHE_TOUCH_INTERVAL = float(os.getenv('INFO_CACHE_TOUCH_INTERVAL', 30))
+
+
+class InfoCache:
+    """Двухуровневый кэш информации о видео: LRU в памяти + SQLite на диске.
+
+    Память ограничена и по числу записей, и по примерному объему (длина JSON).
+    Диск переживает перезапуск: после деплоя горячие записи поднимаются в память
+    сразу, остальные — при первом обращении. Горячесть определяется по accessed,
+    который обновляется при каждом попадании (на диск — пачками).
+    """
+    def __init__(self, path=None, max_entries=INFO_CACHE_MAX_ENTRIES, max_bytes=INFO_CACHE_MAX_BYTES, ttl=INFO_CACHE_TTL, warmup=INFO_CACHE_WARMUP, reaper=None,
+                 touch_interval=INFO_CACHE_TOUCH_INTERVAL):
+        self.path = path
+        # Фоновое удаление по сроку (None — истекшие записи убираются при чтении и в expire())
+        self.reaper = reaper
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> (data, expires, size)
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.touch_interval = touch_interval
+        self.touched = {}   # key -> время обращения, еще не записанное на диск
+        self.scheduled = {} # key -> срок, уже поставленный в кучу reaper
+        self.touch_flushed = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        if path:
+            try:
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._conn().execute('CREATE TABLE IF NOT EXISTS info_cache (key TEXT PRIMARY KEY, data TEXT, expires REAL, accessed REAL)')
+                self.warm_up(warmup)
+            except sqlite3.Error as e:
+                logger.warning(f"Info cache disk tier disabled: {e}")
+                self.path = None
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def _put_memory(self, key, data, expires, size):
+        # Вызывается под self.lock
+        old = self.entries.pop(key, None)
+        if old:
+            self.bytes -= old[2]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (data, expires, size)
+        self.bytes += size
+        # Подъем с диска и прогрев дают тот же срок — второй элемент в куче не нужен
+        if self.reaper and self.scheduled.get(key) != expires:
+            self.scheduled[key] = expires
+            self.reaper.schedule('info', key, expires, self._reap)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, _, old_size) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            item = self.entries.get(key)
+            if item:
+                if item[1] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    flush = self._touch(key, now)
+                else:
+                    self.bytes -= item[2]
+                    del self.entries[key]
+                    item = None
+        if item:
+            if flush:
+                self.flush_access()
+            return item[0]
+
+        if self.path:
+            try:
+                row = self._conn().execute('SELECT data, expires FROM info_cache WHERE key = ? AND expires > ?', (key, now)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Info cache read error: {e}")
+                row = None
+            if row:
+                data = json.loads(row[0])
+                with self.lock:
+                    self._put_memory(key, data, row[1], len(row[0]))
+                    self.disk_hits += 1
+                    flush = self._touch(key, now)
+                if flush:
+                    self.flush_access()
+                return data
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, data, ttl=None):
+        expires = time.time() + (ttl or self.ttl)
+        raw = json.dumps(data, ensure_ascii=False, default=str)
+        with self.lock:
+            self._put_memory(key, data, expires, len(raw))
+            self.touched.pop(key, None)
+        if self.path:
+            try:
+                self._conn().execute('INSERT OR REPLACE INTO info_cache (key, data, expires, accessed) VALUES (?, ?, ?, ?)',
+                                     (key, raw, expires, time.time()))
+            except sqlite3.Error as e:
+                logger.warning(f"Info cache write error: {e}")
+
+    def _touch(self, key, now):
+        """Запоминает обращение (под self.lock); True — пора записать накопленное на диск."""
+        if not self.path:
+            return False
+        self.touched[key] = now
+        return now - self.touch_flushed >= self.touch_interval
+
+    def flush_access(self):
+        """Записывает накопленные времена обращений в колонку accessed одним запросом."""
+        with self.lock:
+            batch = [(accessed, key) for key, accessed in self.touched.items()]
+            self.touched.clear()
+            self.touch_flushed = time.time()
+        if not batch or not self.path:
+            return 0
+        try:
+            self._conn().executemany('UPDATE info_cache SET accessed = ? WHERE key = ?', batch)
+        except sqlite3.Error as e:
+            logger.warning(f"Info cache access write error: {e}")
+        return len(batch)
+
+    def warm_up(self, limit):
+        """Поднимает с диска в память самые свежие неистекшие записи."""
+        if not self.path or limit <= 0:
+            return 0
+        rows = self._conn().execute('SELECT key, data, expires FROM info_cache WHERE expires > ? ORDER BY accessed DESC LIMIT ?',
+                                    (time.time(), limit)).fetchall()
+        with self.lock:
+            # Идем от старых к новым, чтобы самые свежие оказались в конце LRU
+            for key, raw, expires in reversed(rows):
+                self._put_memory(key, json.loads(raw), expires, len(raw))
+        return len(rows)
+
+    def _reap(self, key):
+        """Обработчик срока одной записи: возвращает освобожденную память или None, если запись жива."""
+        now = time.time()
+        with self.lock:
+            if self.scheduled.get(key, now + 1) <= now:
+                # Последний поставленный срок наступил — в куче по этому ключу больше ничего нет
+                del self.scheduled[key]
+            item = self.entries.get(key)
+            if not item or item[1] > now:
+                return None
+            del self.entries[key]
+            self.bytes -= item[2]
+        if self.path:
+            try:
+                self._conn().execute('DELETE FROM info_cache WHERE key = ? AND expires <= ?', (key, now))
+            except sqlite3.Error as e:
+                logger.warning(f"Info cache expire error: {e}")
+        return item[2]
+
+    def expire(self):
+        self.flush_access()
+        now = time.time()
+        with self.lock:
+            old = [key for key, item in self.entries.items() if item[1] <= now]
+            for key in old:
+                self.bytes -= self.entries.pop(key)[2]
+        if self.path:
+            try:
+                self._conn().execute('DELETE FROM info_cache WHERE expires <= ?', (now,))
+            except sqlite3.Error as e:
+                logger.warning(f"Info cache expire error: {e}")
+        return len(old)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from extensions import MEDIA_CACHE_FOLDER, TASK_TTL, logger, reaper
+
+# Бюджет диска под кэш готовых файлов (по умолчанию 2 ГБ) и политика вытеснения: lru или lfu
+MEDIA_CACHE_BYTES = int(os.getenv('MEDIA_CACHE_BYTES', 2 * 1024 ** 3))
+MEDIA_CACHE_POLICY = os.getenv('MEDIA_CACHE_POLICY', 'lru').lower()
+
+
+class MediaCache:
+    """Кэш готовых файлов, адресуемый по содержимому: (экстрактор, id ролика, id формата).
+
+    Запрос (нормализованная ссылка + селектор формата) сначала отображается в ключ
+    содержимого через алиасы, поэтому разные селекторы, давшие один и тот же формат,
+    делят один файл. Не вытесняются файлы, которые сейчас отдаются клиентам (refs > 0),
+    и файлы задач, которые еще живут (pins: task_id -> срок): пользователь может прийти
+    за файлом в /get_file в любой момент до истечения задачи.
+    """
+    def __init__(self, folder=MEDIA_CACHE_FOLDER, budget=MEDIA_CACHE_BYTES, policy=MEDIA_CACHE_POLICY,
+                 reaper=None, pin_ttl=TASK_TTL):
+        self.folder = folder
+        self.budget = budget
+        self.policy = policy
+        # Снятие закрепления по сроку задачи (None — закрепления снимаются только при вытеснении)
+        self.reaper = reaper
+        self.pin_ttl = pin_ttl
+        self.entries = OrderedDict()   # content_key -> запись, порядок = давность использования
+        self.aliases = {}              # request_key -> content_key
+        self.used = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def content_key(extractor, video_id, format_id):
+        raw = f'{extractor}|{video_id}|{format_id}'
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def request_key(video_key, format_selector):
+        return f'{video_key}|{format_selector}'
+
+    def _index_path(self):
+        return os.path.join(self.folder, 'index.json')
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, entry in sorted(data.get('entries', {}).items(), key=lambda kv: kv[1].get('last_access', 0)):
+            # Файл могли удалить вручную — такие записи пропускаем
+            if os.path.isfile(entry['path']):
+                entry['refs'] = 0
+                # Задачи, пережившие перезапуск, держат свои файлы до прежнего срока
+                entry['pins'] = {tid: until for tid, until in (entry.get('pins') or {}).items() if until > now}
+                for tid, until in entry['pins'].items():
+                    self._schedule_unpin(key, tid, until)
+                self.entries[key] = entry
+                self.used += entry['size']
+        self.aliases = {rk: ck for rk, ck in data.get('aliases', {}).items() if ck in self.entries}
+
+    def _save_index(self):
+        data = {
+            'entries': {k: {f: v for f, v in e.items() if f != 'refs'} for k, e in self.entries.items()},
+            'aliases': self.aliases,
+        }
+        tmp = self._index_path() + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self._index_path())
+        except OSError as e:
+            logger.warning(f"Media cache index save error: {e}")
+
+    def _schedule_unpin(self, content_key, task_id, until):
+        if self.reaper:
+            self.reaper.schedule('media_pin', (content_key, task_id), until, self._unpin)
+
+    def _pin(self, content_key, entry, task_id):
+        # Вызывается под self.lock
+        if task_id:
+            until = time.time() + self.pin_ttl
+            entry.setdefault('pins', {})[task_id] = until
+            self._schedule_unpin(content_key, task_id, until)
+
+    def _unpin(self, key):
+        """Обработчик срока закрепления: задача истекла, ее файл снова можно вытеснять."""
+        content_key, task_id = key
+        with self.lock:
+            entry = self.entries.get(content_key)
+            pins = entry.get('pins') if entry else None
+            if not pins or task_id not in pins or pins[task_id] > time.time():
+                return None
+            del pins[task_id]
+            self._evict()
+            self._save_index()
+        return 0
+
+    @staticmethod
+    def _pinned(entry, now):
+        return any(until > now for until in (entry.get('pins') or {}).values())
+
+    def lookup(self, request_key, task_id=None):
+        """Возвращает копию записи кэша для запроса или None. task_id закрепляет файл за задачей."""
+        with self.lock:
+            ck = self.aliases.get(request_key)
+            entry = self.entries.get(ck) if ck else None
+            if not entry:
+                return None
+            if not os.path.isfile(entry['path']):
+                self._drop(ck)
+                return None
+            entry['hits'] += 1
+            entry['last_access'] = time.time()
+            self.entries.move_to_end(ck)
+            if task_id:
+                self._pin(ck, entry, task_id)
+                self._save_index()
+            return dict(entry, key=ck)
+
+    def put(self, request_key, content_key, src_path, download_name, title=None, task_id=None):
+        """Переносит готовый файл в кэш и возвращает запись. Если файл не влезает в бюджет — None.
+
+        task_id закрепляет файл за задачей до ее истечения (до вытеснения, которое идет здесь же).
+        """
+        size = os.path.getsize(src_path)
+        if size > self.budget:
+            return None
+        ext = os.path.splitext(src_path)[1]
+        dst = os.path.join(self.folder, content_key + ext)
+        with self.lock:
+            entry = self.entries.get(content_key)
+            if entry and os.path.isfile(entry['path']):
+                # Такой же файл уже есть (другой селектор дал тот же формат) — новый не нужен
+                try: os.remove(src_path)
+                except OSError: pass
+            else:
+                os.replace(src_path, dst)
+                entry = {'path': dst, 'size': size, 'download_name': download_name, 'title': title,
+                         'hits': 0, 'refs': 0, 'pins': {}, 'last_access': time.time()}
+                self.entries[content_key] = entry
+                self.used += size
+            self.entries.move_to_end(content_key)
+            self.aliases[request_key] = content_key
+            self._pin(content_key, entry, task_id)
+            self._evict()
+            self._save_index()
+            return dict(entry, key=content_key)
+
+    def acquire(self, content_key):
+        """Помечает файл как отдаваемый клиенту (защищает от вытеснения)."""
+        with self.lock:
+            entry = self.entries.get(content_key)
+            if not entry:
+                return None
+            entry['refs'] += 1
+            entry['last_access'] = time.time()
+            self.entries.move_to_end(content_key)
+            return entry['path']
+
+    def release(self, content_key):
+        with self.lock:
+            entry = self.entries.get(content_key)
+            if entry and entry['refs'] > 0:
+                entry['refs'] -= 1
+            if self._evict():
+                self._save_index()
+
+    def _drop(self, content_key):
+        entry = self.entries.pop(content_key)
+        self.used -= entry['size']
+        self.aliases = {rk: ck for rk, ck in self.aliases.items() if ck != content_key}
+        try: os.remove(entry['path'])
+        except OSError: pass
+
+    def _evict(self):
+        evicted = 0
+        now = time.time()
+        while self.used > self.budget:
+            candidates = [(k, e) for k, e in self.entries.items() if e['refs'] == 0 and not self._pinned(e, now)]
+            if not candidates:
+                break
+            if self.policy == 'lfu':
+                # Реже всего использованный, при равенстве — давно не использованный
+                victim = min(candidates, key=lambda kv: (kv[1]['hits'], kv[1]['last_access']))[0]
+            else:
+                victim = candidates[0][0]
+            logger.info(f"Media cache evict {victim} ({self.entries[victim]['size']} bytes)")
+            self._drop(victim)
+            evicted += 1
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'used': self.used, 'budget': self.budget}
+
+
+media_cache = MediaCache(reaper=reaper)
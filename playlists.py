@@ -0,0 +1,543 @@
+import os
+import time
+import queue
+import stat
+import shutil
+import zipfile
+import threading
+import logging
+import yt_dlp
+from extensions import task_manager, get_db, storage, reaper, DOWNLOAD_FOLDER
+from scheduler import download_scheduler
+from services import download_service, DownloadService, ProgressReporter, get_friendly_error
+from storage import StorageFullError, STORAGE_WAIT_TIMEOUT
+from url_keys import canonical_key
+
+logger = logging.getLogger(__name__)
+
+# Сколько роликов плейлиста качать одновременно
+PLAYLIST_PARALLEL = int(os.getenv('PLAYLIST_PARALLEL', 3))
+# Сколько скачанных файлов может ждать упаковки в ZIP (дальше загрузки ждут клиента)
+PLAYLIST_BUFFER_FILES = int(os.getenv('PLAYLIST_BUFFER_FILES', 2))
+# Сколько ждать, пока клиент начнет забирать архив, прежде чем отменить задачу
+PLAYLIST_CLIENT_TIMEOUT = int(os.getenv('PLAYLIST_CLIENT_TIMEOUT', 600))
+PLAYLIST_MAX_ENTRIES = int(os.getenv('PLAYLIST_MAX_ENTRIES', 200))
+ZIP_CHUNK_SIZE = 256 * 1024
+# Роликов на странице списка (срез playlist_items для yt-dlp)
+PLAYLIST_PAGE_SIZE = int(os.getenv('PLAYLIST_PAGE_SIZE', 50))
+# Сколько роликов одновременно дополнять полной информацией (длительность, размеры) и сколько держать в очереди
+PLAYLIST_ENRICH_WORKERS = int(os.getenv('PLAYLIST_ENRICH_WORKERS', 4))
+PLAYLIST_ENRICH_QUEUE = int(os.getenv('PLAYLIST_ENRICH_QUEUE', 500))
+# Через сколько секунд повторить ролик, информацию о котором получить не удалось
+PLAYLIST_ENRICH_RETRY = 600
+
+_END = object()
+
+
+# Принудительное удаление файлов рабочей папки (если файл занят или read-only)
+def remove_readonly(func, path, _):
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+def page_items(cursor, size=PLAYLIST_PAGE_SIZE):
+    """Срез плейлиста для yt-dlp (playlist_items): номера с cursor по cursor + size - 1."""
+    return f'{cursor}-{cursor + size - 1}'
+
+
+class PlaylistBrowser:
+    """Постраничный просмотр плейлиста с фоновым дополнением записей.
+
+    Страница — срез playlist_items, поэтому yt-dlp запрашивает только нужную часть
+    списка, а не весь канал на тысячи роликов. Плоский список (extract_flat) не содержит
+    размеров, а часто и длительности: ролики страницы ставятся в очередь, и
+    PLAYLIST_ENRICH_WORKERS потоков получают о них полную информацию. Результат хранится
+    в кэше информации под ключом самого ролика — тем же, что у /get_info, — поэтому
+    повторные страницы, другие плейлисты с тем же роликом и /get_info по его ссылке
+    запросов к YouTube уже не делают.
+    """
+    def __init__(self, service=None, cache=None, workers=PLAYLIST_ENRICH_WORKERS, max_queue=PLAYLIST_ENRICH_QUEUE):
+        self.service = service or download_service
+        self.cache = cache if cache is not None else task_manager.info_cache
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pending = set()    # ключи роликов в очереди или в работе
+        self.failed = {}        # ключ ролика -> когда можно повторить
+        self.lock = threading.Lock()
+        self.threads = []
+        self.enriched = 0
+
+    @staticmethod
+    def page_key(url, cursor, size):
+        return f'{canonical_key(url)}#page:{cursor}:{size}'
+
+    def is_cached(self, url, cursor, size=PLAYLIST_PAGE_SIZE):
+        return self.cache.get(self.page_key(url, cursor, size)) is not None
+
+    def listing(self, info, cursor, size=PLAYLIST_PAGE_SIZE):
+        """Страница из плоского результата yt-dlp: только то, что нужно клиенту."""
+        raw = info.get('entries') or []
+        entries = []
+        for offset, entry in enumerate(raw):
+            if not entry:
+                continue
+            url = entry.get('url') or entry.get('webpage_url')
+            if not url:
+                continue
+            entries.append({
+                'index': entry.get('playlist_index') or cursor + offset,
+                'id': entry.get('id'),
+                'title': entry.get('title') or 'Без названия',
+                'url': url,
+                'duration': DownloadService.format_duration(entry.get('duration')),
+            })
+        count = info.get('playlist_count')
+        has_more = len(raw) >= size and (not count or cursor + size <= count)
+        return {'title': info.get('title') or 'Без названия', 'count': count, 'cursor': cursor,
+                'next_cursor': cursor + size if has_more else None, 'entries': entries}
+
+    def page(self, url, cursor=1, size=PLAYLIST_PAGE_SIZE, info=None, enrich=True):
+        """Страница плейлиста (из кэша или через yt-dlp); info — уже полученный срез с этого cursor."""
+        key = self.page_key(url, cursor, size)
+        listing = self.cache.get(key)
+        if listing is None:
+            if info is None:
+                info = self.service.lookup_info(url, playlist_items=page_items(cursor, size))
+            listing = self.listing(info, cursor, size)
+            self.cache.set(key, listing)
+        return self.enrich(listing) if enrich else listing
+
+    def iter_entries(self, url, limit, size=PLAYLIST_PAGE_SIZE):
+        """Записи плейлиста по страницам, не больше limit. Первым элементом отдается название."""
+        cursor, count = 1, 0
+        while cursor and count < limit:
+            listing = self.page(url, cursor, size, enrich=False)
+            if cursor == 1:
+                yield listing['title']
+            for entry in listing['entries'][:limit - count]:
+                count += 1
+                yield entry
+            cursor = listing['next_cursor']
+
+    def enrich(self, listing):
+        """Подставляет в записи страницы то, что уже известно, остальное ставит в очередь.
+
+        Записи без данных помечаются pending — клиент запрашивает страницу повторно.
+        """
+        now = time.time()
+        entries = []
+        for entry in listing['entries']:
+            entry = dict(entry)
+            key = canonical_key(entry['url'])
+            summary = self.cache.get(key)
+            if summary:
+                entry['duration'] = summary.get('duration') or entry['duration']
+                entry['sizes'] = summary.get('sizes') or {}
+            elif self.failed.get(key, 0) > now:
+                entry['unavailable'] = True
+            else:
+                entry['pending'] = True
+                self._submit(key, entry['url'])
+            entries.append(entry)
+        return dict(listing, entries=entries)
+
+    def _submit(self, key, url):
+        with self.lock:
+            if key in self.pending:
+                return
+            try:
+                self.queue.put_nowait((key, url))
+            except queue.Full:
+                # Очередь переполнена — ролик будет поставлен при следующем запросе страницы
+                return
+            self.pending.add(key)
+            while len(self.threads) < self.workers:
+                t = threading.Thread(target=self._worker, daemon=True)
+                self.threads.append(t)
+                t.start()
+
+    def _worker(self):
+        while True:
+            key, url = self.queue.get()
+            try:
+                if self.cache.get(key) is None:
+                    info = self.service.lookup_info(url)
+                    # 18+ в кэш не кладем: /get_info отдает кэш без проверки возраста
+                    if (info.get('age_limit') or 0) >= 18 or info.get('_type') == 'playlist':
+                        self._fail(key)
+                    else:
+                        self.cache.set(key, self.service.video_summary(info))
+                        self.enriched += 1
+            except Exception as e:
+                logger.info(f"Playlist entry enrichment failed for {key}: {str(e)[:100]}")
+                self._fail(key)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+    def _fail(self, key):
+        now = time.time()
+        with self.lock:
+            if len(self.failed) > 5000:
+                self.failed = {k: t for k, t in self.failed.items() if t > now}
+            self.failed[key] = now + PLAYLIST_ENRICH_RETRY
+
+    def stats(self):
+        with self.lock:
+            return {'queued': self.queue.qsize(), 'pending': len(self.pending),
+                    'enriched': self.enriched, 'failed': len(self.failed)}
+
+
+class _ZipSink:
+    """Приемник для ZipFile без seek/tell: zipfile пишет записи с дескриптором данных,
+    а накопленные байты забираются drain() и сразу уходят клиенту."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class EntryProgress(ProgressReporter):
+    """Прогресс одного ролика плейлиста: пишется в общую задачу, а не в отдельную."""
+    def __init__(self, archive, index):
+        super().__init__(archive.task_id)
+        self.archive = archive
+        self.index = index
+
+    def __call__(self, d):
+        # Клиент ушел — прерываем загрузку из хука, yt-dlp пробросит исключение наверх
+        if self.archive.cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+        super().__call__(d)
+
+    def publish(self, fields):
+        self.archive.entry_progress(self.index, fields['progress'])
+
+    def finished(self):
+        self.archive.entry_progress(self.index, 100)
+
+
+class PlaylistArchive:
+    """Скачивание плейлиста с отдачей ZIP по мере готовности роликов.
+
+    Ролики качаются в PLAYLIST_PARALLEL потоков во временную папку и через очередь
+    из PLAYLIST_BUFFER_FILES элементов передаются в stream(), которая упаковывает их
+    в ZIP без сжатия прямо в HTTP-ответ и удаляет. Если клиент читает медленнее,
+    очередь заполняется и загрузки ждут, поэтому на диске одновременно лежит не больше
+    parallel + buffer_files + 1 файлов при любой длине плейлиста. Архив целиком нигде
+    не собирается.
+    """
+    def __init__(self, task_id, parallel=PLAYLIST_PARALLEL, buffer_files=PLAYLIST_BUFFER_FILES,
+                 client_timeout=PLAYLIST_CLIENT_TIMEOUT, user=None):
+        self.task_id = task_id
+        # Ключ справедливого деления полосы: ролики плейлиста делят долю пользователя с его же загрузками
+        self.user = user if user is not None else f'playlist:{task_id}'
+        self.parallel = max(1, parallel)
+        self.client_timeout = client_timeout
+        self.work_dir = os.path.join(DOWNLOAD_FOLDER, f'playlist_{task_id}')
+        self.ready = queue.Queue(maxsize=max(1, buffer_files))
+        self.cancelled = threading.Event()
+        self.listed = threading.Event()    # список роликов получен (известно название)
+        self.produced = threading.Event()  # загрузки закончены, в очереди больше ничего не будет
+        self.consumed = threading.Event()  # клиент дочитал архив или отключился
+        self.lock = threading.Lock()
+        self.created = time.monotonic()
+        self.attached = False
+        self.title = None
+        self.total = 0
+        self.done = 0
+        self.failed = []
+        self.active = {}
+        self.owners = set()   # записи учета места под ролики этого архива
+        self.cleaned = False
+
+    def attach(self):
+        """Архив можно отдать только одному клиенту: файлы удаляются сразу после упаковки."""
+        with self.lock:
+            if self.attached or self.cancelled.is_set():
+                return False
+            self.attached = True
+            return True
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def entry_progress(self, index, progress):
+        with self.lock:
+            if index in self.active:
+                self.active[index]['progress'] = progress
+            self._publish()
+
+    def _publish(self, **fields):
+        # Вызывается под self.lock
+        running = sum(a['progress'] for a in self.active.values())
+        progress = ((self.done + len(self.failed)) * 100 + running) / self.total if self.total else 0
+        task_manager.update_task(self.task_id, progress=round(min(progress, 100), 1), done=self.done,
+                                 failed=len(self.failed), total=self.total,
+                                 active={str(i): dict(a) for i, a in self.active.items()}, **fields)
+
+    def _put(self, item):
+        # put с таймаутом, чтобы заметить отмену и клиента, который так и не пришел за архивом
+        while not self.cancelled.is_set():
+            try:
+                self.ready.put(item, timeout=1)
+                return True
+            except queue.Full:
+                if not self.attached and time.monotonic() - self.created > self.client_timeout:
+                    logger.warning(f"Playlist {self.task_id}: client did not come for the archive, cancelling")
+                    self.cancel()
+        return False
+
+    def _worker(self, entries, quality, limit_height, ratelimit, sleep_interval, borrow=False):
+        """Качает ролики из очереди. borrow — поток сверх воркера пула: каждый ролик занимает место в пуле."""
+        while not self.cancelled.is_set():
+            if borrow:
+                # Место берется только на время загрузки: пока файл ждет клиента, пул свободен
+                while not download_scheduler.acquire_slot(timeout=1):
+                    if self.cancelled.is_set():
+                        return
+            try:
+                item = self._download_next(entries, quality, limit_height, ratelimit, sleep_interval)
+            except queue.Empty:
+                return
+            finally:
+                if borrow:
+                    download_scheduler.release_slot()
+            if self.cancelled.is_set():
+                return
+            if item and not self._put(item):
+                return
+
+    def _download_next(self, entries, quality, limit_height, ratelimit, sleep_interval):
+        """Скачивает следующий ролик; возвращает элемент для упаковки или None, если ролик не получился."""
+        index, entry = entries.get_nowait()
+        title = entry.get('title') or f'Video {index}'
+        with self.lock:
+            self.active[index] = {'title': title, 'progress': 0}
+            self._publish()
+        filename, error = None, None
+        # Место резервируется под каждый ролик отдельно и освобождается, как только он упакован
+        owner = f'{self.task_id}:{index}'
+        self.owners.add(owner)
+        try:
+            estimate = download_service.estimate_size(entry['url'], quality, limit_height)
+            if not storage.reserve(owner, estimate, timeout=STORAGE_WAIT_TIMEOUT):
+                raise StorageFullError()
+            outtmpl = os.path.join(self.work_dir, f'{index:03d} - %(title)s.%(ext)s')
+            _, filename = download_service.download_media(entry['url'], quality, limit_height, ratelimit,
+                                                          sleep_interval, outtmpl, EntryProgress(self, index),
+                                                          user=self.user)
+        except Exception as e:
+            if self.cancelled.is_set():
+                storage.cancel(owner)
+                return None
+            logger.warning(f"Playlist {self.task_id}: entry {index} failed: {str(e)[:100]}")
+            error = get_friendly_error(e)
+        ok = error is None and os.path.exists(filename)
+        if ok:
+            storage.commit(owner, filename)
+        else:
+            storage.cancel(owner)
+        with self.lock:
+            self.active.pop(index, None)
+            if ok:
+                self.done += 1
+            else:
+                # Неудачный ролик пропускаем, а причину кладем в архив (_errors.txt)
+                self.failed.append((index, title, error or 'Файл не найден после загрузки'))
+            self._publish()
+        return (os.path.basename(filename), filename, owner) if ok else None
+
+    def run(self, url, quality, limit_height=None, ratelimit=None, sleep_interval=0):
+        """Получает список роликов и качает их; возвращается, как только загрузки закончены.
+
+        Первый поток загрузки — сам воркер пула, остальные (до parallel) занимают места в пуле
+        на время каждого ролика. Клиента, который еще дочитывает архив, воркер не ждет: папку
+        удаляет тот, кто закончит последним, — отдача архива или проверка по сроку в reaper,
+        если клиент так и не пришел.
+        """
+        try:
+            listing = playlist_browser.iter_entries(url, PLAYLIST_MAX_ENTRIES)
+            self.title = next(listing, None) or 'playlist'
+            entries = queue.Queue()
+            for entry in listing:
+                entries.put((entry['index'], entry))
+            self.total = entries.qsize()
+            if not self.total:
+                raise ValueError('Playlist is empty')
+            os.makedirs(self.work_dir, exist_ok=True)
+            with self.lock:
+                self._publish(status='downloading', title=self.title)
+            self.listed.set()
+
+            args = (entries, quality, limit_height, ratelimit, sleep_interval)
+            helpers = [threading.Thread(target=self._worker, args=args, kwargs={'borrow': True}, daemon=True)
+                       for _ in range(min(self.parallel, self.total) - 1)]
+            for t in helpers:
+                t.start()
+            self._worker(*args)
+            for t in helpers:
+                t.join()
+            if not self.done and not self.cancelled.is_set():
+                raise ValueError(self.failed[0][2] if self.failed else 'Nothing downloaded')
+            with self.lock:
+                self._publish(status='finished' if not self.cancelled.is_set() else 'error',
+                              error='Загрузка отменена' if self.cancelled.is_set() else None)
+            return self.done
+        finally:
+            self.listed.set()
+            self.produced.set()
+            try:
+                # Метка конца — только если есть место: иначе stream() узнает о конце по produced,
+                # а воркер пула не ждет клиента ради нее
+                self.ready.put_nowait(_END)
+            except queue.Full:
+                pass
+            with self.lock:
+                attached = self.attached
+                if not attached and not self.done:
+                    # Отдавать нечего — клиента не ждем
+                    self.cancelled.set()
+            # Пока клиент читает архив, stream() берет файлы из папки — ее удалит он сам
+            if self.consumed.is_set() or self.cancelled.is_set():
+                self._cleanup()
+            elif not attached:
+                waited = time.monotonic() - self.created
+                reaper.schedule('playlist', self.task_id, time.time() + max(self.client_timeout - waited, 0), self._abandon)
+
+    def _abandon(self, task_id):
+        """Срок ожидания клиента (reaper): архив так никто и не начал забирать."""
+        with self.lock:
+            if self.attached or self.cleaned:
+                return None
+            self.cancelled.set()
+        logger.warning(f"Playlist {self.task_id}: client did not come for the archive, cancelling")
+        return self._cleanup()
+
+    def _cleanup(self):
+        """Удаляет папку архива и записи учета места (один раз) и снимает архив с регистрации."""
+        with self.lock:
+            if self.cleaned:
+                return None
+            self.cleaned = True
+        freed = 0
+        if os.path.isdir(self.work_dir):
+            freed = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(self.work_dir) for name in names)
+            try: shutil.rmtree(self.work_dir, onerror=remove_readonly)
+            except Exception as e: logger.error(f"Playlist cleanup error: {e}")
+        for owner in self.owners:
+            storage.discard(owner)
+        playlist_registry.remove(self.task_id, self)
+        return freed
+
+    def _next_file(self):
+        while True:
+            try:
+                return self.ready.get(timeout=1)
+            except queue.Empty:
+                if self.produced.is_set() and self.ready.empty():
+                    return _END
+
+    def stream(self, chunk_size=ZIP_CHUNK_SIZE):
+        """Генератор тела ответа: ZIP без сжатия (ZIP_STORED), записи добавляются по мере готовности."""
+        sink = _ZipSink()
+        complete = False
+        try:
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+                while True:
+                    item = self._next_file()
+                    if item is _END:
+                        break
+                    arcname, path, owner = item
+                    # Размер известен заранее, поэтому zipfile сам решает, нужен ли ZIP64
+                    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                    with open(path, 'rb') as src, zf.open(zinfo, 'w') as dest:
+                        while True:
+                            chunk = src.read(chunk_size)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            yield sink.drain()
+                    yield sink.drain()
+                    # Упакованный файл больше не нужен — место сразу возвращается в бюджет
+                    storage.discard(owner)
+                if self.failed:
+                    report = '\n'.join(f'{index:03d} - {title}: {error}' for index, title, error in sorted(self.failed))
+                    zf.writestr('_errors.txt', report)
+            # Центральный каталог записывается при закрытии архива
+            yield sink.drain()
+            complete = True
+        finally:
+            if not complete:
+                self.cancel()
+            self.consumed.set()
+            # Загрузки уже закончены — воркер пула ушел, убираем за архивом здесь
+            if self.produced.is_set():
+                self._cleanup()
+
+
+playlist_browser = PlaylistBrowser()
+
+
+class PlaylistRegistry:
+    """Активные архивы плейлистов этого процесса (отдача идет из того же процесса, что и загрузка)."""
+    def __init__(self):
+        self.archives = {}
+        self.lock = threading.Lock()
+
+    def create(self, task_id, user=None):
+        with self.lock:
+            archive = self.archives[task_id] = PlaylistArchive(task_id, user=user)
+            return archive
+
+    def get(self, task_id):
+        with self.lock:
+            return self.archives.get(task_id)
+
+    def remove(self, task_id, archive=None):
+        with self.lock:
+            if archive is None or self.archives.get(task_id) is archive:
+                self.archives.pop(task_id, None)
+
+
+playlist_registry = PlaylistRegistry()
+
+
+def background_playlist(task_id, url, quality, history_id=None):
+    archive = playlist_registry.get(task_id)
+    if archive is None:
+        # Задача поднята из БД после перезапуска: соединение клиента умерло вместе с процессом
+        task_manager.update_task(task_id, status='error', error='Загрузка прервана перезапуском сервера')
+        return
+    try:
+        archive.run(url, quality)
+        if history_id:
+            try:
+                with get_db() as conn:
+                    conn.execute('UPDATE history SET title = ? WHERE id = ?', (f'Плейлист: {archive.title}', history_id))
+                    conn.commit()
+            except Exception as e:
+                logger.error(f"History update error: {e}")
+    except Exception as e:
+        logger.error(f"Playlist error: {e}")
+        task_manager.update_task(task_id, status='error', error=get_friendly_error(e))
+        if history_id:
+            try:
+                with get_db() as conn:
+                    conn.execute('DELETE FROM history WHERE id = ?', (history_id,))
+                    conn.commit()
+            except Exception: pass
+
+
+download_scheduler.register('playlist', background_playlist)
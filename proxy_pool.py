@@ -0,0 +1,177 @@
+import os
+import time
+import threading
+import logging
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# Прокси через запятую; PROXY_URL (один прокси) поддерживается как раньше
+PROXY_URLS = [p.strip() for p in (os.getenv('PROXY_URLS', '') + ',' + os.getenv('PROXY_URL', '')).split(',') if p.strip()]
+# Куда ходить проверкой здоровья (для YouTube — пустая страница generate_204)
+PROXY_HEALTH_URL = os.getenv('PROXY_HEALTH_URL', 'https://www.youtube.com/generate_204')
+PROXY_HEALTH_INTERVAL = int(os.getenv('PROXY_HEALTH_INTERVAL', 60))
+PROXY_HEALTH_TIMEOUT = int(os.getenv('PROXY_HEALTH_TIMEOUT', 10))
+# Сколько ошибок подряд ("я не робот", 429, сеть) размыкают прокси и на сколько секунд
+PROXY_BREAKER_THRESHOLD = int(os.getenv('PROXY_BREAKER_THRESHOLD', 3))
+PROXY_BREAKER_COOLDOWN = int(os.getenv('PROXY_BREAKER_COOLDOWN', 300))
+# Вес нового замера в скользящем среднем (EWMA)
+PROXY_EWMA_ALPHA = 0.3
+
+# Классы ошибок (services.classify_error), в которых виноват прокси, а не видео
+PROXY_ERROR_CLASSES = ('bot', 'rate_limit', 'network')
+
+
+def display_proxy(proxy):
+    """Адрес прокси без логина и пароля — для логов и статистики."""
+    return proxy.split('@')[-1] if proxy else 'direct'
+
+
+class ProxyPool:
+    """Пул прокси с проверками здоровья, EWMA задержки/скорости и автоматическим выключателем.
+
+    Для каждого запроса выбирается лучший доступный прокси: для информации — с наименьшей
+    задержкой, для скачивания — с наибольшей скоростью, с поправкой на текущую нагрузку.
+    После PROXY_BREAKER_THRESHOLD ошибок подряд прокси "размыкается" и не выдается
+    PROXY_BREAKER_COOLDOWN секунд; затем пропускается один пробный запрос (полуоткрытое
+    состояние), и успех возвращает прокси в работу. Если разомкнуты все прокси, выдается
+    тот, что раньше всех должен восстановиться, — загрузки замедляются, но не встают.
+    """
+    def __init__(self, proxies=None, health_url=PROXY_HEALTH_URL, timeout=PROXY_HEALTH_TIMEOUT,
+                 threshold=PROXY_BREAKER_THRESHOLD, cooldown=PROXY_BREAKER_COOLDOWN):
+        proxies = PROXY_URLS if proxies is None else proxies
+        self.health_url = health_url
+        self.timeout = timeout
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.proxies = {}
+        for proxy in dict.fromkeys(proxies):
+            self.proxies[proxy] = {'latency': None, 'throughput': None, 'failures': 0,
+                                   'open_until': 0, 'trial': False, 'in_flight': 0,
+                                   'requests': 0, 'errors': 0}
+        self.lock = threading.Lock()
+        if not self.proxies:
+            logger.warning("⚠️  NO PROXY configured. YouTube may block this server (Render). See PROXY_SETUP.md for instructions.")
+
+    @staticmethod
+    def _ewma(old, value):
+        return value if old is None else old + PROXY_EWMA_ALPHA * (value - old)
+
+    def _state(self, p, now):
+        if p['failures'] < self.threshold:
+            return 'closed'
+        return 'open' if p['open_until'] > now else 'half_open'
+
+    def _score(self, p, kind):
+        # Неизмеренные прокси идут первыми, чтобы о них появилась статистика
+        if kind == 'download' and p['throughput'] is not None:
+            return (1, -p['throughput'] / (1 + p['in_flight']))
+        if p['latency'] is None:
+            return (0, p['in_flight'])
+        return (1, p['latency'] * (1 + p['in_flight']))
+
+    def acquire(self, kind='info', exclude=None):
+        """Выбирает прокси для запроса ('info' или 'download'); None — без прокси."""
+        if not self.proxies:
+            return None
+        now = time.time()
+        with self.lock:
+            candidates = []
+            for proxy, p in self.proxies.items():
+                state = self._state(p, now)
+                if proxy == exclude or state == 'open' or (state == 'half_open' and p['trial']):
+                    continue
+                candidates.append((self._score(p, kind), proxy))
+            if candidates:
+                proxy = min(candidates)[1]
+            else:
+                # Все разомкнуты — берем тот, что восстановится раньше остальных
+                proxy = min(self.proxies, key=lambda k: (k == exclude, self.proxies[k]['open_until']))
+            p = self.proxies[proxy]
+            if self._state(p, now) == 'half_open':
+                p['trial'] = True
+            p['in_flight'] += 1
+            p['requests'] += 1
+            return proxy
+
+    def release(self, proxy):
+        p = self.proxies.get(proxy)
+        if p:
+            with self.lock:
+                p['in_flight'] = max(0, p['in_flight'] - 1)
+                p['trial'] = False
+
+    def record(self, proxy, ok, error_class=None, latency=None, throughput=None):
+        """Учитывает результат запроса через прокси.
+
+        Ошибки, в которых прокси не виноват (удаленное видео и т.п.), считаются успехом соединения.
+        """
+        p = self.proxies.get(proxy)
+        if not p:
+            return
+        failed = not ok and error_class in PROXY_ERROR_CLASSES
+        with self.lock:
+            if failed:
+                p['errors'] += 1
+                p['failures'] += 1
+                if p['failures'] >= self.threshold:
+                    if p['open_until'] <= time.time():
+                        logger.warning(f"Proxy {display_proxy(proxy)} disabled for {self.cooldown}s after {p['failures']} errors ({error_class})")
+                    p['open_until'] = time.time() + self.cooldown
+                return
+            if p['failures'] >= self.threshold:
+                logger.info(f"Proxy {display_proxy(proxy)} is back")
+            p['failures'] = 0
+            p['open_until'] = 0
+            if latency is not None:
+                p['latency'] = self._ewma(p['latency'], latency)
+            if throughput:
+                p['throughput'] = self._ewma(p['throughput'], throughput)
+
+    def probe(self, proxy):
+        """Проверка здоровья: запрос PROXY_HEALTH_URL через прокси. Возвращает задержку или None."""
+        if not proxy.startswith('http'):
+            # socks-прокси urllib не умеет — для них остается только учет реальных запросов
+            return None
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({'http': proxy, 'https': proxy}))
+        started = time.monotonic()
+        try:
+            with opener.open(self.health_url, timeout=self.timeout) as response:
+                response.read(1024)
+        except Exception as e:
+            logger.warning(f"Proxy {display_proxy(proxy)} health check failed: {str(e)[:100]}")
+            self.record(proxy, False, 'network')
+            return None
+        latency = time.monotonic() - started
+        p = self.proxies[proxy]
+        with self.lock:
+            # Проверка не доказывает, что YouTube не требует капчу, поэтому счетчик ошибок
+            # она не сбрасывает — это делает только успешный настоящий запрос (record)
+            p['latency'] = self._ewma(p['latency'], latency)
+        return latency
+
+    def check_all(self):
+        for proxy in list(self.proxies):
+            self.probe(proxy)
+
+    def start_health_checks(self, interval=PROXY_HEALTH_INTERVAL):
+        if not self.proxies:
+            return
+        def loop():
+            while True:
+                try: self.check_all()
+                except Exception as e: logger.error(f"Proxy health check error: {e}")
+                time.sleep(interval)
+        threading.Thread(target=loop, daemon=True).start()
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return [{'proxy': display_proxy(proxy), 'state': self._state(p, now),
+                     'latency': round(p['latency'], 3) if p['latency'] is not None else None,
+                     'throughput': int(p['throughput']) if p['throughput'] else None,
+                     'in_flight': p['in_flight'], 'requests': p['requests'], 'errors': p['errors']}
+                    for proxy, p in self.proxies.items()]
+
+
+proxy_pool = ProxyPool()
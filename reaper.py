@@ -0,0 +1,95 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Сколько просроченных элементов обрабатывать за один проход (остальные — следующим проходом, без ожидания)
+REAPER_BATCH = int(os.getenv('REAPER_BATCH', 500))
+
+
+class ExpiryReaper:
+    """Фоновое удаление всего, у чего есть срок жизни: задачи, записи кэша информации, файлы.
+
+    Владелец данных при создании записи ставит в кучу ее срок (schedule, O(log n)),
+    а один фоновый поток спит до ближайшего срока и вызывает обработчик. Обработчик
+    сам проверяет, что запись действительно истекла (срок могли продлить — тогда в
+    куче уже лежит более новый элемент), и возвращает число освобожденных байт
+    или None, если удалять было нечего. Поэтому в запросах нет ни полного обхода задач,
+    ни обхода каталога.
+    """
+    def __init__(self, batch=REAPER_BATCH):
+        self.batch = max(1, batch)
+        self.heap = []                 # (срок, порядковый номер, вид, ключ, обработчик)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.expired = defaultdict(int)
+        self.bytes_freed = 0
+        self.errors = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+
+    def schedule(self, kind, key, deadline, handler):
+        """Ставит срок записи: в момент deadline будет вызван handler(key)."""
+        with self.cond:
+            earliest = not self.heap or deadline < self.heap[0][0]
+            heapq.heappush(self.heap, (deadline, next(self.seq), kind, key, handler))
+            if self.thread is None:
+                # Поток запускается лениво, при первом сроке
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+            elif earliest:
+                self.cond.notify()
+
+    def run_due(self, now=None):
+        """Обрабатывает до batch просроченных элементов. Возвращает, сколько записей удалено."""
+        now = now or time.time()
+        with self.cond:
+            due = []
+            while self.heap and self.heap[0][0] <= now and len(due) < self.batch:
+                due.append(heapq.heappop(self.heap))
+        removed = 0
+        for deadline, _, kind, key, handler in due:
+            try:
+                freed = handler(key)
+            except Exception as e:
+                logger.error(f"Reaper {kind} {key} error: {e}")
+                with self.cond:
+                    self.errors += 1
+                continue
+            lag = max(time.time() - deadline, 0.0)
+            with self.cond:
+                self.lag_last = lag
+                self.lag_max = max(self.lag_max, lag)
+                if freed is not None:
+                    self.expired[kind] += 1
+                    self.bytes_freed += freed
+                    removed += 1
+        return removed
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.cond.wait(self.heap[0][0] - now if self.heap else None)
+            self.run_due()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'pending': len(self.heap),
+                'next_in': round(self.heap[0][0] - time.time(), 1) if self.heap else None,
+                'expired': dict(self.expired),
+                'bytes_freed': self.bytes_freed,
+                'errors': self.errors,
+                'lag_last': round(self.lag_last, 3),
+                'lag_max': round(self.lag_max, 3),
+            }
@@ -0,0 +1,211 @@
+import os
+import time
+import threading
+from collections import deque
+from extensions import task_manager, job_store, logger
+from fragments import fragment_connections
+
+# Настройки пула воркеров (можно переопределить в .env / Render)
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 3))
+DOWNLOAD_QUEUE_SIZE = int(os.getenv('DOWNLOAD_QUEUE_SIZE', 50))
+# Сколько Premium-задач подряд можно взять, прежде чем пропустить одну бесплатную (защита от голодания)
+DOWNLOAD_PREMIUM_BURST = int(os.getenv('DOWNLOAD_PREMIUM_BURST', 3))
+# Как часто искать задачи, брошенные упавшим/перезапущенным процессом
+JOB_RECLAIM_INTERVAL = int(os.getenv('JOB_RECLAIM_INTERVAL', 30))
+
+
+class QueueFullError(Exception):
+    """Очередь скачиваний переполнена."""
+
+
+class DownloadScheduler:
+    """Ограниченный пул воркеров с приоритетными очередями для Premium и бесплатных пользователей."""
+    LANES = ('premium', 'free')
+
+    def __init__(self, tasks=None, jobs=None, workers=DOWNLOAD_WORKERS, max_queue=DOWNLOAD_QUEUE_SIZE, premium_burst=DOWNLOAD_PREMIUM_BURST,
+                 connections=None):
+        self.tasks = tasks or task_manager
+        self.jobs = jobs
+        # Общий бюджет соединений фрагментных загрузок: пока он исчерпан, новые задачи ждут в очереди
+        self.connections = connections
+        if connections:
+            connections.subscribe(self._wake)
+        self.handlers = {}
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.premium_burst = max(1, premium_burst)
+        self.lanes = {lane: deque() for lane in self.LANES}
+        self.cond = threading.Condition()
+        self.active = 0
+        # Места в очереди, занятые задачами, которые сейчас сохраняются в БД (submit вне блокировки)
+        self.reserved = 0
+        self._premium_streak = 0
+        self._threads = []
+
+    def _ensure_workers(self):
+        # Воркеры запускаются лениво, при первой задаче
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def _wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def _saturated(self):
+        return self.connections is not None and self.connections.available() <= 0
+
+    def queued_count(self):
+        return sum(len(q) for q in self.lanes.values())
+
+    def register(self, kind, func):
+        """Регистрирует обработчик для типа задач (нужно, чтобы поднять задачу из БД после перезапуска)."""
+        self.handlers[kind] = func
+
+    def submit(self, task_id, kind, *args, premium=False):
+        """Ставит задачу в очередь. Бросает QueueFullError, если очередь заполнена."""
+        lane = 'premium' if premium else 'free'
+        with self.cond:
+            if self.queued_count() + self.reserved >= self.max_queue:
+                raise QueueFullError()
+            self.reserved += 1
+        # Запись в хранилище и синхронная запись в БД идут без блокировки: воркеры и другие submit не ждут диск
+        try:
+            self.tasks.update_task(task_id, status='queued', lane=lane)
+            if self.jobs:
+                self.jobs.create(task_id, kind, args, lane, self.tasks.get_task(task_id) or {'status': 'queued'})
+        except Exception:
+            with self.cond:
+                self.reserved -= 1
+            raise
+        with self.cond:
+            self.reserved -= 1
+            self._enqueue(task_id, kind, args, lane)
+
+    def _enqueue(self, task_id, kind, args, lane):
+        self.lanes[lane].append((task_id, kind, args))
+        self._ensure_workers()
+        # На том же условии ждут и вспомогательные загрузки (acquire_slot) — будим всех
+        self.cond.notify_all()
+
+    def recover(self):
+        """Подбирает из БД задачи, брошенные упавшим процессом, и ставит их обратно в очередь."""
+        if not self.jobs:
+            return 0
+        claimed = self.jobs.claim_orphans()
+        with self.cond:
+            for job in claimed:
+                if job['kind'] not in self.handlers:
+                    logger.warning(f"No handler for recovered job {job['task_id']} ({job['kind']})")
+                    continue
+                state = dict(job['state'], status='queued')
+                self.tasks.restore_task(job['task_id'], state)
+                # Восстановленные задачи не отбрасываем, даже если очередь заполнена
+                self._enqueue(job['task_id'], job['kind'], tuple(job['args']), job['lane'] or 'free')
+                logger.info(f"Recovered download job {job['task_id']}")
+        return len(claimed)
+
+    def start_recovery(self, interval=JOB_RECLAIM_INTERVAL):
+        def loop():
+            while True:
+                try: self.recover()
+                except Exception as e: logger.error(f"Job recovery error: {e}")
+                time.sleep(interval)
+        threading.Thread(target=loop, daemon=True).start()
+
+    def _pick_lane(self, premium_len, free_len, streak):
+        if premium_len and (streak < self.premium_burst or not free_len):
+            return 'premium'
+        return 'free'
+
+    def _next_job(self):
+        lane = self._pick_lane(len(self.lanes['premium']), len(self.lanes['free']), self._premium_streak)
+        self._premium_streak = self._premium_streak + 1 if lane == 'premium' else 0
+        return self.lanes[lane].popleft()
+
+    def position(self, task_id):
+        """Место задачи в очереди (1 — следующая), 0 — задача не в очереди.
+
+        Считается при чтении: симулируем порядок выдачи задач, пока не дойдем до нужной.
+        Хранить позицию в задаче дороже — любой submit или выдача сдвигает всю очередь.
+        """
+        with self.cond:
+            premium_len, free_len = len(self.lanes['premium']), len(self.lanes['free'])
+            p_idx = f_idx = 0
+            streak = self._premium_streak
+            for position in range(1, premium_len + free_len + 1):
+                lane = self._pick_lane(premium_len - p_idx, free_len - f_idx, streak)
+                if lane == 'premium':
+                    queued_id = self.lanes['premium'][p_idx][0]
+                    p_idx += 1
+                    streak += 1
+                else:
+                    queued_id = self.lanes['free'][f_idx][0]
+                    f_idx += 1
+                    streak = 0
+                if queued_id == task_id:
+                    return position
+        return 0
+
+    def with_position(self, task_id, task):
+        """Копия состояния задачи с текущим queue_position (для присоединенной задачи — позиция лидера)."""
+        if not task or task.get('status') != 'queued':
+            return task
+        return dict(task, queue_position=self.position(task.get('leader_id') or task_id))
+
+    def acquire_slot(self, timeout=None):
+        """Место в пуле для вспомогательной загрузки внутри задачи (ролик плейлиста).
+
+        Такие загрузки считаются в active наравне с задачами и уступают очереди: место
+        выдается, только когда есть свободный воркер и ни одна задача не ждет.
+        Возвращает False, если за timeout место не освободилось.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.active >= self.workers or self.queued_count():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            self.active += 1
+            return True
+
+    def release_slot(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.queued_count() or self._saturated() or self.active >= self.workers:
+                    self.cond.wait()
+                task_id, kind, args = self._next_job()
+                self.active += 1
+            try:
+                func = self.handlers.get(kind)
+                if func is None:
+                    # Обработчик не зарегистрирован: задача завершается ошибкой, воркер живет дальше
+                    logger.error(f"No handler for job {task_id} ({kind})")
+                    self.tasks.update_task(task_id, status='error', error='Неизвестный тип задачи')
+                    continue
+                func(task_id, *args)
+            except Exception as e:
+                logger.error(f"Worker error for task {task_id}: {e}")
+            finally:
+                with self.cond:
+                    self.active -= 1
+                    self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'workers': self.workers,
+                'active': self.active,
+                'queued': {lane: len(q) for lane, q in self.lanes.items()},
+                'connections': self.connections.stats() if self.connections else None,
+            }
+
+
+download_scheduler = DownloadScheduler(jobs=job_store, connections=fragment_connections)
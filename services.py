@@ -1,5 +1,5 @@
 import os
-import re
+import json
 import shutil
 import smtplib
 import time
@@ -9,46 +9,102 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 import hashlib
+import queue
+import threading
+from collections import OrderedDict, defaultdict, deque
 from flask import url_for
 from markupsafe import escape
-from extensions import socketio, task_manager, get_db
+from extensions import socketio, task_manager, get_db, storage, reaper, DOWNLOAD_FOLDER
+from scheduler import download_scheduler
+from media_cache import media_cache
+from url_keys import canonical_key, canonicalize
+from ydl_pool import YdlPool
+from cookie_manager import cookie_manager
+from proxy_pool import proxy_pool, display_proxy, PROXY_ERROR_CLASSES
+from streaming import MediaStream, STREAM_MAX_ACTIVE, STREAM_READY_TTL, proxy_supported
+from format_index import FormatIndex
+from storage import StorageFullError, STORAGE_WAIT_TIMEOUT
+from bandwidth import bandwidth
+from fragments import fragment_tuner, fragment_connections, ConnectionsBusyError
 from models import UserRepository
 import logging
 
 logger = logging.getLogger(__name__)
 
-def get_friendly_error(e):
-    """Преобразует ошибку yt-dlp в понятное сообщение."""
+ERROR_MESSAGES = {
+    'network': "Ошибка сети: не удалось связаться с видео-хостингом. Попробуйте позже или используйте VPN.",
+    'unsupported': "Ссылка не поддерживается. Попробуйте другую.",
+    'unavailable': "Видео недоступно. Возможно, оно удалено или доступ ограничено.",
+    'private': "Это приватное видео. Для скачивания нужен доступ.",
+    'age': "Видео с возрастным ограничением (18+). Скачивание запрещено.",
+    'bot': "YouTube требует проверку 'Я не робот'. Сервер блокирован. Администратор должен добавить прокси в настройках Render (PROXY_URL).",
+    'rate_limit': "Видео-хостинг ограничил число запросов с сервера. Попробуйте через пару минут.",
+    'unknown': "Не удалось получить информацию о видео. Проверьте ссылку и попробуйте снова.",
+    'storage': "На сервере закончилось место для файлов. Попробуйте через несколько минут.",
+    'busy': "Сервер перегружен: слишком много одновременных загрузок. Попробуйте через минуту.",
+}
+
+# Сколько секунд помнить неудачный поиск информации, в зависимости от класса ошибки.
+# Постоянные ошибки (удалено, приватное) живут дольше, временные (сеть, бот-проверка) — совсем недолго.
+INFO_NEGATIVE_TTL = {
+    'unsupported': 600,
+    'unavailable': 300,
+    'private': 300,
+    'age': 600,
+    'bot': 30,
+    'rate_limit': 30,
+    'network': 10,
+    'unknown': 30,
+}
+# Сколько недавних ошибок помнить одновременно; самые старые вытесняются
+INFO_NEGATIVE_MAX = int(os.getenv('INFO_NEGATIVE_MAX', 1000))
+# Файл в рабочей папке задачи: загрузка и склейка закончены, после перезапуска качать заново не нужно
+DOWNLOAD_CHECKPOINT = '.checkpoint.json'
+# Сколько ждать результат чужого запроса той же ссылки
+INFO_LOOKUP_TIMEOUT = int(os.getenv('INFO_LOOKUP_TIMEOUT', 180))
+
+# Ошибки, которые не исправить сменой параметров запроса
+PERMANENT_ERROR_CLASSES = ('unsupported', 'unavailable', 'private', 'age')
+
+def classify_error(e):
+    """Определяет класс ошибки yt-dlp (ключ для ERROR_MESSAGES и INFO_NEGATIVE_TTL)."""
+    if isinstance(e, StorageFullError):
+        return 'storage'
+    if isinstance(e, ConnectionsBusyError):
+        return 'busy'
     error_str = str(e).lower()
-    logger.warning(f"yt-dlp error: {error_str}") # Логируем ошибку для отладки
     if 'failed to resolve' in error_str or 'lookup timed out' in error_str:
-        return "Ошибка сети: не удалось связаться с видео-хостингом. Попробуйте позже или используйте VPN."
+        return 'network'
     if 'unsupported url' in error_str:
-        return "Ссылка не поддерживается. Попробуйте другую."
+        return 'unsupported'
     if 'video unavailable' in error_str:
-        return "Видео недоступно. Возможно, оно удалено или доступ ограничено."
+        return 'unavailable'
     if 'private video' in error_str:
-        return "Это приватное видео. Для скачивания нужен доступ."
+        return 'private'
     if 'age-restricted' in error_str or 'confirm your age' in error_str:
-        return "Видео с возрастным ограничением (18+). Скачивание запрещено."
+        return 'age'
     if 'sign in to confirm' in error_str or 'not a bot' in error_str:
-        return "YouTube требует проверку 'Я не робот'. Сервер блокирован. Администратор должен добавить прокси в настройках Render (PROXY_URL)."
-    return "Не удалось получить информацию о видео. Проверьте ссылку и попробуйте снова."
+        return 'bot'
+    if 'http error 429' in error_str or 'too many requests' in error_str:
+        return 'rate_limit'
+    return 'unknown'
+
+def get_friendly_error(e):
+    """Преобразует ошибку yt-dlp в понятное сообщение."""
+    logger.warning(f"yt-dlp error: {str(e).lower()}") # Логируем ошибку для отладки
+    return ERROR_MESSAGES[classify_error(e)]
+
+class InfoLookupError(Exception):
+    """Ошибка получения информации о видео (в том числе взятая из негативного кэша)."""
+    def __init__(self, message, error_class):
+        super().__init__(message)
+        self.error_class = error_class
 
 SMTP_EMAIL = os.getenv('SMTP_EMAIL', "").strip()
 SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', "").replace(' ', '')
 ADMIN_EMAIL = os.getenv('ADMIN_EMAIL', "").strip()
 FREEDOM_MERCHANT_ID = os.getenv('FREEDOM_MERCHANT_ID')
 FREEDOM_SECRET_KEY = os.getenv('FREEDOM_SECRET_KEY')
-PROXY_URL = os.getenv('PROXY_URL')
-
-# Список бесплатных публичных прокси для Render
-# Если основной прокси не работает, используем эти как fallback
-FALLBACK_PROXIES = [
-    # Вы можете добавить бесплатные прокси сюда если PROXY_URL не установлен
-    # Например: 'http://proxy1.example.com:8080'
-    # Или использовать платный сервис
-]
 
 class EmailService:
     """Сервис для отправки уведомлений и писем."""
@@ -153,26 +209,251 @@ class FreedomPayService:
         # Логика проверки подписи callback
         return True # Упрощено для примера, в продакшене нужно реализовать полную проверку
 
+# Заголовки браузера для запросов к видео-хостингам
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0',
+    'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Cache-Control': 'max-age=0'
+}
+
+# Окно истории стратегий на экстрактор и режим гонки двух лучших стратегий
+INFO_STRATEGY_WINDOW = int(os.getenv('INFO_STRATEGY_WINDOW', 50))
+INFO_RACE_STRATEGIES = os.getenv('INFO_RACE_STRATEGIES', 'False').lower() == 'true'
+
+class StrategyMemory:
+    """Помнит, какие стратегии получения информации срабатывали для каждого экстрактора (скользящее окно)."""
+    def __init__(self, window=INFO_STRATEGY_WINDOW):
+        self.window = window
+        self.history = defaultdict(lambda: deque(maxlen=self.window))
+        self.lock = threading.Lock()
+
+    def record(self, domain, strategy, ok, latency):
+        with self.lock:
+            self.history[domain].append((strategy, ok, latency))
+
+    def order(self, domain, strategies):
+        """Сортирует стратегии: сначала по доле успехов, затем по средней задержке успешных попыток."""
+        with self.lock:
+            events = list(self.history.get(domain, ()))
+        default_rank = {s: i for i, s in enumerate(strategies)}
+
+        def score(strategy):
+            runs = [(ok, latency) for name, ok, latency in events if name == strategy]
+            successes = [latency for ok, latency in runs if ok]
+            # Сглаживание Лапласа: у стратегии без истории шанс 50%, порядок по умолчанию сохраняется
+            rate = (len(successes) + 1) / (len(runs) + 2)
+            avg_latency = sum(successes) / len(successes) if successes else float('inf')
+            return (-rate, avg_latency, default_rank[strategy])
+
+        return sorted(strategies, key=score)
+
+    def stats(self):
+        with self.lock:
+            return {domain: list(events) for domain, events in self.history.items()}
+
+# Как часто (сек) публиковать прогресс одной загрузки
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', 0.5))
+
+class ProgressReporter:
+    """Хук прогресса yt-dlp: сырые числовые поля вместо строк и не чаще раза в interval секунд.
+
+    При нескольких фрагментах одновременно yt-dlp вызывает хук сотни раз в секунду
+    из разных потоков. Лишние вызовы отбрасываются без ожидания блокировок,
+    форматирование (проценты, скорость, ETA) делает клиент.
+    """
+    def __init__(self, task_id, interval=PROGRESS_UPDATE_INTERVAL):
+        self.task_id = task_id
+        self.interval = interval
+        self.last = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fields(d):
+        downloaded = d.get('downloaded_bytes') or 0
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        fragment_index, fragment_count = d.get('fragment_index'), d.get('fragment_count')
+        if total:
+            progress = min(downloaded / total * 100, 100)
+        elif fragment_count:
+            progress = min((fragment_index or 0) / fragment_count * 100, 100)
+        else:
+            progress = 0
+        return {
+            'progress': round(progress, 1),
+            'downloaded_bytes': downloaded,
+            'total_bytes': int(total) if total else None,
+            'speed': round(d['speed']) if d.get('speed') else None,
+            'eta': int(d['eta']) if d.get('eta') is not None else None,
+            'fragment_index': fragment_index,
+            'fragment_count': fragment_count,
+        }
+
+    def __call__(self, d):
+        status = d.get('status')
+        if status == 'downloading':
+            now = time.monotonic()
+            # Другой поток уже публикует прогресс — этот вызов просто пропускаем
+            if now - self.last < self.interval or not self.lock.acquire(blocking=False):
+                return
+            try:
+                if now - self.last < self.interval:
+                    return
+                self.last = now
+                self.publish(self.fields(d))
+            finally:
+                self.lock.release()
+        elif status == 'finished':
+            self.finished()
+
+    def publish(self, fields):
+        task_manager.update_task(self.task_id, **fields)
+
+    def finished(self):
+        # Файл (или одна из дорожек) скачан, дальше склейка/конвертация
+        task_manager.update_task(self.task_id, status='processing', progress=100)
+
 class DownloadService:
     """Сервис для скачивания видео и обработки."""
+
+    def __init__(self):
+        # Загрузки в процессе: (ключ ролика и формата, есть ли ограничение скорости) -> лидер и присоединившиеся задачи
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        # Поиск информации: запросы в процессе (single-flight) и недавние ошибки (негативный кэш)
+        self.info_flights = {}
+        self.info_errors = OrderedDict()
+        self.info_lock = threading.Lock()
+        self.strategy_memory = StrategyMemory()
+        # Прогретые экземпляры YoutubeDL вместо создания нового на каждый запрос
+        self.ydl_pool = YdlPool()
+        # Потоковые задачи, которые сейчас отдаются (ограничены STREAM_MAX_ACTIVE)
+        self.streams_active = 0
+        self.stream_lock = threading.Lock()
+
+    def stream_available(self):
+        # С socks-прокси в пуле поток мог бы пойти в обход прокси — такие загрузки идут через очередь
+        if not all(proxy_supported(proxy) for proxy in proxy_pool.proxies):
+            return False
+        with self.stream_lock:
+            return self.streams_active < STREAM_MAX_ACTIVE and fragment_connections.available() > 0
+
+    def claim_stream(self, task_id):
+        """Одноразовый запуск потоковой задачи: stream_ready -> stream_starting и место в лимите потоков.
+
+        Возвращает (задача, причина отказа или None): 'missing' — нет такой потоковой задачи,
+        'used' — ссылку уже открывали, 'busy' — все места заняты (задача остается stream_ready).
+        """
+        with self.stream_lock:
+            task = task_manager.get_task(task_id)
+            if not task or task.get('mode') != 'stream':
+                return task, 'missing'
+            if task.get('status') != 'stream_ready':
+                return task, 'used'
+            if self.streams_active >= STREAM_MAX_ACTIVE or fragment_connections.available() <= 0:
+                return task, 'busy'
+            self.streams_active += 1
+            task_manager.update_task(task_id, status='stream_starting')
+            return task, None
+
+    def expect_stream(self, task_id, ttl=STREAM_READY_TTL):
+        """Ставит срок потоковой ссылке: если ее так и не откроют, задача отменяется (_expire_stream)."""
+        reaper.schedule('stream', task_id, time.time() + ttl, self._expire_stream)
+
+    def _expire_stream(self, task_id):
+        """Ссылку не открыли: ни одного байта не отдали, поэтому запись в истории не должна тратить лимит."""
+        with self.stream_lock:
+            task = task_manager.get_task(task_id)
+            if not task or task.get('mode') != 'stream' or task.get('status') != 'stream_ready':
+                return None
+            task_manager.update_task(task_id, status='error', error='Ссылка устарела. Начните скачивание заново.')
+        if task.get('history_id'):
+            try:
+                with get_db() as conn:
+                    conn.execute('DELETE FROM history WHERE id = ?', (task['history_id'],))
+                    conn.commit()
+            except Exception: pass
+        return 0
+
+    def release_stream(self):
+        with self.stream_lock:
+            self.streams_active = max(0, self.streams_active - 1)
+
+    @staticmethod
+    def build_format_selector(quality, limit_height=None):
+        # Приоритет аудио m4a (AAC) для лучшей совместимости с MP4
+        audio_q = 'bestaudio[ext=m4a]/bestaudio'
+
+        if quality == 'audio':
+            return 'bestaudio/best'
+        if limit_height:
+            # Пытаемся скачать видео+аудио, если не выйдет - лучший одиночный файл
+            return f'bestvideo[height<={limit_height}]+{audio_q}/best[height<={limit_height}]/best'
+        if quality == '1080':
+            return f'bestvideo[height<=1080]+{audio_q}/best[height<=1080]/best'
+        if quality == '720':
+            return f'bestvideo[height<=720]+{audio_q}/best[height<=720]/best'
+        return f'bestvideo+{audio_q}/best'
+
+    def request_key(self, url, quality, limit_height=None):
+        """Ключ запроса на скачивание: нормализованный ролик + селектор формата."""
+        return media_cache.request_key(canonical_key(url), self.build_format_selector(quality, limit_height))
+
+    def join_inflight(self, task_id, url, quality, limit_height, ratelimit, history_id=None):
+        """Single-flight: если такой же ролик в таком же формате уже качается, присоединяет задачу к нему.
+
+        Возвращает id задачи-лидера, если присоединились, иначе регистрирует task_id лидером и возвращает None.
+        Список присоединившихся сохраняется в состоянии лидера, чтобы пережить перезапуск (resume_inflight).
+        """
+        key = self.request_key(url, quality, limit_height)
+        limited = bool(ratelimit)
+        with self.inflight_lock:
+            # К загрузке без ограничения скорости присоединяется любой. Premium к ограниченной не присоединяем,
+            # чтобы не замедлять его, — он становится лидером своей загрузки, и следующие Premium ждут уже ее
+            flight = self.inflight.get((key, False)) or (self.inflight.get((key, True)) if limited else None)
+            if flight:
+                flight['followers'].append((task_id, history_id))
+                task_manager.update_task(task_id, status='queued', leader_id=flight['task_id'])
+                task_manager.update_task(flight['task_id'], followers=[list(f) for f in flight['followers']])
+                return flight['task_id']
+            self.inflight[(key, limited)] = {'task_id': task_id, 'ratelimit': ratelimit, 'followers': []}
+            return None
+
+    def resume_inflight(self, task_id, url, quality, limit_height, ratelimit):
+        """Регистрирует лидером задачу, поднятую после перезапуска, вместе с сохраненными присоединившимися."""
+        followers = [tuple(f) for f in (task_manager.get_task(task_id) or {}).get('followers') or []]
+        key = (self.request_key(url, quality, limit_height), bool(ratelimit))
+        with self.inflight_lock:
+            if any(flight['task_id'] == task_id for flight in self.inflight.values()):
+                return
+            # Ключ мог занять новый запрос, пока задача ждала в очереди: новые задачи ждут его,
+            # а эта регистрируется отдельно, только чтобы leave_inflight вернул ее присоединившихся
+            if key in self.inflight:
+                key += (task_id,)
+            self.inflight[key] = {'task_id': task_id, 'ratelimit': ratelimit, 'followers': followers}
+
+    def leave_inflight(self, task_id):
+        """Снимает лидера с регистрации и возвращает присоединившиеся к нему задачи."""
+        with self.inflight_lock:
+            for key, flight in list(self.inflight.items()):
+                if flight['task_id'] == task_id:
+                    del self.inflight[key]
+                    return flight['followers']
+        return []
     
     def _get_ydl_opts_with_cookies(self, base_opts):
         """Добавляет cookies и параметры для обхода проверки 'я не робот'."""
-        # Абсолютный путь к cookies.txt
-        cookies_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cookies.txt')
-        
-        # Добавляем cookies если они есть и содержат данные
-        if os.path.exists(cookies_path):
-            try:
-                with open(cookies_path, 'r') as f:
-                    content = f.read()
-                    # Проверяем есть ли реальные cookies (не только комментарии)
-                    cookie_lines = [l for l in content.split('\n') if l.strip() and not l.startswith('#')]
-                    if len(cookie_lines) > 3:
-                        base_opts['cookiefile'] = cookies_path
-                        logger.info(f"Using cookies file with {len(cookie_lines)} cookies")
-            except Exception as e:
-                logger.warning(f"Could not read cookies file: {e}")
+        # Наименее нагруженный аккаунт из пула cookies (файлы читаются только при изменении)
+        cookiefile = cookie_manager.acquire()
+        if cookiefile:
+            # Рабочая копия: сохранение cookies при закрытии YoutubeDL не меняет версию файла для пула
+            base_opts['cookiefile'] = cookie_manager.working_copy(cookiefile)
         
         # Агрессивные параметры для обхода защиты YouTube
         base_opts['extractor_args'] = {
@@ -184,18 +465,7 @@ class DownloadService:
         }
         
         # Хороший User-Agent (актуальный на 2026 год)
-        base_opts['http_headers'] = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0',
-            'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'Cache-Control': 'max-age=0'
-        }
+        base_opts['http_headers'] = dict(BROWSER_HEADERS)
         
         # Параметры для обхода проверки и оптимизации
         base_opts['socket_timeout'] = 30
@@ -203,138 +473,264 @@ class DownloadService:
         base_opts['fragment_retries'] = 3  # Повторы для фрагментов
         base_opts['http_chunks'] = True
         
-        # Используем прокси если он существует в .env
-        if PROXY_URL:
-            base_opts['proxy'] = PROXY_URL
-            proxy_display = PROXY_URL.split('@')[-1] if '@' in PROXY_URL else PROXY_URL
-            logger.info(f"🛡️  Using PROXY for YouTube: {proxy_display}")
-        else:
-            logger.warning("⚠️  NO PROXY configured. YouTube may block this server (Render). See PROXY_SETUP.md for instructions.")
-        
         return base_opts
     
-    def get_video_info(self, url, proxy=None):
-        """Получает информацию о видео с множественными стратегиями обхода блокировки."""
+    # Стратегии извлечения информации: от полной (cookies, заголовки, extractor_args) до минимальной
+    INFO_STRATEGIES = ('full', 'reduced', 'minimal')
+
+    def _info_opts(self, strategy, proxy):
+        if strategy == 'full':
+            # С cookies и полными параметрами + прокси если есть
+            ydl_opts = {
+                'quiet': True,
+                'cachedir': False,
+                'no_warnings': True,
+                'extract_flat': 'in_playlist',
+            }
+            if proxy:
+                ydl_opts['proxy'] = proxy
+            # Добавляем cookies и параметры защиты
+            return self._get_ydl_opts_with_cookies(ydl_opts)
+
         ydl_opts = {
             'quiet': True,
-            'cachedir': False,
-            'no_warnings': True,
             'extract_flat': 'in_playlist',
         }
-
-        # Используем прокси из .env, если он задан.
-        current_proxy = proxy or PROXY_URL
+        if strategy == 'reduced':
+            # Без некоторых параметров которые могут вызвать проблемы, но с хорошим User-Agent
+            ydl_opts['socket_timeout'] = 30
+            ydl_opts['http_headers'] = dict(BROWSER_HEADERS)
+        if proxy:
+            ydl_opts['proxy'] = proxy
+        return ydl_opts
+
+    def _run_strategy(self, strategy, url, proxy, domain, playlist_items=None):
+        logger.info(f"Extracting info with '{strategy}' strategy")
+        started = time.monotonic()
+        opts = self._info_opts(strategy, proxy)
+        cookiefile = opts.get('cookiefile')
+        # Срез плейлиста ("51-100"): yt-dlp запрашивает только нужные страницы списка
+        overrides = {'playlist_items': playlist_items} if playlist_items else None
+        try:
+            with self.ydl_pool.checkout(f'info_{strategy}', opts, overrides, generation=cookie_manager.version(cookiefile)) as ydl:
+                info = ydl.extract_info(url, download=False)
+        except Exception as e:
+            error_class = classify_error(e)
+            cookie_manager.report_failure(cookiefile, error_class)
+            proxy_pool.record(proxy, False, error_class)
+            # Ошибки самого видео (удалено, приватное) не говорят ничего о качестве стратегии
+            if error_class not in PERMANENT_ERROR_CLASSES:
+                self.strategy_memory.record(domain, strategy, False, time.monotonic() - started)
+            logger.warning(f"Strategy '{strategy}' failed: {str(e)[:100]}")
+            raise
+        latency = time.monotonic() - started
+        self.strategy_memory.record(domain, strategy, True, latency)
+        proxy_pool.record(proxy, True, latency=latency)
+        return info
+
+    def _race_strategies(self, strategies, url, proxy, domain, playlist_items=None):
+        """Запускает стратегии параллельно и возвращает первый успешный результат.
+
+        Остановить yt-dlp посреди запроса нельзя, поэтому проигравший поток
+        просто дорабатывает в фоне, а его результат отбрасывается.
+        """
+        results = queue.Queue()
+        for strategy in strategies:
+            def run(strategy=strategy):
+                try:
+                    results.put((True, self._run_strategy(strategy, url, proxy, domain, playlist_items)))
+                except Exception as e:
+                    results.put((False, e))
+            threading.Thread(target=run, daemon=True).start()
+
+        last_error = None
+        for _ in strategies:
+            ok, value = results.get()
+            if ok:
+                return value
+            last_error = value
+        raise last_error
+
+    def get_video_info(self, url, proxy=None, playlist_items=None):
+        """Получает информацию о видео с множественными стратегиями обхода блокировки.
+
+        Порядок стратегий берется из истории успехов для этого экстрактора: во время
+        волн бот-проверок не приходится каждый раз ждать таймаут заведомо неудачной попытки.
+        """
+        # Явно переданный прокси используем как есть, иначе берем лучший из пула
+        pooled = proxy is None
+        current_proxy = proxy_pool.acquire('info') if pooled else proxy
         if current_proxy:
-            logger.info(f"Using proxy for get_info: {current_proxy.split('@')[-1]}") 
-            ydl_opts['proxy'] = current_proxy
+            logger.info(f"Using proxy for get_info: {display_proxy(current_proxy)}")
 
-        # Добавляем cookies и параметры защиты
-        ydl_opts = self._get_ydl_opts_with_cookies(ydl_opts)
+        domain = canonicalize(url)[0]
+        order = self.strategy_memory.order(domain, self.INFO_STRATEGIES)
+        last_error = None
 
-        # Попытка 1: С cookies и полными параметрами + прокси если есть
         try:
-            logger.info(f"Attempt 1: Extracting info with cookies")
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                return ydl.extract_info(url, download=False)
-        except Exception as e:
-            logger.warning(f"Attempt 1 failed: {str(e)[:100]}")
+            if INFO_RACE_STRATEGIES and len(order) > 1:
+                try:
+                    return self._race_strategies(order[:2], url, current_proxy, domain, playlist_items)
+                except Exception as e:
+                    last_error = e
+                    order = order[2:]
+
+            for strategy in order:
+                if last_error is not None:
+                    error_class = classify_error(last_error)
+                    # Удаленное/приватное/неподдерживаемое видео другие стратегии не спасут
+                    if error_class in PERMANENT_ERROR_CLASSES:
+                        break
+                    # Прокси получил капчу или 429 — следующую стратегию пробуем через другой
+                    if pooled and current_proxy and error_class in PROXY_ERROR_CLASSES:
+                        proxy_pool.release(current_proxy)
+                        current_proxy = proxy_pool.acquire('info', exclude=current_proxy)
+                try:
+                    return self._run_strategy(strategy, url, current_proxy, domain, playlist_items)
+                except Exception as e:
+                    last_error = e
+        finally:
+            if pooled:
+                proxy_pool.release(current_proxy)
+
+        logger.error(f"All attempts failed. Last error: {last_error}")
+        raise last_error
+
+    def lookup_info(self, url, playlist_items=None):
+        """get_video_info с объединением одновременных запросов одной ссылки и кэшем недавних ошибок."""
+        key = f'{canonical_key(url)}#{playlist_items}' if playlist_items else canonical_key(url)
+        with self.info_lock:
+            cached_error = self.info_errors.get(key)
+            if cached_error:
+                if cached_error['expires'] > time.time():
+                    raise InfoLookupError(cached_error['message'], cached_error['class'])
+                del self.info_errors[key]
+            flight = self.info_flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = {'event': threading.Event(), 'result': None, 'error': None}
+                self.info_flights[key] = flight
+
+        if not is_leader:
+            # Ждем результат уже идущего запроса вместо повторного запуска yt-dlp
+            if not flight['event'].wait(INFO_LOOKUP_TIMEOUT):
+                raise InfoLookupError('lookup timed out', 'network')
+            if flight['error']:
+                raise flight['error']
+            return flight['result']
 
-        # Попытка 2: Без некоторых параметров которые могут вызвать проблемы
         try:
-            logger.info(f"Attempt 2: Extracting info with reduced options")
-            ydl_opts_reduced = {
-                'quiet': True,
-                'extract_flat': 'in_playlist',
-                'socket_timeout': 30,
-            }
-            if current_proxy:
-                ydl_opts_reduced['proxy'] = current_proxy
-            
-            # Хороший User-Agent
-            ydl_opts_reduced['http_headers'] = ydl_opts.get('http_headers', {})
-            
-            with yt_dlp.YoutubeDL(ydl_opts_reduced) as ydl:
-                return ydl.extract_info(url, download=False)
+            flight['result'] = self.get_video_info(url, playlist_items=playlist_items)
+            return flight['result']
         except Exception as e:
-            logger.warning(f"Attempt 2 failed: {str(e)[:100]}")
-
-        # Попытка 3: Минимальные параметры 
+            error_class = classify_error(e)
+            flight['error'] = InfoLookupError(str(e), error_class)
+            ttl = INFO_NEGATIVE_TTL.get(error_class, 0)
+            if ttl:
+                now = time.time()
+                with self.info_lock:
+                    self.info_errors.pop(key, None)
+                    self.info_errors[key] = {'class': error_class, 'message': str(e), 'expires': now + ttl}
+                    while len(self.info_errors) > INFO_NEGATIVE_MAX:
+                        self.info_errors.popitem(last=False)
+            raise flight['error']
+        finally:
+            with self.info_lock:
+                self.info_flights.pop(key, None)
+            flight['event'].set()
+
+    def open_stream(self, task_id, url, quality, limit_height, ratelimit, user=None):
+        """Потоковый режим: выбирает форматы и начинает отдачу, не дожидаясь скачивания файла целиком.
+
+        Возвращает (MediaStream, имя файла для пользователя, info). Ошибки до первых
+        байтов поднимаются исключением, чтобы клиент получил нормальный ответ об ошибке.
+        Место в лимите потоков (claim_stream) освобождается здесь же, когда поток закрыт.
+        """
+        # Ссылки YouTube на медиа привязаны к IP, поэтому и информация, и сами байты идут через один прокси
+        proxy = proxy_pool.acquire('download')
         try:
-            logger.info(f"Attempt 3: Extracting info with minimal options")
-            ydl_opts_minimal = {
-                'quiet': True,
-                'extract_flat': 'in_playlist',
-            }
-            if current_proxy:
-                ydl_opts_minimal['proxy'] = current_proxy
-            
-            with yt_dlp.YoutubeDL(ydl_opts_minimal) as ydl:
-                return ydl.extract_info(url, download=False)
+            if not proxy_supported(proxy):
+                raise ValueError(f'Streaming through {display_proxy(proxy)} is not supported')
+            opts = {'quiet': True}
+            if proxy:
+                opts['proxy'] = proxy
+            opts = self._get_ydl_opts_with_cookies(opts)
+            cookiefile = opts.get('cookiefile')
+            with self.ydl_pool.checkout('stream', opts, {'format': self.build_format_selector(quality, limit_height)},
+                                        generation=cookie_manager.version(cookiefile)) as ydl:
+                info = ydl.extract_info(url, download=False)
+            if info.get('_type') == 'playlist':
+                raise ValueError('Playlists cannot be streamed')
         except Exception as e:
-            logger.error(f"All attempts failed. Last error: {e}")
-            raise e
+            proxy_pool.record(proxy, False, classify_error(e))
+            proxy_pool.release(proxy)
+            self.release_stream()
+            raise
+
+        # Поток открывает по соединению на дорожку — они учитываются в общем бюджете соединений.
+        # Ждать места здесь нельзя (клиент ждет ответа), поэтому при нехватке — отказ
+        formats = info.get('requested_formats') or [info]
+        if not fragment_connections.try_acquire(len(formats)):
+            proxy_pool.release(proxy)
+            self.release_stream()
+            raise ConnectionsBusyError()
+
+        # Байты потока тоже идут через общий распределитель полосы, в доле того же пользователя
+        flow = bandwidth.open('free' if ratelimit else 'premium', user or task_id) if bandwidth.enabled else None
+
+        def finish(stream):
+            proxy_pool.release(proxy)
+            self.release_stream()
+            fragment_connections.release(len(formats))
+            if flow:
+                flow.close()
+            if stream.complete:
+                task_manager.update_task(task_id, status='finished', progress=100)
+            elif stream.error:
+                proxy_pool.record(proxy, False, classify_error(stream.error))
+                task_manager.update_task(task_id, status='error', error=get_friendly_error(stream.error))
+            else:
+                task_manager.update_task(task_id, status='error', error='Передача прервана')
 
-    def calculate_sizes(self, info, is_premium=False):
-        formats = info.get('formats', [])
-        duration = info.get('duration')
-        
-        # Находим максимальное доступное разрешение видео
-        max_height = 0
-        for f in formats:
-            h = f.get('height')
-            if h:
-                try: max_height = max(max_height, int(h))
-                except: pass
-
-        try: duration = float(duration) if duration else 0
-        except: duration = 0
-        
-        def get_size(f):
-            size = f.get('filesize') or f.get('filesize_approx')
-            if size: return size
-            if duration:
-                tbr = f.get('tbr')
-                if tbr: return int(tbr * 1000 / 8 * duration)
-                # Если нет общего битрейта, пробуем сложить видео + аудио
-                vbr = f.get('vbr')
-                abr = f.get('abr')
-                if vbr:
-                    return int((vbr + (abr or 0)) * 1000 / 8 * duration)
-            return 0
-
-        audio_size = 0
-        for f in formats:
-            if f.get('acodec') != 'none' and f.get('vcodec') == 'none':
-                audio_size = max(audio_size, get_size(f))
-        
-        def calc_total_size(height, prefer_mp4=True):
-            best_premerged = 0
-            # Ищем готовый файл (видео+аудио)
-            for f in formats:
-                h = f.get('height', 0) or 0
-                try: h = int(h)
-                except: h = 0
-                
-                # Если предпочитаем MP4, штрафуем другие форматы (игнорируем их для расчета "Best", если есть MP4)
-                if prefer_mp4 and f.get('ext') != 'mp4' and f.get('ext') != 'm4a':
-                    continue
+        stream = MediaStream(formats, proxy=proxy, ratelimit=None if flow else ratelimit,
+                             on_close=finish, throttle=flow.consume if flow else None)
+        task_manager.update_task(task_id, status='streaming')
+        stream.start()
+        download_name = f"{yt_dlp.utils.sanitize_filename(info.get('title') or 'video')}.{stream.ext}"
+        return stream, download_name, info
 
-                if abs(h - height) < 20 and f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                    best_premerged = max(best_premerged, get_size(f))
-            
-            if best_premerged > 0: return best_premerged
-
-            # Если нет готового, считаем сумму потоков (но берем MP4/H264 видео поток, он обычно меньше VP9/AV1 или наоборот, но совместимее)
-            v_size_only = 0
-            for f in formats:
-                h = f.get('height', 0) or 0
-                try: h = int(h)
-                except: h = 0
-                if prefer_mp4 and f.get('ext') != 'mp4': continue # Стараемся найти mp4 поток
-                if abs(h - height) < 20 and f.get('vcodec') != 'none' and f.get('acodec') == 'none':
-                    v_size_only = max(v_size_only, get_size(f))
-            
-            return v_size_only + audio_size if v_size_only > 0 else 0
+    @staticmethod
+    def format_duration(duration, default=''):
+        if not duration:
+            return default
+        try:
+            d = int(duration)
+        except (TypeError, ValueError):
+            return default
+        h = d // 3600
+        m = (d % 3600) // 60
+        s = d % 60
+
+        parts = []
+        if h > 0: parts.append(f"{h} h")
+        if m > 0: parts.append(f"{m} min")
+        if s > 0 or (h==0 and m==0): parts.append(f"{s} sec")
+        return " ".join(parts)
+
+    def video_summary(self, info):
+        """То, что /get_info отдает клиенту об одном ролике (и что хранится в кэше информации)."""
+        return {
+            'title': info.get('title', 'Без названия'),
+            'thumbnail': info.get('thumbnail', ''),
+            'duration': self.format_duration(info.get('duration'), info.get('duration_string', '')),
+            'sizes': self.calculate_sizes(info),
+            # Вся лестница качеств в байтах (144p–4320p и аудио) — кэшируется вместе с остальным
+            'qualities': FormatIndex.for_info(info).ladder()
+        }
+
+    def calculate_sizes(self, info, is_premium=False):
+        # Индекс форматов строится один раз на info и переиспользуется всеми ступенями
+        index = FormatIndex.for_info(info)
 
         def fmt_size(bytes_val):
             if not bytes_val: return "?"
@@ -342,104 +738,192 @@ class DownloadService:
 
         crown = '👑 ' if not is_premium else ''
         sizes = {}
-        sizes['best'] = crown + fmt_size(calc_total_size(max_height) or calc_total_size(1080))
-        sizes['1080'] = crown + fmt_size(calc_total_size(1080))
-        sizes['720'] = fmt_size(calc_total_size(720))
-        sizes['audio'] = fmt_size(audio_size)
+        sizes['best'] = crown + fmt_size(index.total_size(index.max_height) or index.total_size(1080))
+        sizes['1080'] = crown + fmt_size(index.total_size(1080))
+        sizes['720'] = fmt_size(index.total_size(720))
+        sizes['audio'] = fmt_size(index.audio_size)
         return sizes
 
-    def background_download(self, task_id, url, quality, user_id, ratelimit, limit_height, sleep_interval, history_id=None):
+    def estimate_size(self, url, quality, limit_height=None):
+        """Оценка размера файла в байтах по лестнице качеств из кэша информации (None — неизвестно)."""
+        ladder = (task_manager.get_cached_info(url) or {}).get('qualities') or {}
+        if quality == 'audio':
+            sizes = [size for key, size in ladder.items() if key.startswith('audio_')]
+            return max(sizes) if sizes else None
+        cap = int(quality) if str(quality).isdigit() else None
+        if limit_height:
+            cap = min(cap or limit_height, limit_height)
+        heights = [int(key) for key in ladder if key.isdigit() and (cap is None or int(key) <= cap)]
+        return ladder[str(max(heights))] if heights else None
+
+    def download_media(self, url, quality, limit_height, ratelimit, sleep_interval, outtmpl, progress_hook, user=None):
+        """Скачивает один ролик экземпляром YoutubeDL из пула и возвращает (info, путь к файлу).
+
+        Здесь же выбираются прокси и cookies и учитываются их ошибки и скорость. Скорость
+        задает общий распределитель полосы (ratelimit тогда только признак бесплатного
+        тарифа); user — ключ справедливого деления внутри тарифа. Параллельность фрагментов
+        и буфер подбирает контроллер по источнику в пределах общего бюджета соединений.
+        """
+        cookiefile = None
+        tier = 'free' if ratelimit else 'premium'
+        proxy = proxy_pool.acquire('download')
+        flow = bandwidth.open(tier, user) if bandwidth.enabled else None
+        fragments = fragment_tuner.controller(url, proxy, tier, flow)
         try:
-            task_manager.update_task(task_id, status='downloading', progress=0)
-            
-            def progress_hook(d):
-                if d['status'] == 'downloading':
-                    # Очищаем строку процентов от лишних символов и цветов консоли
-                    raw_p = d.get('_percent_str', '0%')
-                    p = re.sub(r'\x1b\[[0-9;]*m', '', raw_p).replace('%','').strip()
-                    
-                    # Очищаем сообщение (ETA) от ANSI кодов
-                    raw_msg = d.get('_eta_str', '') or d.get('_elapsed_str', '')
-                    clean_msg = re.sub(r'\x1b\[[0-9;]*m', '', raw_msg).strip()
-                    task_manager.update_task(task_id, progress=p, message=clean_msg)
-                elif d['status'] == 'finished':
-                    task_manager.update_task(task_id, status='processing', progress='100')
-            
             # Явно ищем FFmpeg в системе
             ffmpeg_path = shutil.which('ffmpeg') or shutil.which('ffmpeg.exe')
 
             ydl_opts = {
-                'outtmpl': f'downloads/{task_id}_%(title)s.%(ext)s',
-                'progress_hooks': [progress_hook],
                 'quiet': True,
                 'merge_output_format': 'mp4', # Принудительно склеивать в MP4 (лучшая совместимость)
+                'continuedl': True,  # Продолжать .part и фрагментные загрузки (манифест .ytdl) после перезапуска
             }
             
             # Если нашли FFmpeg, указываем путь к нему (критично для Render/Windows)
             if ffmpeg_path:
                 ydl_opts['ffmpeg_location'] = ffmpeg_path
 
-            # Используем прокси из .env, если он задан.
-            if PROXY_URL:
-                logger.info(f"Using proxy for download: {PROXY_URL.split('@')[-1]}") # Логируем без пароля
-                ydl_opts['proxy'] = PROXY_URL
+            # Прокси из пула (самый быстрый из исправных)
+            if proxy:
+                logger.info(f"Using proxy for download: {display_proxy(proxy)}") # Логируем без пароля
+                ydl_opts['proxy'] = proxy
 
             # Добавляем cookies и параметры защиты
             ydl_opts = self._get_ydl_opts_with_cookies(ydl_opts)
+            cookiefile = ydl_opts.get('cookiefile')
+
+            # Параметры конкретной задачи накладываются на экземпляр из пула только на время загрузки.
+            # Параллельность фрагментов и буфер — от контроллера (ждет свободного соединения в общем бюджете)
+            overrides = dict(fragments.start(), **{
+                'outtmpl': outtmpl,
+                'progress_hooks': [progress_hook, fragments.hook] + ([flow.hook] if flow else []),
+                'format': self.build_format_selector(quality, limit_height),
+                'ratelimit': None if flow else ratelimit or None,
+                'sleep_interval': sleep_interval or None,
+            })
+            profile = 'audio' if quality == 'audio' else tier
+
+            started = time.monotonic()
+            with self.ydl_pool.checkout(profile, ydl_opts, overrides, generation=cookie_manager.version(cookiefile)) as ydl:
+                fragments.attach(ydl.params)
+                info = ydl.extract_info(url, download=True)
+                filename = ydl.prepare_filename(info)
 
-            # Оптимизация для Premium (ускорение)
-            if not ratelimit:
-                ydl_opts['concurrent_fragment_downloads'] = 5  # Скачивать 5 фрагментов одновременно
-                ydl_opts['buffersize'] = 1024 * 1024  # Увеличенный буфер
+            # Скорость прокси меряем только без ограничения скорости, иначе она ничего не говорит
+            throughput = None
+            elapsed = max(time.monotonic() - started, 0.001)
+            unthrottled = flow.slept < elapsed * 0.05 if flow else not ratelimit
+            if unthrottled and os.path.exists(filename):
+                throughput = os.path.getsize(filename) / elapsed
+            proxy_pool.record(proxy, True, throughput=throughput)
+            return info, filename
+        except Exception as e:
+            cookie_manager.report_failure(cookiefile, classify_error(e))
+            proxy_pool.record(proxy, False, classify_error(e))
+            raise
+        finally:
+            proxy_pool.release(proxy)
+            fragments.close()
+            if flow:
+                flow.close()
 
-            if ratelimit:
-                ydl_opts['ratelimit'] = ratelimit
-            
-            if sleep_interval:
-                ydl_opts['sleep_interval'] = sleep_interval
+    @staticmethod
+    def work_dir(task_id):
+        """Рабочая папка задачи: недокачанные .part, фрагменты с манифестом .ytdl, дорожки до склейки."""
+        return os.path.join(DOWNLOAD_FOLDER, task_id)
 
-            # Приоритет аудио m4a (AAC) для лучшей совместимости с MP4
-            audio_q = 'bestaudio[ext=m4a]/bestaudio'
+    @staticmethod
+    def _load_checkpoint(work_dir):
+        try:
+            with open(os.path.join(work_dir, DOWNLOAD_CHECKPOINT), 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return checkpoint if os.path.isfile(checkpoint.get('filename') or '') else None
 
-            # Логика выбора формата
-            if quality == 'audio':
-                ydl_opts['format'] = 'bestaudio/best'
+    @staticmethod
+    def _save_checkpoint(work_dir, info, filename):
+        checkpoint = {'filename': filename, 'title': info.get('title'), 'extractor_key': info.get('extractor_key'),
+                      'id': info.get('id'), 'format_id': info.get('format_id')}
+        try:
+            with open(os.path.join(work_dir, DOWNLOAD_CHECKPOINT), 'w', encoding='utf-8') as f:
+                json.dump(checkpoint, f, ensure_ascii=False)
+        except OSError as e:
+            logger.warning(f"Checkpoint save error: {e}")
+
+    def background_download(self, task_id, url, quality, user_id, ratelimit, limit_height, sleep_interval, history_id=None, estimate=None):
+        work_dir = self.work_dir(task_id)
+        # После перезапуска задачи нет в inflight: возвращаем ее туда с присоединившимися из сохраненного состояния
+        self.resume_inflight(task_id, url, quality, limit_height, ratelimit)
+        try:
+            # Место на диске резервируется до старта; если его нет, задача ждет, пока освободится
+            if not storage.reserve(task_id, estimate, timeout=STORAGE_WAIT_TIMEOUT):
+                raise StorageFullError()
+            # Папка уже есть — задачу подняли после перезапуска: yt-dlp продолжит .part и фрагменты
+            # с последнего сохраненного (continuedl), а готовые дорожки и склеенный файл скачивать не будет
+            resumed = os.path.isdir(work_dir) and bool(os.listdir(work_dir))
+            os.makedirs(work_dir, exist_ok=True)
+            task_manager.update_task(task_id, status='downloading', progress=0, resumed=resumed)
+            checkpoint = self._load_checkpoint(work_dir) if resumed else None
+            if checkpoint:
+                # Файл был полностью готов до перезапуска — повторно ничего не качаем
+                logger.info(f"Task {task_id}: download already completed before restart")
+                info, filename = checkpoint, checkpoint['filename']
             else:
-                if limit_height:
-                    # Пытаемся скачать видео+аудио, если не выйдет - лучший одиночный файл
-                    ydl_opts['format'] = f'bestvideo[height<={limit_height}]+{audio_q}/best[height<={limit_height}]/best'
-                elif quality == '1080':
-                    ydl_opts['format'] = f'bestvideo[height<=1080]+{audio_q}/best[height<=1080]/best'
-                elif quality == '720':
-                    ydl_opts['format'] = f'bestvideo[height<=720]+{audio_q}/best[height<=720]/best'
-                else:
-                    ydl_opts['format'] = f'bestvideo+{audio_q}/best'
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
+                if resumed:
+                    logger.info(f"Task {task_id}: resuming download in {work_dir}")
+                info, filename = self.download_media(url, quality, limit_height, ratelimit, sleep_interval,
+                                                     os.path.join(work_dir, '%(title)s.%(ext)s'), ProgressReporter(task_id),
+                                                     user=user_id or task_id)
+                self._save_checkpoint(work_dir, info, filename)
             
-            # Update title in history
-            if history_id:
+            # Update title in history (своя запись и записи присоединившихся пользователей)
+            followers = self.leave_inflight(task_id)
+            history_ids = [h for h in [history_id] + [f_hid for _, f_hid in followers] if h]
+            if history_ids:
                  try:
                     with get_db() as conn:
-                        conn.execute('UPDATE history SET title = ? WHERE id = ?', (info.get('title', 'Video'), history_id))
+                        conn.executemany('UPDATE history SET title = ? WHERE id = ?', [(info.get('title', 'Video'), h) for h in history_ids])
                         conn.commit()
                  except Exception as e:
                      logger.error(f"History update error: {e}")
             
-            task_manager.update_task(task_id, status='finished', filename=filename, download_name=os.path.basename(filename))
+            download_name = os.path.basename(filename)
+
+            # Кладем готовый файл в кэш, чтобы следующий такой же запрос завершился мгновенно
+            cache_key = None
+            try:
+                content_key = media_cache.content_key(info.get('extractor_key'), info.get('id'), info.get('format_id'))
+                entry = media_cache.put(self.request_key(url, quality, limit_height), content_key, filename, download_name, info.get('title'),
+                                        task_id=task_id)
+                if entry:
+                    filename, cache_key = entry['path'], entry['key']
+            except OSError as e:
+                logger.warning(f"Media cache put error: {e}")
+            if cache_key:
+                # Файл перенесен в кэш, у которого свой бюджет; рабочая папка больше не нужна
+                storage.discard(task_id, work_dir)
+            else:
+                storage.commit(task_id, work_dir)
+
+            task_manager.update_task(task_id, status='finished', filename=filename, download_name=download_name, cache_key=cache_key)
             
         except Exception as e:
             logger.error(f"Download error: {e}")
-            task_manager.update_task(task_id, status='error', error=str(e))
+            # Задача завершилась ошибкой (не перезапуском) — продолжать ее некому, остатки не нужны
+            storage.discard(task_id, work_dir)
+            # Подписчики получают статус сразу, поэтому сырой текст ошибки yt-dlp в задачу не пишем
             task_manager.update_task(task_id, status='error', error=get_friendly_error(e))
-            # Если ошибка - удаляем из истории, чтобы не тратить лимит пользователя
-            if history_id:
+            # Если ошибка - удаляем из истории, чтобы не тратить лимит пользователя (и присоединившихся тоже)
+            followers = self.leave_inflight(task_id)
+            history_ids = [h for h in [history_id] + [f_hid for _, f_hid in followers] if h]
+            if history_ids:
                 try:
                     with get_db() as conn:
-                        conn.execute('DELETE FROM history WHERE id = ?', (history_id,))
+                        conn.executemany('DELETE FROM history WHERE id = ?', [(h,) for h in history_ids])
                         conn.commit()
                 except Exception: pass
                 
 download_service = DownloadService()
+
+download_scheduler.register('download', download_service.background_download)
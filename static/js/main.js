@@ -14,7 +14,7 @@ window.translations = {
         clearHistoryConfirm: 'Вы уверены, что хотите очистить всю историю скачиваний?', deleteNotifConfirm: 'Удалить уведомление из истории?',
         btnDownload: 'Сохранить файл', btnShare: 'Поделиться', btnGetPremium: 'Купить Premium', btnPremiumActive: 'Premium Активен',
         qualityBest: 'Лучшее (MP4)', quality1080: '1080p (MP4)', quality720: '720p (MP4)', qualityAudio: 'Аудио (MP3)',
-        statusDownloading: 'Скачивание...', statusProcessing: 'Обработка и склеивание...', statusFinished: 'Готово!', statusError: 'Ошибка при скачивании: ',
+        statusQueued: 'В очереди', statusDownloading: 'Скачивание...', statusProcessing: 'Обработка и склеивание...', statusFinished: 'Готово!', statusError: 'Ошибка при скачивании: ',
         searching: 'Поиск...', btnYes: 'Да', btnNo: 'Нет', resetSettingsConfirm: 'Сбросить все настройки и перезагрузить?',
         currency: '₽', priceMonth: '199', priceYear: '500',
         // Premium Cards
@@ -40,7 +40,7 @@ window.translations = {
         clearHistoryConfirm: 'Are you sure you want to clear download history?', deleteNotifConfirm: 'Delete notification from history?',
         btnDownload: 'Save file', btnShare: 'Share', btnGetPremium: 'Get Premium', btnPremiumActive: 'Premium Active',
         qualityBest: 'Best (MP4)', quality1080: '1080p (MP4)', quality720: '720p (MP4)', qualityAudio: 'Audio (MP3)',
-        statusDownloading: 'Downloading...', statusProcessing: 'Processing and merging...', statusFinished: 'Done!', statusError: 'Download error: ',
+        statusQueued: 'In queue', statusDownloading: 'Downloading...', statusProcessing: 'Processing and merging...', statusFinished: 'Done!', statusError: 'Download error: ',
         searching: 'Searching...', btnYes: 'Yes', btnNo: 'No', resetSettingsConfirm: 'Reset all settings and reload?',
         currency: '$', priceMonth: '3', priceYear: '6',
         // Premium Cards
@@ -66,7 +66,7 @@ window.translations = {
         clearHistoryConfirm: 'Сиз жүктөө тарыхын тазалоону каалайсызбы?', deleteNotifConfirm: 'Билдирүүнү тарыхтан өчүрүү?',
         btnDownload: 'Файлды сактоо', btnShare: 'Бөлүшүү', btnGetPremium: 'Premium алуу', btnPremiumActive: 'Premium Активдүү',
         qualityBest: 'Мыкты (MP4)', quality1080: '1080p (MP4)', quality720: '720p (MP4)', qualityAudio: 'Аудио (MP3)',
-        statusDownloading: 'Жүктөлүүдө...', statusProcessing: 'Иштеп чыгуу жана бириктирүү...', statusFinished: 'Даяр!', statusError: 'Жүктөө катасы: ',
+        statusQueued: 'Кезекте', statusDownloading: 'Жүктөлүүдө...', statusProcessing: 'Иштеп чыгуу жана бириктирүү...', statusFinished: 'Даяр!', statusError: 'Жүктөө катасы: ',
         searching: 'Издөө...', btnYes: 'Ооба', btnNo: 'Жок', resetSettingsConfirm: 'Бардык жөндөөлөрдү тазалап, кайра жүктөйбүзбү?',
         currency: 'сом', priceMonth: '200', priceYear: '500',
         // Premium Cards
@@ -98,6 +98,21 @@ const Utils = {
         if (classes) el.className = classes;
         if (text) el.textContent = text;
         return el;
+    },
+
+    // Сервер присылает прогресс числами — форматируем здесь
+    formatBytes: (bytes) => {
+        if (!bytes) return '';
+        const units = ['B', 'KB', 'MB', 'GB'];
+        let i = 0;
+        while (bytes >= 1024 && i < units.length - 1) { bytes /= 1024; i++; }
+        return `${bytes.toFixed(i > 1 ? 1 : 0)} ${units[i]}`;
+    },
+
+    formatEta: (sec) => {
+        if (sec === null || sec === undefined) return '';
+        const m = Math.floor(sec / 60), s = Math.floor(sec % 60);
+        return `${m}:${String(s).padStart(2, '0')}`;
     }
 };
 
@@ -551,11 +566,16 @@ function createSnowflake(isInit = false) {
 }
 
 // --- WEBSOCKETS ---
+let appSocket = null;
 try {
     const socket = io();
+    appSocket = socket;
     socket.on('connect', () => {
         checkUnreadStatus();
+        // После переподключения комнаты теряются — подписываемся на задачу заново
+        if (VideoDownloader.progressInterval) VideoDownloader.subscribeTask();
     });
+    socket.on('task_progress', (data) => VideoDownloader.onTaskEvent(data));
     socket.on('new_notification', (data) => {
         showToast('📢 ' + data.message);
         const badge = document.getElementById('notifBadge');
@@ -594,6 +614,10 @@ const VideoDownloader = {
         const url = document.getElementById('urlInput').value;
         if (!url) return showToast('Введите ссылку!', true);
 
+        // Несколько ссылок сразу — отправляем одним пакетом
+        const urls = url.split(/[\s,]+/).filter(u => /^https?:\/\//.test(u));
+        if (urls.length > 1) return this.startBatch(urls);
+
         this.resetUI(true); // Скрыть старые результаты
 
         const btn = document.getElementById('searchBtn');
@@ -675,6 +699,7 @@ const VideoDownloader = {
         
         const container = document.getElementById('buttonsContainer');
         container.innerHTML = '';
+        this.streamQualities = data.stream_qualities || [];
         
         const labels = { 'best': t.qualityBest, '1080': t.quality1080, '720': t.quality720, 'audio': t.qualityAudio };
         ['best', '1080', '720', 'audio'].forEach(key => {
@@ -682,21 +707,23 @@ const VideoDownloader = {
                 const button = document.createElement('button');
                 button.className = 'btn btn-outline-primary quality-btn';
                 button.innerHTML = `${labels[key] || key}<br><small style="opacity:0.7">${data.sizes[key]}</small>`;
-                button.onclick = () => this.startDownload(url, key);
+                button.onclick = () => this.startDownload(url, key, data.is_playlist);
                 container.appendChild(button);
             }
         });
 
         if (data.is_playlist && data.entries) {
-            this.renderPlaylist(data.entries);
+            this.renderPlaylist(data, url);
         }
 
         document.getElementById('videoInfo').style.display = 'block';
     },
 
-    renderPlaylist(entries) {
+    renderPlaylist(data, url) {
         const plContainer = document.getElementById('playlistContainer');
         plContainer.innerHTML = '';
+        this.playlistUrl = url;
+        clearTimeout(this.enrichTimer);
         
         const card = Utils.createElement('div', 'card bg-dark border-secondary shadow-sm');
         const header = Utils.createElement('div', 'card-header border-secondary text-center text-white-50 small fw-bold text-uppercase py-2', 'Содержимое плейлиста');
@@ -705,43 +732,110 @@ const VideoDownloader = {
         const list = Utils.createElement('div', 'list-group list-group-flush');
         list.style.maxHeight = '400px';
         list.style.overflowY = 'auto';
+        this.playlistList = list;
+
+        // Следующая страница списка подгружается по кнопке
+        const moreBtn = Utils.createElement('button', 'btn btn-sm btn-outline-secondary m-2', 'Показать ещё');
+        moreBtn.onclick = () => this.loadPlaylistPage(this.playlistNextCursor);
+        this.playlistMoreBtn = moreBtn;
+
+        card.append(header, list, moreBtn);
+        plContainer.appendChild(card);
+        plContainer.style.display = 'block';
+        this.appendPlaylistPage({ cursor: 1, ...data });
+    },
 
-        entries.forEach((entry, index) => {
+    appendPlaylistPage(page) {
+        page.entries.forEach(entry => {
             const item = Utils.createElement('div', 'list-group-item bg-transparent text-light border-secondary d-flex flex-column flex-sm-row justify-content-sm-center align-items-sm-center gap-2 py-3');
             
             const infoDiv = Utils.createElement('div', 'd-flex align-items-center text-truncate me-2');
             infoDiv.style.flex = '1';
             
-            const badge = Utils.createElement('span', 'badge bg-secondary bg-opacity-25 text-secondary me-3 rounded-pill', index + 1);
+            const badge = Utils.createElement('span', 'badge bg-secondary bg-opacity-25 text-secondary me-3 rounded-pill', entry.index);
             badge.style.minWidth = '25px';
             
+            const textDiv = Utils.createElement('div', 'd-flex flex-column text-truncate');
             const title = Utils.createElement('span', 'text-truncate small fw-medium', entry.title);
             title.title = entry.title; // Tooltip
+            const meta = Utils.createElement('span', 'text-white-50', '');
+            meta.style.fontSize = '0.75rem';
+            meta.dataset.entryIndex = entry.index;
+            textDiv.append(title, meta);
 
-            infoDiv.append(badge, title);
+            infoDiv.append(badge, textDiv);
 
             const btnGroup = Utils.createElement('div', 'd-flex gap-2 shrink-0 justify-content-end');
-            const singleUrl = `https://www.youtube.com/watch?v=${entry.id}`;
             
             const btnMp4 = Utils.createElement('button', 'btn btn-sm btn-outline-info');
             btnMp4.innerHTML = '<i class="bi bi-camera-video"></i> MP4';
-            btnMp4.onclick = () => this.startDownload(singleUrl, 'best');
+            btnMp4.onclick = () => this.startDownload(entry.url, 'best');
 
             const btnMp3 = Utils.createElement('button', 'btn btn-sm btn-outline-success');
             btnMp3.innerHTML = '<i class="bi bi-music-note-beamed"></i> MP3';
-            btnMp3.onclick = () => this.startDownload(singleUrl, 'audio');
+            btnMp3.onclick = () => this.startDownload(entry.url, 'audio');
 
             btnGroup.append(btnMp4, btnMp3);
             item.append(infoDiv, btnGroup);
-            list.appendChild(item);
+            this.playlistList.appendChild(item);
         });
+        this.updatePlaylistMeta(page.entries);
 
-        card.append(header, list);
-        plContainer.appendChild(card);
-        plContainer.style.display = 'block';
+        this.playlistNextCursor = page.next_cursor;
+        this.playlistMoreBtn.style.display = page.next_cursor ? 'block' : 'none';
+        this.pollPlaylistEnrichment(page.cursor, page.entries, 0);
+    },
+
+    updatePlaylistMeta(entries) {
+        entries.forEach(entry => {
+            const meta = this.playlistList.querySelector(`[data-entry-index="${entry.index}"]`);
+            if (!meta) return;
+            const sizes = entry.sizes || {};
+            meta.innerText = [entry.duration, sizes['720'] || sizes.best, entry.pending ? '…' : ''].filter(Boolean).join(' · ');
+        });
+    },
+
+    pollPlaylistEnrichment(cursor, entries, attempt) {
+        // Длительность и размеры дополняются на сервере в фоне — перезапрашиваем страницу, пока они не готовы
+        if (!entries.some(e => e.pending) || attempt >= 10) return;
+        const url = this.playlistUrl;
+        this.enrichTimer = setTimeout(async () => {
+            try {
+                const page = await this.fetchPlaylistPage(url, cursor);
+                if (url !== this.playlistUrl || page.error) return;
+                this.updatePlaylistMeta(page.entries);
+                this.pollPlaylistEnrichment(cursor, page.entries, attempt + 1);
+            } catch (e) { console.error(e); }
+        }, 3000);
     },
 
-    async startDownload(url, quality) {
+    async fetchPlaylistPage(url, cursor) {
+        const formData = new FormData();
+        formData.append('url', url);
+        formData.append('cursor', cursor);
+        const res = await fetch('/playlist_page', {
+            method: 'POST',
+            body: formData,
+            headers: { 'X-CSRFToken': Utils.getCsrfToken() }
+        });
+        return res.json();
+    },
+
+    async loadPlaylistPage(cursor) {
+        if (!cursor) return;
+        this.playlistMoreBtn.disabled = true;
+        try {
+            const page = await this.fetchPlaylistPage(this.playlistUrl, cursor);
+            if (page.error) showToast(page.error, true);
+            else this.appendPlaylistPage(page);
+        } catch (e) {
+            showToast('Ошибка: ' + e, true);
+        } finally {
+            this.playlistMoreBtn.disabled = false;
+        }
+    },
+
+    async startDownload(url, quality, playlist = false) {
         document.getElementById('buttonsContainer').style.pointerEvents = 'none';
         document.getElementById('buttonsContainer').style.opacity = '0.5';
         document.getElementById('progress-section').style.display = 'block';
@@ -749,6 +843,11 @@ const VideoDownloader = {
         const formData = new FormData();
         formData.append('url', url);
         formData.append('quality', quality);
+        // Качества из stream_qualities (/get_info) сервер может отдавать во время скачивания;
+        // остальные идут через очередь и кэш сервера
+        if (!playlist && (this.streamQualities || []).includes(quality)) formData.append('mode', 'stream');
+        // Плейлист скачивается целиком и отдается ZIP-архивом по мере готовности роликов
+        if (playlist) formData.append('playlist', '1');
 
         try {
             const response = await fetch('/start_download', { 
@@ -765,7 +864,17 @@ const VideoDownloader = {
 
             const data = await response.json();
 
-            if (response.ok) {
+            if (response.ok && data.zip_url) {
+                // Архив начинает качаться сразу, прогресс по роликам показываем параллельно
+                this.currentTaskId = data.task_id;
+                this.trackProgress();
+                this.showDownloadLink(data.zip_url, true);
+                setTimeout(() => this.updateLimitUI(), 1000);
+            } else if (response.ok && data.stream_url) {
+                this.currentTaskId = data.task_id;
+                this.showDownloadLink(data.stream_url);
+                setTimeout(() => this.updateLimitUI(), 1000);
+            } else if (response.ok) {
                 this.currentTaskId = data.task_id;
                 this.trackProgress();
                 setTimeout(() => this.updateLimitUI(), 1000); // Обновляем лимит сразу после старта
@@ -779,46 +888,150 @@ const VideoDownloader = {
         }
     },
 
+    async startBatch(urls) {
+        this.resetUI(true);
+        document.getElementById('progress-section').style.display = 'block';
+        try {
+            const response = await fetch('/batch', {
+                method: 'POST',
+                body: JSON.stringify({ urls, quality: lastAuthData.isPremium ? 'best' : '720' }),
+                headers: { 'Content-Type': 'application/json', 'X-CSRFToken': Utils.getCsrfToken() }
+            });
+            const data = await response.json();
+            if (!response.ok) {
+                showToast('Ошибка старта: ' + data.error, true);
+                return this.resetUI();
+            }
+            // Группа — обычная задача: один опрос/подписка на весь пакет
+            this.currentTaskId = data.group_id;
+            this.trackProgress();
+            setTimeout(() => this.updateLimitUI(), 1000);
+        } catch (e) {
+            showToast('Ошибка: ' + e, true);
+            this.resetUI();
+        }
+    },
+
+    renderBatchLinks(items) {
+        const plContainer = document.getElementById('playlistContainer');
+        plContainer.innerHTML = '';
+        const list = Utils.createElement('div', 'list-group');
+        items.forEach(item => {
+            const row = Utils.createElement('div', 'list-group-item bg-transparent text-light border-secondary d-flex justify-content-between align-items-center gap-2');
+            const title = Utils.createElement('span', 'text-truncate small', item.title || item.url);
+            title.title = item.url;
+            row.appendChild(title);
+            if (item.status === 'finished') {
+                const link = Utils.createElement('a', 'btn btn-sm btn-success shrink-0');
+                link.innerHTML = '<i class="bi bi-download"></i>';
+                link.href = `/get_file/${item.task_id}`;
+                row.appendChild(link);
+            } else {
+                row.appendChild(Utils.createElement('span', 'small text-danger shrink-0', item.error || ''));
+            }
+            list.appendChild(row);
+        });
+        plContainer.appendChild(list);
+        plContainer.style.display = 'block';
+        document.getElementById('progress-section').style.display = 'none';
+    },
+
     trackProgress() {
-        const t = window.translations[window.appSettings.lang] || window.translations['ru'];
         if (this.progressInterval) clearInterval(this.progressInterval);
-        
+        this.taskState = {};
+        this.taskIds = [this.currentTaskId];
+        this.lastSync = 0;
+        this.subscribeTask();
+
+        // Запасной вариант: опрос, если Socket.IO недоступен или давно не было событий
         this.progressInterval = setInterval(async () => {
+            const pushActive = appSocket && appSocket.connected && this.taskIds.length > 0;
+            if (pushActive && Date.now() - this.lastSync < 15000) return;
             try {
                 const res = await fetch(`/progress/${this.currentTaskId}`);
-                const data = await res.json();
-                const bar = document.getElementById('progressBar');
-                const statusText = document.getElementById('statusText');
-                const percentText = document.getElementById('percentText');
-
-                if (data.status === 'downloading') {
-                    bar.style.width = data.progress + '%';
-                    bar.className = 'progress-bar progress-bar-striped progress-bar-animated';
-                    statusText.innerText = (data.message && /\d/.test(data.message)) ? `${t.statusDownloading} (${data.message})` : t.statusDownloading;
-                    percentText.innerText = Math.round(parseFloat(data.progress)) + '%';
-                } else if (data.status === 'processing') {
-                    bar.style.width = '100%';
-                    bar.className = 'progress-bar progress-bar-striped progress-bar-animated bg-warning';
-                    statusText.innerText = t.statusProcessing;
-                    percentText.innerText = '100%';
-                } else if (data.status === 'finished') {
-                    clearInterval(this.progressInterval);
-                    bar.className = 'progress-bar bg-success';
-                    statusText.innerText = t.statusFinished;
-                    document.getElementById('downloadBtn').href = `/get_file/${this.currentTaskId}`;
-                    if (navigator.share) document.getElementById('shareBtn').style.display = 'block';
-                    document.getElementById('progress-section').style.display = 'none';
-                    document.getElementById('download-section').style.display = 'block';
-                    VideoDownloader.updateLimitUI(); // Обновляем лимит
-                } else if (data.status === 'error') {
-                    clearInterval(this.progressInterval);
-                    showToast(t.statusError + data.error, true);
-                    this.resetUI();
-                }
+                this.taskState = await res.json();
+                this.lastSync = Date.now();
+                this.renderProgress(this.taskState);
             } catch (e) { console.error(e); }
         }, 1000);
     },
 
+    subscribeTask() {
+        if (!appSocket || !appSocket.connected || !this.currentTaskId) return;
+        const taskId = this.currentTaskId;
+        appSocket.emit('subscribe_task', { task_id: taskId }, (task) => {
+            if (!task || task.error || taskId !== this.currentTaskId) return;
+            this.taskState = task;
+            this.taskIds = [taskId, task.leader_id].filter(Boolean);
+            this.lastSync = Date.now();
+            this.renderProgress(this.taskState);
+        });
+    },
+
+    onTaskEvent(data) {
+        // События приходят только измененными полями — накладываем их на известное состояние
+        if (!this.progressInterval || !this.taskIds || !this.taskIds.includes(data.task_id)) return;
+        const { task_id, ...fields } = data;
+        Object.assign(this.taskState, fields);
+        this.lastSync = Date.now();
+        this.renderProgress(this.taskState);
+    },
+
+    stopTracking() {
+        clearInterval(this.progressInterval);
+        this.progressInterval = null;
+    },
+
+    renderProgress(data) {
+        const t = window.translations[window.appSettings.lang] || window.translations['ru'];
+        const bar = document.getElementById('progressBar');
+        const statusText = document.getElementById('statusText');
+        const percentText = document.getElementById('percentText');
+
+        if (data.status === 'queued') {
+            bar.style.width = '0%';
+            bar.className = 'progress-bar progress-bar-striped progress-bar-animated bg-secondary';
+            statusText.innerText = data.queue_position ? `${t.statusQueued} (#${data.queue_position})` : t.statusQueued;
+            percentText.innerText = '0%';
+        } else if (data.status === 'downloading') {
+            bar.style.width = data.progress + '%';
+            bar.className = 'progress-bar progress-bar-striped progress-bar-animated';
+            const details = data.total
+                ? `${(data.done || 0) + (data.failed || 0)}/${data.total}`
+                : [data.speed ? Utils.formatBytes(data.speed) + '/s' : '', Utils.formatEta(data.eta)].filter(Boolean).join(', ');
+            statusText.innerText = details ? `${t.statusDownloading} (${details})` : t.statusDownloading;
+            percentText.innerText = Math.round(parseFloat(data.progress) || 0) + '%';
+        } else if (data.status === 'processing') {
+            bar.style.width = '100%';
+            bar.className = 'progress-bar progress-bar-striped progress-bar-animated bg-warning';
+            statusText.innerText = t.statusProcessing;
+            percentText.innerText = '100%';
+        } else if (data.status === 'finished' && data.mode === 'batch') {
+            if (!this.progressInterval) return;
+            this.stopTracking();
+            this.renderBatchLinks(data.items || []);
+        } else if (data.status === 'finished') {
+            if (!this.progressInterval) return;
+            this.stopTracking();
+            bar.className = 'progress-bar bg-success';
+            statusText.innerText = t.statusFinished;
+            this.showDownloadLink(`/get_file/${this.currentTaskId}`);
+            VideoDownloader.updateLimitUI(); // Обновляем лимит
+        } else if (data.status === 'error') {
+            if (!this.progressInterval) return;
+            this.stopTracking();
+            showToast(t.statusError + data.error, true);
+            this.resetUI();
+        }
+    },
+
+    showDownloadLink(href, keepProgress = false) {
+        document.getElementById('downloadBtn').href = href;
+        if (navigator.share) document.getElementById('shareBtn').style.display = 'block';
+        if (!keepProgress) document.getElementById('progress-section').style.display = 'none';
+        document.getElementById('download-section').style.display = 'block';
+    },
+
     resetUI(full = false) {
         document.getElementById('buttonsContainer').style.pointerEvents = 'auto';
         document.getElementById('buttonsContainer').style.opacity = '1';
@@ -860,7 +1073,7 @@ const VideoDownloader = {
 
 // Экспорт функций для HTML обработчиков
 window.getInfo = () => VideoDownloader.getInfo();
-window.startDownload = (u, q) => VideoDownloader.startDownload(u, q);
+window.startDownload = (u, q, p) => VideoDownloader.startDownload(u, q, p);
 
 // --- Функция "Поделиться" ---
 window.shareFile = async function() {
@@ -879,7 +1092,7 @@ window.shareFile = async function() {
         let filename = 'video_download';
 
         // Если ссылка ведет на сервер, скачиваем файл в память
-        if (url.includes('/get_file/')) {
+        if (url.includes('/get_file/') || url.includes('/stream/')) {
             const res = await fetch(url);
             if (!res.ok) throw new Error('Файл недоступен (возможно, уже скачан)');
             blob = await res.blob();
@@ -0,0 +1,274 @@
+import os
+import time
+import glob
+import shutil
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Сколько места на диске можно занять рабочими файлами загрузок (кэш готовых файлов — отдельный бюджет)
+STORAGE_BUDGET_BYTES = int(os.getenv('STORAGE_BUDGET_BYTES', 8 * 1024 ** 3))
+# Сколько резервировать, если размер ролика заранее неизвестен
+STORAGE_DEFAULT_ESTIMATE = int(os.getenv('STORAGE_DEFAULT_ESTIMATE', 300 * 1024 ** 2))
+# Сколько хранить готовый файл, если место не понадобилось раньше
+STORAGE_FILE_TTL = int(os.getenv('STORAGE_FILE_TTL', 3600))
+# Сколько задача может ждать места, прежде чем завершиться ошибкой
+STORAGE_WAIT_TIMEOUT = int(os.getenv('STORAGE_WAIT_TIMEOUT', 300))
+
+
+class StorageFullError(Exception):
+    """Места под файл нет и за отведенное время не освободилось."""
+
+
+def _path_size(path):
+    if os.path.isdir(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try: total += os.path.getsize(os.path.join(root, name))
+                except OSError: pass
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+class StorageManager:
+    """Учет места на диске под загрузки: резервирование до старта и вытеснение по индексу.
+
+    Перед загрузкой задача резервирует оценку размера (reserve); если места нет, сначала
+    удаляются файлы с истекшим сроком, затем давно не запрошенные (LRU), и только потом
+    задача ждет, пока другие загрузки не закончатся. Готовый файл записывается в индекс
+    с фактическим размером (commit), резерв при этом снимается. Каталог целиком читается
+    один раз при старте (файлы, оставшиеся от прошлого запуска), дальше все решения
+    принимаются по индексу. Файлы, которые сейчас отдаются клиентам (refs > 0), не удаляются.
+    Рабочие папки задач, которые еще не завершены (pinned — их id), закреплены: они не истекают
+    и не вытесняются, пока задача не продолжит загрузку и не закончит ее (commit) или не
+    удалит остатки (discard).
+    """
+    def __init__(self, folder=None, budget=STORAGE_BUDGET_BYTES, ttl=STORAGE_FILE_TTL,
+                 default_estimate=STORAGE_DEFAULT_ESTIMATE, skip=(), reaper=None, pinned=()):
+        self.folder = folder
+        # Фоновое удаление по сроку — единственная очередь сроков (None — только полным проходом expire())
+        self.reaper = reaper
+        self.budget = budget
+        self.ttl = ttl
+        self.default_estimate = default_estimate
+        self.entries = OrderedDict()   # владелец (id задачи) -> запись, порядок = давность использования
+        self.used = 0                  # байты готовых файлов
+        self.reserved = 0              # байты, обещанные идущим загрузкам
+        self.evicted = 0
+        self.cond = threading.Condition()
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+            self._adopt(skip, set(pinned))
+
+    def _adopt(self, skip, pinned):
+        """Ставит на учет файлы, оставшиеся от прошлого запуска (единственный обход каталога)."""
+        skip = {os.path.normpath(p) for p in skip}
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if os.path.normpath(path) in skip:
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            # Рабочая папка задачи называется ее id: перезапущенная задача продолжит ее же запись
+            entry = self._entry(name)
+            entry['paths'][path] = _path_size(path)
+            entry['size'] = entry['paths'][path]
+            self.used += entry['size']
+            if name in pinned:
+                # Задача еще в download_jobs: ее подберут после перезапуска и продолжат с этих остатков
+                entry['pinned'] = True
+            else:
+                self._schedule(name, entry, mtime + self.ttl)
+
+    def _entry(self, owner):
+        entry = self.entries.get(owner)
+        if entry is None:
+            entry = self.entries[owner] = {'reserved': 0, 'size': 0, 'paths': {}, 'expires': None, 'refs': 0, 'pinned': False}
+        return entry
+
+    def _schedule(self, owner, entry, expires):
+        entry['expires'] = expires
+        if self.reaper:
+            self.reaper.schedule('file', owner, expires, self._reap)
+
+    def available(self):
+        return self.budget - self.used - self.reserved
+
+    def fits(self, size):
+        """Может ли файл такого размера поместиться хотя бы на пустой диск."""
+        return (size or self.default_estimate) <= self.budget
+
+    def reserve(self, owner, size, timeout=0):
+        """Резервирует место под загрузку. Возвращает False, если места нет и за timeout не появилось."""
+        size = size or self.default_estimate
+        if size > self.budget:
+            return False
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            entry = self.entries.get(owner)
+            if entry:
+                # Недокачанные файлы продолженной задачи не должны истечь или быть вытеснены,
+                # а их байты уже учтены в used — резервируется только остаток оценки
+                entry['expires'] = None
+                entry['pinned'] = True
+                size = max(size - entry['size'], 0)
+            while not self._make_room(size, keep=owner):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            entry = self._entry(owner)
+            entry['reserved'] += size
+            self.reserved += size
+            return True
+
+    def commit(self, owner, path):
+        """Записывает готовый файл (или папку) в индекс с фактическим размером и снимает резерв владельца."""
+        size = _path_size(path)
+        with self.cond:
+            entry = self._entry(owner)
+            self.reserved -= entry['reserved']
+            entry['reserved'] = 0
+            entry['pinned'] = False
+            delta = size - entry['paths'].get(path, 0)
+            entry['paths'][path] = size
+            entry['size'] += delta
+            self.used += delta
+            self._schedule(owner, entry, time.time() + self.ttl)
+            self.entries.move_to_end(owner)
+            # Фактический размер мог оказаться меньше оценки — кто-то из ждущих может поместиться
+            self.cond.notify_all()
+
+    def cancel(self, owner):
+        """Снимает резерв (файл не получился или перенесен в кэш готовых файлов)."""
+        with self.cond:
+            entry = self.entries.get(owner)
+            if not entry:
+                return
+            self.reserved -= entry['reserved']
+            entry['reserved'] = 0
+            if not entry['paths']:
+                del self.entries[owner]
+            elif entry['pinned']:
+                # Остатки, которые так и не продолжили, дальше живут по обычному сроку
+                entry['pinned'] = False
+                self._schedule(owner, entry, time.time() + self.ttl)
+            self.cond.notify_all()
+
+    def discard(self, owner, pattern=None):
+        """Удаляет файлы владельца и снимает его с учета.
+
+        pattern — маска для недокачанных остатков (.part, отдельные дорожки), которых нет в индексе.
+        """
+        with self.cond:
+            entry = self.entries.get(owner)
+            if entry:
+                self._drop(owner)
+            self.cond.notify_all()
+        if pattern:
+            for path in glob.glob(pattern):
+                _remove(path)
+
+    def acquire(self, owner):
+        """Помечает файл как отдаваемый клиенту (защищает от удаления) и обновляет давность."""
+        with self.cond:
+            entry = self.entries.get(owner)
+            if not entry:
+                return False
+            entry['refs'] += 1
+            self.entries.move_to_end(owner)
+            return True
+
+    def release(self, owner):
+        with self.cond:
+            entry = self.entries.get(owner)
+            if entry and entry['refs'] > 0:
+                entry['refs'] -= 1
+                self.cond.notify_all()
+
+    def expire(self, now=None):
+        """Полный проход: удаляет файлы с истекшим сроком. Возвращает число удаленных записей.
+
+        Обычно сроки обрабатывает reaper по одному; проход нужен как страховка и без reaper.
+        """
+        with self.cond:
+            removed = self._expire(now or time.time())
+            if removed:
+                self.cond.notify_all()
+            return removed
+
+    def _reap(self, owner):
+        """Обработчик срока одного владельца: возвращает освобожденные байты или None."""
+        now = time.time()
+        with self.cond:
+            entry = self.entries.get(owner)
+            if not entry or entry['expires'] is None or entry['expires'] > now or entry['reserved']:
+                return None
+            if entry['refs']:
+                # Файл сейчас скачивают — проверим еще раз позже
+                self._schedule(owner, entry, now + 60)
+                return None
+            size = entry['size']
+            self._drop(owner)
+            self.cond.notify_all()
+            return size
+
+    def _expire(self, now):
+        removed = 0
+        for owner, entry in list(self.entries.items()):
+            if entry['expires'] is None or entry['expires'] > now or entry['reserved']:
+                continue
+            if entry['refs']:
+                # Файл сейчас скачивают — проверим еще раз позже
+                self._schedule(owner, entry, now + 60)
+                continue
+            self._drop(owner)
+            removed += 1
+        return removed
+
+    def _make_room(self, size, keep=None):
+        # Вызывается под self.cond
+        if self.available() >= size:
+            return True
+        self._expire(time.time())
+        if self.available() >= size:
+            return True
+        for owner in [o for o, e in self.entries.items()
+                      if e['paths'] and not e['reserved'] and not e['refs'] and not e['pinned'] and o != keep]:
+            logger.info(f"Storage evict {owner} ({self.entries[owner]['size']} bytes)")
+            self._drop(owner)
+            self.evicted += 1
+            if self.available() >= size:
+                return True
+        return False
+
+    def _drop(self, owner):
+        entry = self.entries.pop(owner)
+        self.used -= entry['size']
+        self.reserved -= entry['reserved']
+        for path in entry['paths']:
+            _remove(path)
+
+    def stats(self):
+        with self.cond:
+            return {'entries': len(self.entries), 'used': self.used, 'reserved': self.reserved,
+                    'budget': self.budget, 'evicted': self.evicted,
+                    'pinned': sum(1 for e in self.entries.values() if e['pinned'])}
@@ -0,0 +1,186 @@
+import os
+import time
+import queue
+import shutil
+import threading
+import subprocess
+import logging
+import urllib.request
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Режим "отдавать во время скачивания" (можно выключить в .env)
+STREAMING_ENABLED = os.getenv('STREAMING_ENABLED', 'True').lower() == 'true'
+# Для каких качеств клиент может запросить поток: по умолчанию только аудио (один формат, без склейки).
+# Потоковая задача идет мимо очереди, кэша и резерва места, поэтому видео по умолчанию качается обычным путем
+STREAM_QUALITIES = tuple(q.strip() for q in os.getenv('STREAM_QUALITIES', 'audio').split(',') if q.strip())
+# Сколько потоков процесс отдает одновременно; при заполнении новые загрузки идут через очередь
+STREAM_MAX_ACTIVE = int(os.getenv('STREAM_MAX_ACTIVE', 4))
+# Сколько ждать, пока клиент откроет потоковую ссылку; после — задача отменяется, запись в истории откатывается
+STREAM_READY_TTL = int(os.getenv('STREAM_READY_TTL', 600))
+# Через какие прокси умеют ходить и ffmpeg (-http_proxy), и urllib: socks сюда не входит
+STREAM_PROXY_SCHEMES = ('http', 'https')
+STREAM_CHUNK_SIZE = 64 * 1024
+# Сколько чанков держать в памяти на один поток (64 * 64 КБ = 4 МБ)
+STREAM_BUFFER_CHUNKS = int(os.getenv('STREAM_BUFFER_CHUNKS', 64))
+# Сколько ждать первых байтов, прежде чем сообщить клиенту об ошибке
+STREAM_START_TIMEOUT = int(os.getenv('STREAM_START_TIMEOUT', 60))
+
+_END = object()
+
+
+def find_ffmpeg():
+    # Ищем при каждом вызове: static_ffmpeg добавляет путь уже после импорта модулей
+    return shutil.which('ffmpeg') or shutil.which('ffmpeg.exe')
+
+
+def proxy_supported(proxy):
+    """Можно ли отдать поток через этот прокси. Ссылки на медиа привязаны к IP прокси,
+    поэтому идти в обход него (как ffmpeg/urllib поступили бы с socks5) нельзя."""
+    return not proxy or urlparse(proxy).scheme.lower() in STREAM_PROXY_SCHEMES
+
+
+def needs_remux(formats):
+    """Видео и аудио отдельно или фрагментированный протокол (HLS/DASH) — нужна склейка через ffmpeg."""
+    return len(formats) > 1 or formats[0].get('protocol') not in ('http', 'https')
+
+
+def ffmpeg_command(ffmpeg, formats, proxy=None):
+    """ffmpeg без перекодирования собирает дорожки во фрагментированный MP4 и пишет его в stdout.
+
+    Фрагментированный MP4 (moov в начале, дальше независимые фрагменты) можно
+    отдавать по мере записи — обычному MP4 нужен индекс в конце файла.
+    """
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for f in formats:
+        headers = ''.join(f'{k}: {v}\r\n' for k, v in (f.get('http_headers') or {}).items())
+        if headers:
+            cmd += ['-headers', headers]
+        if proxy:
+            cmd += ['-http_proxy', proxy]
+        cmd += ['-i', f['url']]
+    if len(formats) > 1:
+        cmd += ['-map', '0:v:0', '-map', '1:a:0']
+    cmd += ['-c', 'copy', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', 'pipe:1']
+    return cmd
+
+
+class MediaStream:
+    """Передает медиа в HTTP-ответ по мере скачивания через ограниченный буфер в памяти.
+
+    Отдельный поток читает источник (ffmpeg или прямой HTTP-ответ) и складывает чанки
+    в очередь из buffer_chunks элементов. Если клиент читает медленнее, очередь
+    заполняется, поток-читатель блокируется, а за ним и ffmpeg/сокет источника —
+    скачивание замедляется до скорости клиента, память не растет.
+    """
+    def __init__(self, formats, proxy=None, ratelimit=None, on_close=None,
+                 buffer_chunks=STREAM_BUFFER_CHUNKS, chunk_size=STREAM_CHUNK_SIZE, throttle=None):
+        self.formats = formats
+        self.proxy = proxy
+        self.ratelimit = ratelimit
+        # throttle(n) блокирует чтение источника, пока распределитель полосы не разрешит n байт
+        self.throttle = throttle
+        self.on_close = on_close
+        self.chunk_size = chunk_size
+        self.buffer = queue.Queue(maxsize=buffer_chunks)
+        self.stop = threading.Event()
+        self.process = None
+        self.first = None
+        self.error = None
+        self.complete = False
+        self.bytes_sent = 0
+        self.closed = False
+
+    @property
+    def ext(self):
+        if needs_remux(self.formats):
+            return 'm4a' if all(f.get('vcodec') == 'none' for f in self.formats) else 'mp4'
+        return self.formats[0].get('ext') or 'mp4'
+
+    def _open_source(self):
+        if needs_remux(self.formats):
+            ffmpeg = find_ffmpeg()
+            if not ffmpeg:
+                raise RuntimeError('ffmpeg not found')
+            self.process = subprocess.Popen(ffmpeg_command(ffmpeg, self.formats, self.proxy),
+                                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+            return self.process.stdout
+        f = self.formats[0]
+        handlers = [urllib.request.ProxyHandler({'http': self.proxy, 'https': self.proxy})] if self.proxy else []
+        request = urllib.request.Request(f['url'], headers=f.get('http_headers') or {})
+        return urllib.request.build_opener(*handlers).open(request, timeout=30)
+
+    def _put(self, item):
+        # put с таймаутом, чтобы заметить закрытие потока, пока буфер полон
+        while not self.stop.is_set():
+            try:
+                self.buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        source = None
+        try:
+            source = self._open_source()
+            while not self.stop.is_set():
+                chunk = source.read(self.chunk_size)
+                if not chunk:
+                    if self.process and self.process.wait() != 0:
+                        raise RuntimeError(f'ffmpeg exited with code {self.process.returncode}')
+                    self.complete = True
+                    break
+                if self.throttle:
+                    self.throttle(len(chunk))
+                if not self._put(chunk):
+                    break
+        except Exception as e:
+            self.error = e
+            logger.warning(f"Stream source error: {str(e)[:200]}")
+        finally:
+            if source is not None:
+                try: source.close()
+                except Exception: pass
+            self._put(_END)
+
+    def start(self, timeout=STREAM_START_TIMEOUT):
+        """Запускает чтение и ждет первый чанк; ошибка источника поднимается здесь, до отправки заголовков."""
+        threading.Thread(target=self._produce, daemon=True).start()
+        try:
+            self.first = self.buffer.get(timeout=timeout)
+        except queue.Empty:
+            self.close()
+            raise RuntimeError('stream start timed out')
+        if self.first is _END:
+            self.close()
+            raise self.error or RuntimeError('empty stream')
+        return self
+
+    def __iter__(self):
+        started = time.monotonic()
+        chunk = self.first
+        try:
+            while chunk is not _END:
+                yield chunk
+                self.bytes_sent += len(chunk)
+                if self.ratelimit:
+                    # Ограничение скорости для бесплатных аккаунтов: ждем, пока не "заработаем" отправленное
+                    delay = self.bytes_sent / self.ratelimit - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                chunk = self.buffer.get()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stop.set()
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+        if self.on_close:
+            try: self.on_close(self)
+            except Exception as e: logger.error(f"Stream close callback error: {e}")
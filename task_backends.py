@@ -0,0 +1,181 @@
+import json
+import sqlite3
+import threading
+import time
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryTaskBackend:
+    """Состояние задач в памяти процесса (подходит только для одного воркера).
+
+    Блокировка разбита на полосы по id задачи: обновления прогресса разных загрузок
+    не ждут друг друга.
+    """
+    def __init__(self, stripes=16):
+        self.tasks = {}
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def _lock(self, tid):
+        return self.locks[hash(tid) % len(self.locks)]
+
+    def create(self, tid, task):
+        with self._lock(tid):
+            self.tasks[tid] = task
+
+    def get(self, tid):
+        with self._lock(tid):
+            task = self.tasks.get(tid)
+            return dict(task) if task is not None else None
+
+    def update(self, tid, fields, snapshot=False):
+        with self._lock(tid):
+            task = self.tasks.get(tid)
+            if task is None:
+                return None
+            task.update(fields)
+            return dict(task) if snapshot else True
+
+    def expire(self, cutoff):
+        old = [tid for tid, task in list(self.tasks.items()) if task['start_time'] < cutoff]
+        for tid in old:
+            with self._lock(tid):
+                self.tasks.pop(tid, None)
+        return old
+
+    def discard(self, tid, cutoff):
+        """Удаляет одну задачу, если она создана раньше cutoff (срок мог быть продлен восстановлением)."""
+        with self._lock(tid):
+            task = self.tasks.get(tid)
+            if task is None or task['start_time'] >= cutoff:
+                return False
+            del self.tasks[tid]
+            return True
+
+
+class SQLiteTaskBackend:
+    """Общее состояние задач в SQLite-файле (режим WAL) для нескольких процессов на одной машине."""
+    def __init__(self, path='tasks.db'):
+        self.path = path
+        self.local = threading.local()
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, data TEXT, start_time REAL)')
+
+    def _conn(self):
+        # Отдельное соединение на поток: sqlite3 не разрешает делить его между потоками
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def create(self, tid, task):
+        self._conn().execute('INSERT OR REPLACE INTO tasks (task_id, data, start_time) VALUES (?, ?, ?)',
+                             (tid, json.dumps(task, default=str), task.get('start_time', time.time())))
+
+    def get(self, tid):
+        row = self._conn().execute('SELECT data FROM tasks WHERE task_id = ?', (tid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, tid, fields, snapshot=False):
+        conn = self._conn()
+        # BEGIN IMMEDIATE сразу берет блокировку записи, чтобы параллельные обновления не терялись
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM tasks WHERE task_id = ?', (tid,)).fetchone()
+            if not row:
+                conn.execute('COMMIT')
+                return None
+            task = json.loads(row[0])
+            task.update(fields)
+            conn.execute('UPDATE tasks SET data = ? WHERE task_id = ?', (json.dumps(task, default=str), tid))
+            conn.execute('COMMIT')
+            return task if snapshot else True
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def expire(self, cutoff):
+        conn = self._conn()
+        old = [row[0] for row in conn.execute('SELECT task_id FROM tasks WHERE start_time < ?', (cutoff,)).fetchall()]
+        conn.execute('DELETE FROM tasks WHERE start_time < ?', (cutoff,))
+        return old
+
+    def discard(self, tid, cutoff):
+        return self._conn().execute('DELETE FROM tasks WHERE task_id = ? AND start_time < ?', (tid, cutoff)).rowcount > 0
+
+
+class RedisTaskBackend:
+    """Состояние задач в Redis (или любом сервере с протоколом Redis): переживает перезапуск и видно другим процессам.
+
+    Каждая задача — хэш task:<id>, поля хранятся в JSON. HSET сливает поля атомарно,
+    поэтому чтение-модификация-запись не нужны, а старые задачи удаляет сам сервер по TTL.
+    Проверка существования и запись в update выполняются одним Lua-скриптом: задача,
+    истекшая между ними, не воскресает частичным хэшем без TTL.
+
+    Общим здесь становится только состояние задач (переживает перезапуск, видно другим
+    процессам). Загрузки по-прежнему ведет один процесс: очередь, объединение одинаковых
+    загрузок, индекс медиакэша, плейлисты и комнаты Socket.IO в Redis не вынесены.
+    """
+    def __init__(self, url=None, client=None, ttl=3600, prefix='task:'):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("Для TASK_BACKEND=redis установите пакет redis")
+            client = redis.Redis.from_url(url or 'redis://localhost:6379/0')
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._update = client.register_script(self.UPDATE_SCRIPT)
+
+    def _key(self, tid):
+        return f'{self.prefix}{tid}'
+
+    # Поля пишутся, только если хэш еще существует (TTL при этом сохраняется)
+    UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+    def create(self, tid, task):
+        key = self._key(tid)
+        # HSET и EXPIRE одной транзакцией: хэш без TTL не остается даже при обрыве соединения
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(key, mapping={k: json.dumps(v, default=str) for k, v in task.items()})
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def get(self, tid):
+        data = self.client.hgetall(self._key(tid))
+        if not data:
+            return None
+        return {(k.decode() if isinstance(k, bytes) else k): json.loads(v) for k, v in data.items()}
+
+    def update(self, tid, fields, snapshot=False):
+        key = self._key(tid)
+        args = [item for k, v in fields.items() for item in (k, json.dumps(v, default=str))]
+        if not (self._update(keys=[key], args=args) if args else self.client.exists(key)):
+            return None
+        return self.get(tid) if snapshot else True
+
+    def expire(self, cutoff):
+        # Истечение делает сам Redis (EXPIRE)
+        return []
+
+    def discard(self, tid, cutoff):
+        return False
+
+
+def make_task_backend(kind, url=None):
+    kind = (kind or 'memory').lower()
+    if kind == 'sqlite':
+        return SQLiteTaskBackend(url or 'tasks.db')
+    if kind == 'redis':
+        return RedisTaskBackend(url)
+    return MemoryTaskBackend()
@@ -0,0 +1,113 @@
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Не чаще одного сообщения о задаче за столько секунд (промежуточные обновления склеиваются)
+PROGRESS_PUSH_INTERVAL = float(os.getenv('PROGRESS_PUSH_INTERVAL', 0.5))
+# Статусы, которые отправляются сразу, без ожидания
+FINAL_STATUSES = ('finished', 'error')
+
+
+def task_room(task_id):
+    return f'task_{task_id}'
+
+
+class TaskEventPublisher:
+    """Отправляет изменения задач в комнату Socket.IO task_<id> вместо опроса /progress.
+
+    Отправляются только измененные поля. Если задача обновляется чаще, чем раз в
+    interval секунд, изменения склеиваются и уходят одним сообщением по истечении
+    интервала. Смена статуса на finished/error отправляется сразу.
+
+    Каждое взятое из pending сообщение получает порядковый номер задачи, и _emit
+    отправляет их строго по номерам: пачка, которую фоновый поток уже забрал, но
+    еще не отправил, уйдет раньше финального статуса, а не после него.
+    """
+    def __init__(self, socketio, interval=PROGRESS_PUSH_INTERVAL):
+        self.socketio = socketio
+        self.interval = interval
+        self.pending = {}     # task_id -> накопленные поля
+        self.last_emit = {}   # task_id -> время последней отправки
+        self.seq = {}         # task_id -> номер последнего взятого сообщения
+        self.sent = {}        # task_id -> номер последнего отправленного сообщения
+        self.cond = threading.Condition()
+        self.flusher = None
+        self.emitted = 0
+        self.coalesced = 0
+
+    def publish(self, task_id, fields):
+        now = time.monotonic()
+        with self.cond:
+            pending = self.pending.setdefault(task_id, {})
+            if pending:
+                self.coalesced += 1
+            pending.update(fields)
+            final = fields.get('status') in FINAL_STATUSES
+            if not final and now - self.last_emit.get(task_id, 0) < self.interval:
+                # Отправит фоновый поток, когда пройдет интервал
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                    self.flusher.start()
+                self.cond.notify()
+                return
+            payload = self.pending.pop(task_id)
+            seq = self._next_seq(task_id)
+            if final:
+                self.last_emit.pop(task_id, None)
+            else:
+                self.last_emit[task_id] = now
+        self._emit(task_id, payload, seq, final)
+
+    def _next_seq(self, task_id):
+        # Вызывается под self.cond вместе с извлечением из pending
+        seq = self.seq.get(task_id, 0) + 1
+        self.seq[task_id] = seq
+        return seq
+
+    def _emit(self, task_id, payload, seq, final=False):
+        with self.cond:
+            # Ждем, пока уйдут сообщения этой задачи, взятые раньше нашего
+            while self.sent.get(task_id, 0) < seq - 1:
+                self.cond.wait()
+        try:
+            self.socketio.emit('task_progress', dict(payload, task_id=task_id), room=task_room(task_id))
+            self.emitted += 1
+        except Exception as e:
+            logger.warning(f"Task event emit error: {e}")
+        with self.cond:
+            if final and self.seq.get(task_id) == seq:
+                # Задача завершена и новых сообщений нет: счетчики больше не нужны
+                self.seq.pop(task_id, None)
+                self.sent.pop(task_id, None)
+            else:
+                self.sent[task_id] = seq
+            self.cond.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                now = time.monotonic()
+                due = [tid for tid in self.pending if now - self.last_emit.get(tid, 0) >= self.interval]
+                if not due:
+                    wait = min(self.last_emit.get(tid, 0) + self.interval for tid in self.pending) - now
+                    self.cond.wait(max(wait, 0.01))
+                    continue
+                batch = [(tid, self.pending.pop(tid), self._next_seq(tid)) for tid in due]
+                for tid in due:
+                    self.last_emit[tid] = now
+                # Задачи, которые так и не завершились (упал процесс-загрузчик), не копим вечно
+                if len(self.last_emit) > 10000:
+                    self.last_emit = {tid: t for tid, t in self.last_emit.items() if now - t < 3600}
+                    self.seq = {tid: n for tid, n in self.seq.items() if tid in self.last_emit or self.sent.get(tid, 0) < n}
+                    self.sent = {tid: n for tid, n in self.sent.items() if tid in self.seq}
+            for tid, payload, seq in batch:
+                self._emit(tid, payload, seq)
+
+    def stats(self):
+        with self.cond:
+            return {'emitted': self.emitted, 'coalesced': self.coalesced, 'pending': len(self.pending)}
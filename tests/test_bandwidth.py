@@ -0,0 +1,114 @@
+import unittest
+import sys
+import os
+import time
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bandwidth import BandwidthAllocator, water_fill
+
+
+class TestWaterFill(unittest.TestCase):
+    """Тестирование взвешенного max-min распределения"""
+
+    def test_weighted_shares(self):
+        self.assertEqual(water_fill(100, [('a', 4, None), ('b', 1, None)]), {'a': 80, 'b': 20})
+
+    def test_small_demand_gives_rest_to_others(self):
+        rates = water_fill(100, [('slow', 4, 10), ('a', 1, None), ('b', 1, None)])
+        self.assertEqual(rates, {'slow': 10, 'a': 45, 'b': 45})
+
+    def test_leftover_is_not_wasted(self):
+        rates = water_fill(100, [('a', 1, 10), ('b', 1, 30)])
+        self.assertAlmostEqual(sum(rates.values()), 100)
+        self.assertGreater(rates['a'], 10)
+
+
+class TestBandwidthAllocator(unittest.TestCase):
+    """Тестирование распределителя полосы"""
+
+    def test_single_free_flow_gets_everything(self):
+        allocator = BandwidthAllocator(total=1000, weights={'premium': 4, 'free': 1}, min_rate=1)
+        flow = allocator.open('free', 'user1')
+        self.assertEqual(flow.rate, 1000)
+        flow.close()
+        self.assertEqual(allocator.stats()['flows'], 0)
+
+    def test_tiers_then_users(self):
+        allocator = BandwidthAllocator(total=1000, weights={'premium': 4, 'free': 1}, min_rate=1)
+        free = allocator.open('free', 'user1')
+        premium = [allocator.open('premium', 'user2'), allocator.open('premium', 'user2'), allocator.open('premium', 'user3')]
+        self.assertAlmostEqual(free.rate, 200)
+        # Внутри тарифа — поровну между пользователями, а не между загрузками
+        self.assertAlmostEqual(premium[0].rate, 200)
+        self.assertAlmostEqual(premium[1].rate, 200)
+        self.assertAlmostEqual(premium[2].rate, 400)
+        # Premium-загрузки закончились — бесплатная сразу получает всю полосу
+        for flow in premium:
+            flow.close()
+        self.assertAlmostEqual(free.rate, 1000)
+
+    def test_slow_flow_capacity_redistributed(self):
+        allocator = BandwidthAllocator(total=1000, weights={'premium': 4, 'free': 1}, interval=3600, min_rate=1)
+        slow = allocator.open('premium', 'user1')
+        fast = allocator.open('free', 'user2')
+        # Источник premium-загрузки отдает только 100 байт/с, и в свою скорость она не упиралась,
+        # а бесплатная ждала распределителя
+        slow.throttled, fast.throttled = False, True
+        slow.window_bytes, fast.window_bytes = 100, 800
+        allocator.last_realloc = time.monotonic() - 1
+        allocator._reallocate(time.monotonic(), measure=True)
+        self.assertAlmostEqual(slow.rate, 125, delta=1)
+        self.assertAlmostEqual(fast.rate, 875, delta=1)
+
+    def test_consume_throttles_to_rate(self):
+        allocator = BandwidthAllocator(total=100000, burst=0.1, interval=3600, min_rate=1)
+        flow = allocator.open('free')
+        started = time.monotonic()
+        for _ in range(5):
+            flow.consume(10000)
+        # 50 КБ при 100 КБ/с и запасе 10 КБ — не меньше ~0.4 с
+        self.assertGreater(time.monotonic() - started, 0.35)
+        self.assertGreater(flow.slept, 0)
+
+    def test_hook_counts_increments_only(self):
+        allocator = BandwidthAllocator(total=0)
+        consumed = []
+        flow = allocator.open('free')
+        flow.consume = consumed.append
+        # Продолженная загрузка: первое значение уже содержит скачанное раньше
+        for n in (5000, 6000, 8000):
+            flow.hook({'status': 'downloading', 'tmpfilename': 'a.part', 'downloaded_bytes': n})
+        flow.hook({'status': 'downloading', 'tmpfilename': 'b.part', 'downloaded_bytes': 100})
+        flow.hook({'status': 'finished', 'filename': 'a'})
+        self.assertEqual(consumed, [1000, 2000])
+
+    def test_hook_from_fragment_threads_counts_bytes_once(self):
+        allocator = BandwidthAllocator(total=0)
+        consumed = []
+        flow = allocator.open('free')
+        flow.consume = consumed.append
+        flow.hook({'status': 'downloading', 'tmpfilename': 'a.part', 'downloaded_bytes': 0})
+        # Потоки фрагментов сообщают общий счетчик одновременно и не по порядку
+        values = iter(range(1, 20001))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    n = next(values, None)
+                if n is None:
+                    return
+                flow.hook({'status': 'downloading', 'tmpfilename': 'a.part', 'downloaded_bytes': n})
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sum(consumed), 20000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import sys
+import os
+import time
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import TaskManager
+from batches import BatchManager, BatchItemError, parse_urls
+
+
+class FakeService:
+    """Медленный lookup_info с подсчетом одновременных вызовов"""
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def lookup_info(self, url):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        if 'playlist' in url:
+            return {'_type': 'playlist', 'title': 'List'}
+        if 'adult' in url:
+            return {'title': 'Adult', 'age_limit': 18}
+        return {'title': f'Video {url[-1]}'}
+
+    def video_summary(self, info):
+        return {'title': info['title'], 'duration': '', 'sizes': {}}
+
+
+class TestBatches(unittest.TestCase):
+    """Тестирование пакетной отправки ссылок"""
+
+    def setUp(self):
+        # Свой менеджер задач: кэш информации только в памяти
+        self.tm = TaskManager()
+
+    def wait_status(self, group_id, statuses=('finished', 'error'), timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            task = self.tm.get_task(group_id)
+            if task.get('status') in statuses:
+                return task
+            time.sleep(0.02)
+        self.fail(f'group status: {self.tm.get_task(group_id)}')
+
+    def test_parse_urls(self):
+        urls = parse_urls('https://youtu.be/dQw4w9WgXcQ\nhttps://www.youtube.com/watch?v=dQw4w9WgXcQ&t=5, not-a-url https://test/2')
+        self.assertEqual(urls, ['https://youtu.be/dQw4w9WgXcQ', 'https://test/2'])
+        self.assertEqual(len(parse_urls([f'https://test/{i}' for i in range(10)], limit=3)), 3)
+
+    def test_group_aggregates_items(self):
+        service = FakeService()
+        manager = BatchManager(service, self.tm, workers=2, interval=0.02)
+        enqueued = []
+
+        def enqueue(url, title):
+            if url.endswith('9'):
+                raise BatchItemError('Очередь переполнена')
+            task_id = self.tm.create_task()
+            enqueued.append(task_id)
+            return task_id
+
+        urls = [f'https://test/{i}' for i in range(1, 6)] + ['https://test/playlist', 'https://test/adult', 'https://test/9']
+        released = []
+        group_id = manager.create(urls, enqueue, released.append)
+        self.assertEqual(self.tm.get_task(group_id)['mode'], 'batch')
+
+        # Пока задачи пакета не завершены, группа не завершается
+        deadline = time.time() + 5
+        while len(enqueued) < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(enqueued), 5)
+        self.tm.update_task(enqueued[0], status='downloading', progress=50)
+        task = self.wait_status(group_id, ('downloading',))
+        self.assertGreater(task['progress'], 0)
+
+        for task_id in enqueued:
+            self.tm.update_task(task_id, status='finished', progress=100)
+        task = self.wait_status(group_id)
+
+        self.assertEqual(task['status'], 'finished')
+        self.assertEqual((task['done'], task['failed'], task['total']), (5, 3, 8))
+        errors = {item['url']: item['error'] for item in task['items'] if item['status'] == 'error'}
+        self.assertIn('Плейлисты', errors['https://test/playlist'])
+        self.assertIn('18+', errors['https://test/adult'])
+        self.assertEqual(errors['https://test/9'], 'Очередь переполнена')
+        # Место в лимите возвращается только для ссылок, не попавших в очередь
+        self.assertEqual(sorted(released), ['https://test/9', 'https://test/adult', 'https://test/playlist'])
+        # Проверка ссылок идет параллельно, но не больше чем в workers потоков
+        self.assertEqual(service.max_active, 2)
+        self.assertEqual(manager.stats()['groups'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import sys
+import os
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cookie_manager import CookieManager
+
+
+def write_jar(path, count):
+    with open(path, 'w') as f:
+        f.write('# Netscape HTTP Cookie File\n')
+        for i in range(count):
+            f.write(f'.youtube.com\tTRUE\t/\tTRUE\t0\tNAME{i}\tvalue{i}\n')
+
+
+class TestCookieManager(unittest.TestCase):
+    """Тестирование пула файлов cookies"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.a = os.path.join(self.tmp.name, 'a.txt')
+        self.b = os.path.join(self.tmp.name, 'b.txt')
+        write_jar(self.a, 10)
+        write_jar(self.b, 10)
+        self.copies = os.path.join(self.tmp.name, 'copies')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_rotation_and_cooldown(self):
+        manager = CookieManager([self.a, self.b], check_interval=60, cooldown=60, copy_dir=self.copies)
+        used = [manager.acquire() for _ in range(4)]
+        self.assertEqual(sorted(used), sorted([self.a, self.a, self.b, self.b]))
+
+        manager.report_failure(self.a, 'bot')
+        self.assertEqual({manager.acquire() for _ in range(3)}, {self.b})
+        # Прочие ошибки аккаунт не блокируют
+        manager.report_failure(self.b, 'unavailable')
+        self.assertEqual(manager.acquire(), self.b)
+
+    def test_invalid_or_missing_jar_skipped(self):
+        write_jar(self.b, 1)
+        manager = CookieManager([self.a, self.b, os.path.join(self.tmp.name, 'missing.txt')], copy_dir=self.copies)
+        self.assertEqual({manager.acquire() for _ in range(3)}, {self.a})
+        self.assertEqual([s['valid'] for s in manager.stats()], [True, False, False])
+
+    def test_reload_only_on_mtime_change(self):
+        manager = CookieManager([self.a], check_interval=0, copy_dir=self.copies)
+        self.assertEqual(manager.acquire(), self.a)
+        version = manager.version(self.a)
+
+        # Тот же mtime — файл не перечитывается, даже если содержимое другое
+        write_jar(self.a, 1)
+        os.utime(self.a, (version, version))
+        self.assertEqual(manager.acquire(), self.a)
+
+        os.utime(self.a, (time.time() + 10, time.time() + 10))
+        self.assertIsNone(manager.acquire())
+        self.assertNotEqual(manager.version(self.a), version)
+
+    def test_ydl_writes_to_working_copy_keep_version(self):
+        manager = CookieManager([self.a], check_interval=0, copy_dir=self.copies)
+        path = manager.acquire()
+        copy = manager.working_copy(path)
+        self.assertNotEqual(copy, self.a)
+        version = manager.version(self.a)
+
+        # YoutubeDL при закрытии сохраняет cookies в cookiefile — исходный файл не меняется
+        time.sleep(0.01)
+        write_jar(copy, 12)
+        manager.acquire()
+        self.assertEqual(manager.version(copy), version)
+        self.assertEqual(manager.working_copy(self.a), copy)
+
+        # Новая версия исходного файла — новая копия, старая удалена
+        os.utime(self.a, (time.time() + 10, time.time() + 10))
+        manager.acquire()
+        self.assertNotEqual(manager.version(self.a), version)
+        self.assertNotEqual(manager.working_copy(self.a), copy)
+        self.assertFalse(os.path.exists(copy))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import sys
+import os
+import tempfile
+from unittest.mock import patch
+from flask import Flask
+from werkzeug.wsgi import FileWrapper
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_serving import serve_file, content_disposition
+
+
+class TestFileServing(unittest.TestCase):
+    """Тестирование отдачи файлов с поддержкой Range"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'video.mp4')
+        self.data = bytes(range(256)) * 40
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.closed = []
+        app = Flask(__name__)
+
+        @app.route('/file')
+        def get_file():
+            return serve_file(self.path, 'Видео.mp4', on_close=lambda: self.closed.append(True))
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def get(self, **headers):
+        response = self.client.get('/file', headers=headers)
+        data = response.get_data()
+        response.close()
+        return response, data
+
+    def test_full_file(self):
+        response, data = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, self.data)
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.headers['Content-Length'], str(len(self.data)))
+        self.assertEqual(self.closed, [True])
+
+    def test_range_and_if_range(self):
+        response, data = self.get(Range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(data, self.data[100:200])
+        self.assertEqual(response.headers['Content-Range'], f'bytes 100-199/{len(self.data)}')
+
+        etag = response.headers['ETag']
+        response, data = self.get(Range='bytes=-10', **{'If-Range': etag})
+        self.assertEqual((response.status_code, data), (206, self.data[-10:]))
+
+        # Файл изменился с момента первой части — докачка невозможна, отдаем целиком
+        response, data = self.get(Range='bytes=100-', **{'If-Range': '"other"'})
+        self.assertEqual((response.status_code, data), (200, self.data))
+
+    def test_range_through_file_wrapper(self):
+        # Как dev-сервер werkzeug: file_wrapper читает файл до конца, Content-Length не соблюдает
+        response = self.client.get('/file', headers={'Range': 'bytes=100-199'},
+                                   environ_overrides={'wsgi.file_wrapper': FileWrapper})
+        data = response.get_data()
+        response.close()
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(data, self.data[100:200])
+        self.assertEqual(self.closed, [True])
+
+    def test_unsatisfiable_and_not_modified(self):
+        response, _ = self.get(Range=f'bytes={len(self.data) + 10}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], f'bytes */{len(self.data)}')
+
+        etag = self.get()[0].headers['ETag']
+        response, data = self.get(**{'If-None-Match': etag})
+        self.assertEqual((response.status_code, data), (304, b''))
+        self.assertEqual(len(self.closed), 3)
+
+    @patch('file_serving.FILE_OFFLOAD', 'nginx')
+    def test_nginx_offload(self):
+        with patch('file_serving.DOWNLOAD_FOLDER', self.tmp.name):
+            response, data = self.get()
+        self.assertEqual(response.headers['X-Accel-Redirect'], '/protected-downloads/video.mp4')
+        self.assertEqual(data, b'')
+        self.assertEqual(self.closed, [True])
+
+    def test_content_disposition(self):
+        self.assertEqual(content_disposition('Тест "1".mp4'),
+                         "attachment; filename=\"1.mp4\"; filename*=UTF-8''%D0%A2%D0%B5%D1%81%D1%82%20%221%22.mp4")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from format_index import FormatIndex
+from services import DownloadService
+
+MB = 1024 * 1024
+
+FORMATS = [
+    {'format_id': 'sb0', 'vcodec': 'none', 'acodec': 'none', 'ext': 'mhtml'},
+    {'format_id': '140', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'ext': 'm4a', 'abr': 129.5, 'filesize': 4 * MB},
+    {'format_id': '251', 'vcodec': 'none', 'acodec': 'opus', 'ext': 'webm', 'abr': 160, 'filesize': 5 * MB},
+    {'format_id': '18', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'ext': 'mp4', 'height': 360, 'filesize': 10 * MB},
+    {'format_id': '136', 'vcodec': 'avc1.4d401f', 'acodec': 'none', 'ext': 'mp4', 'height': 720, 'filesize': 20 * MB},
+    {'format_id': '247', 'vcodec': 'vp9', 'acodec': 'none', 'ext': 'webm', 'height': 720, 'filesize': 30 * MB},
+    # Высота строкой и 1088p вместо 1080p
+    {'format_id': '137', 'vcodec': 'avc1.640028', 'acodec': 'none', 'ext': 'mp4', 'height': '1088', 'vbr': 4000},
+    # 4K только в WebM
+    {'format_id': '313', 'vcodec': 'vp9', 'acodec': 'none', 'ext': 'webm', 'height': 2160, 'filesize': 300 * MB},
+]
+
+
+class TestFormatIndex(unittest.TestCase):
+    """Тестирование индекса форматов"""
+
+    def setUp(self):
+        self.info = {'duration': 100, 'formats': FORMATS}
+
+    def test_sizes_per_height(self):
+        index = FormatIndex(FORMATS, 100)
+        self.assertEqual(index.max_height, 2160)
+        self.assertEqual(index.audio_size, 5 * MB)
+        # Готовый MP4 важнее склейки
+        self.assertEqual(index.total_size(360), 10 * MB)
+        # Видео MP4 + лучшее аудио; WebM при предпочтении MP4 не учитывается
+        self.assertEqual(index.total_size(720), 25 * MB)
+        self.assertEqual(index.total_size(720, prefer_mp4=False), 35 * MB)
+        # Размер по битрейту и длительности
+        self.assertEqual(index.total_size(1080), 4000 * 1000 // 8 * 100 + 5 * MB)
+        self.assertEqual(index.total_size(2160), 0)
+
+    def test_ladder(self):
+        ladder = FormatIndex(FORMATS, 100).ladder()
+        self.assertEqual(list(ladder), ['360', '720', '1080', '2160', 'audio_128', 'audio_160'])
+        self.assertEqual(ladder['2160'], 305 * MB)
+        self.assertEqual(ladder['audio_128'], 4 * MB)
+        self.assertEqual(FormatIndex([], None).ladder(), {})
+
+    def test_index_cached_on_info(self):
+        index = FormatIndex.for_info(self.info)
+        self.assertIs(FormatIndex.for_info(self.info), index)
+        # Новый список форматов — новый индекс
+        self.info['formats'] = FORMATS[:2]
+        self.assertIsNot(FormatIndex.for_info(self.info), index)
+
+    def test_calculate_sizes(self):
+        sizes = DownloadService().calculate_sizes(self.info)
+        self.assertEqual(sizes['720'], '25.0 MB')
+        self.assertEqual(sizes['audio'], '5.0 MB')
+        # Для 4K нет MP4 — "лучшее" считается по 1080p
+        self.assertEqual(sizes['best'], f"👑 {(4000 * 1000 // 8 * 100 + 5 * MB) / MB:.1f} MB")
+
+
+if __name__ == '__main__':
+    unittest.main()
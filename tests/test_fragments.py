@@ -0,0 +1,131 @@
+import unittest
+import sys
+import os
+import time
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fragments
+from fragments import ConnectionBudget, FragmentTuner, source_key
+
+
+class TestConnectionBudget(unittest.TestCase):
+    """Тестирование общего бюджета соединений"""
+
+    def test_grants_what_is_left(self):
+        budget = ConnectionBudget(total=5)
+        self.assertEqual(budget.acquire(4), 4)
+        self.assertEqual(budget.acquire(4), 1)
+        self.assertEqual(budget.resize(1, 3), 1)
+        budget.release(2)
+        self.assertEqual(budget.resize(1, 3), 3)
+        self.assertEqual(budget.stats()['held'], 5)
+        # Поток берет соединения на все дорожки сразу или не берет ни одного
+        budget.release(1)
+        self.assertFalse(budget.try_acquire(2))
+        self.assertTrue(budget.try_acquire(1))
+
+    def test_waits_for_first_connection(self):
+        budget = ConnectionBudget(total=1)
+        budget.acquire(1)
+        result = {}
+        waiter = threading.Thread(target=lambda: result.update(granted=budget.acquire(3)))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertNotIn('granted', result)
+        budget.release(1)
+        waiter.join(2)
+        self.assertEqual(result.get('granted'), 1)
+
+
+class TestFragmentController(unittest.TestCase):
+    """Тестирование AIMD-подбора параллельности фрагментов"""
+
+    def setUp(self):
+        self.tuner = FragmentTuner(ConnectionBudget(total=8))
+
+    def run_window(self, controller, state, nbytes, fragments_done, errors=0):
+        for _ in range(errors):
+            controller.logger.debug('[download] Got error: HTTP Error 429: Too Many Requests. Retrying fragment 7 (1/10)...')
+        state['downloaded_bytes'] += nbytes
+        if 'fragment_index' in state:
+            state['fragment_index'] += fragments_done
+        # Окно измерения считаем прошедшим
+        controller.window_started = time.monotonic() - fragments.FRAGMENT_WINDOW
+        controller.hook(dict(state))
+
+    def start(self, url='https://www.youtube.com/watch?v=x', tier='premium', protocol='m3u8_native'):
+        controller = self.tuner.controller(url, None, tier)
+        options = controller.start()
+        # До выбора форматов загрузка держит одно соединение
+        self.assertEqual(options['concurrent_fragment_downloads'], 1)
+        params = dict(options)
+        controller.attach(params)
+        # YoutubeDL вызывает match_filter с выбранными форматами перед загрузкой
+        self.assertIsNone(params['match_filter']({'requested_formats': [{'protocol': protocol}, {'protocol': 'https'}]}))
+        state = {'status': 'downloading', 'tmpfilename': 'v.f137.mp4.part', 'downloaded_bytes': 0}
+        if protocol != 'https':
+            state['fragment_index'] = 0
+        controller.hook(dict(state))
+        return controller, params, state
+
+    def test_additive_increase_and_multiplicative_decrease(self):
+        controller, params, state = self.start()
+        self.assertEqual(params['concurrent_fragment_downloads'], fragments.FRAGMENT_CONCURRENCY_START)
+        # Скорость растет без ошибок — по одному соединению за окно
+        for nbytes in (4, 6, 9):
+            self.run_window(controller, state, nbytes * 1024 * 1024, 5)
+        self.assertEqual(params['concurrent_fragment_downloads'], fragments.FRAGMENT_CONCURRENCY_START + 3)
+        # Скорость перестала расти — параллельность держится
+        self.run_window(controller, state, 9 * 1024 * 1024, 5)
+        self.assertEqual(params['concurrent_fragment_downloads'], 6)
+        # Источник начал отвечать 429 — вдвое меньше
+        self.run_window(controller, state, 2 * 1024 * 1024, 2, errors=3)
+        self.assertEqual(params['concurrent_fragment_downloads'], 3)
+        stats = self.tuner.stats()
+        self.assertEqual((stats['increases'], stats['decreases'], stats['errors']), (3, 1, 3))
+        controller.close()
+        self.assertEqual(self.tuner.connections.stats()['held'], 0)
+
+    def test_single_connection_download_takes_one_slot(self):
+        controller, params, state = self.start(protocol='https')
+        for nbytes in (1, 2, 4):
+            self.run_window(controller, state, nbytes * 1024 * 1024, 0)
+        self.assertEqual(params['concurrent_fragment_downloads'], 1)
+        self.assertEqual(self.tuner.connections.stats()['held'], 1)
+        controller.close()
+        # Параллельность источника по такой загрузке не запоминается
+        self.assertIsNone(self.tuner.learned(controller.key))
+
+    def test_current_track_keeps_its_connections(self):
+        controller, params, state = self.start()
+        self.run_window(controller, state, 1024 * 1024, 2, errors=1)
+        # Пул потоков текущей дорожки уже создан на 3 соединения — в бюджете они остаются за загрузкой
+        self.assertEqual(params['concurrent_fragment_downloads'], 1)
+        self.assertEqual(self.tuner.connections.stats()['held'], 3)
+        # Началась следующая дорожка с новым значением — лишние соединения возвращаются
+        audio = {'status': 'downloading', 'tmpfilename': 'v.f140.m4a.part', 'downloaded_bytes': 0, 'fragment_index': 0}
+        controller.hook(dict(audio))
+        self.run_window(controller, audio, 1024 * 1024, 2)
+        self.assertEqual(self.tuner.connections.stats()['held'], 1)
+        controller.close()
+
+    def test_learned_per_source_and_tier_bounds(self):
+        controller, params, state = self.start()
+        self.run_window(controller, state, 1024 * 1024, 2, errors=1)
+        controller.close()
+        self.assertEqual(self.tuner.learned(source_key('https://youtube.com/watch?v=y'))['window'], 1.5)
+        # Следующая загрузка с того же источника начинает с подобранного значения
+        controller, params, _ = self.start(url='https://youtube.com/watch?v=y')
+        self.assertEqual(params['concurrent_fragment_downloads'], 1)
+        controller.close()
+        controller, params, state = self.start(url='https://vimeo.com/1', tier='free')
+        for nbytes in (1, 2, 4, 8):
+            self.run_window(controller, state, nbytes * 1024 * 1024, 3)
+        self.assertEqual(params['concurrent_fragment_downloads'], fragments.FRAGMENT_CONCURRENCY_MAX['free'])
+        controller.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import sys
+import os
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from info_cache import InfoCache
+from reaper import ExpiryReaper
+
+
+class TestInfoCache(unittest.TestCase):
+    """Тестирование двухуровневого кэша информации о видео"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'info_cache.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lru_by_entries_and_bytes(self):
+        cache = InfoCache(max_entries=2, max_bytes=10 ** 6)
+        cache.set('a', {'title': 'A'})
+        cache.set('b', {'title': 'B'})
+        cache.get('a')
+        cache.set('c', {'title': 'C'})
+        # 'b' использовался давнее всех
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), {'title': 'A'})
+
+        small = InfoCache(max_entries=100, max_bytes=40)
+        small.set('a', {'title': 'x' * 10})
+        small.set('b', {'title': 'y' * 10})
+        self.assertIsNone(small.get('a'))
+        self.assertLessEqual(small.stats()['bytes'], 40)
+
+    def test_ttl_and_counters(self):
+        cache = InfoCache()
+        cache.set('a', {'title': 'A'}, ttl=0.05)
+        self.assertIsNotNone(cache.get('a'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_disk_tier_and_warm_up(self):
+        cache = InfoCache(self.path, warmup=1)
+        cache.set('old', {'title': 'Old'})
+        time.sleep(0.01)
+        cache.set('new', {'title': 'New'})
+
+        # "Перезапуск": в память сразу поднимается только самая свежая запись
+        restarted = InfoCache(self.path, warmup=1)
+        self.assertEqual(list(restarted.entries), ['new'])
+        self.assertEqual(restarted.get('old'), {'title': 'Old'})
+        self.assertEqual(restarted.stats()['disk_hits'], 1)
+
+    def test_reads_update_accessed_for_warm_up(self):
+        cache = InfoCache(self.path, warmup=1, touch_interval=0)
+        cache.set('old', {'title': 'Old'})
+        time.sleep(0.01)
+        cache.set('new', {'title': 'New'})
+        time.sleep(0.01)
+        # Запись, которую читают, горячее той, что просто записали позже
+        cache.get('old')
+
+        restarted = InfoCache(self.path, warmup=1)
+        self.assertEqual(list(restarted.entries), ['old'])
+
+    def test_accessed_written_in_batches(self):
+        cache = InfoCache(self.path, touch_interval=3600)
+        cache.set('a', {'title': 'A'})
+        cache.get('a')
+        self.assertEqual(len(cache.touched), 1)
+        self.assertEqual(cache.flush_access(), 1)
+        self.assertEqual(cache.touched, {})
+
+    def test_disk_hits_do_not_pile_up_in_reaper(self):
+        reaper = ExpiryReaper()
+        cache = InfoCache(self.path, max_entries=1, reaper=reaper)
+        cache.set('a', {'title': 'A'})
+        cache.set('b', {'title': 'B'})
+        # 'a' и 'b' по очереди вытесняют друг друга из памяти и поднимаются с диска с тем же сроком
+        for _ in range(20):
+            cache.get('a')
+            cache.get('b')
+        self.assertEqual(cache.stats()['disk_hits'], 40)
+        self.assertEqual(reaper.stats()['pending'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
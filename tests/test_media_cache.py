@@ -0,0 +1,79 @@
+import unittest
+import sys
+import os
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from media_cache import MediaCache
+
+
+class TestMediaCache(unittest.TestCase):
+    """Тестирование кэша готовых файлов"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.tmp.name, 'cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_file(self, name, size):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def put(self, cache, vid, size, selector='best', task_id=None):
+        ck = cache.content_key('Youtube', vid, '137+140')
+        return cache.put(cache.request_key(f'youtube:{vid}', selector), ck, self.make_file(vid + '.mp4', size), vid + '.mp4', vid,
+                         task_id=task_id)
+
+    def test_hit_and_alias(self):
+        cache = MediaCache(self.folder, budget=1000)
+        entry = self.put(cache, 'a', 100)
+        self.assertTrue(os.path.isfile(entry['path']))
+        self.assertEqual(cache.lookup('youtube:a|best')['path'], entry['path'])
+        # Другой селектор дал тот же формат — второй файл не хранится
+        self.put(cache, 'a', 100, selector='bestvideo+bestaudio')
+        self.assertEqual(cache.stats()['used'], 100)
+        self.assertIsNone(cache.lookup('youtube:b|best'))
+
+    def test_lru_eviction_skips_referenced(self):
+        cache = MediaCache(self.folder, budget=250)
+        a = self.put(cache, 'a', 100)
+        self.put(cache, 'b', 100)
+        cache.acquire(a['key'])
+        self.put(cache, 'c', 100)
+        # 'a' самый старый, но отдается клиенту — вытесняется 'b'
+        self.assertIsNotNone(cache.lookup('youtube:a|best'))
+        self.assertIsNone(cache.lookup('youtube:b|best'))
+        self.assertIsNotNone(cache.lookup('youtube:c|best'))
+
+    def test_finished_task_file_pinned_until_task_expires(self):
+        cache = MediaCache(self.folder, budget=250, pin_ttl=0.1)
+        a = self.put(cache, 'a', 100, task_id='t1')
+        self.put(cache, 'b', 100)
+        self.put(cache, 'c', 100)
+        # Задача t1 завершилась, но за файлом еще не приходили — вытесняется 'b'
+        self.assertTrue(os.path.isfile(a['path']))
+        self.assertIsNone(cache.lookup('youtube:b|best'))
+        # Пока срок не вышел, обработчик закрепление не снимает
+        self.assertIsNone(cache._unpin((a['key'], 't1')))
+
+        time.sleep(0.15)
+        self.assertEqual(cache._unpin((a['key'], 't1')), 0)
+        self.put(cache, 'd', 100)
+        self.assertFalse(os.path.isfile(a['path']))
+
+    def test_index_survives_restart(self):
+        cache = MediaCache(self.folder, budget=1000)
+        self.put(cache, 'a', 100)
+        reloaded = MediaCache(self.folder, budget=1000)
+        self.assertEqual(reloaded.lookup('youtube:a|best')['title'], 'a')
+        self.assertEqual(reloaded.stats()['used'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
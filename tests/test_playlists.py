@@ -0,0 +1,262 @@
+import unittest
+import sys
+import os
+import io
+import time
+import shutil
+import zipfile
+import tempfile
+import threading
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import playlists
+from playlists import PlaylistArchive, PlaylistBrowser
+from info_cache import InfoCache
+from extensions import TaskManager
+from scheduler import DownloadScheduler
+
+
+class FakeDownloadService:
+    """Вместо yt-dlp пишет в папку плейлиста файл с известным содержимым"""
+    def __init__(self, count, fail=()):
+        self.count = count
+        self.fail = fail
+        self.calls = 0
+        self.users = set()
+        self.running = 0
+        self.max_running = 0
+        self.delay = 0
+        self.lookups = []
+        self.lock = threading.Lock()
+
+    def lookup_info(self, url, playlist_items=None):
+        with self.lock:
+            self.lookups.append((url, playlist_items))
+        if url.startswith('https://test/video/'):
+            index = int(url.rsplit('/', 1)[1])
+            if index in self.fail:
+                raise Exception('Video unavailable')
+            return {'title': f'Video {index}', 'duration': 60 * index, 'formats': []}
+        start, end = (int(x) for x in playlist_items.split('-'))
+        return {'_type': 'playlist', 'title': 'Test list',
+                'entries': [{'id': str(i), 'title': f'Video {i}', 'url': f'https://test/{i}', 'playlist_index': i}
+                            for i in range(start, min(end, self.count) + 1)]}
+
+    @staticmethod
+    def format_duration(duration, default=''):
+        return f'{duration} sec' if duration else default
+
+    def video_summary(self, info):
+        return {'title': info['title'], 'duration': self.format_duration(info['duration']), 'sizes': {'best': '1 MB'}}
+
+    def estimate_size(self, url, quality, limit_height=None):
+        return None
+
+    def download_media(self, url, quality, limit_height, ratelimit, sleep_interval, outtmpl, progress_hook, user=None):
+        with self.lock:
+            self.calls += 1
+            self.users.add(user)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        index = int(url.rsplit('/', 1)[1])
+        if index in self.fail:
+            raise Exception('Video unavailable')
+        progress_hook({'status': 'downloading', 'downloaded_bytes': 5, 'total_bytes': 10})
+        filename = outtmpl.replace('%(title)s', f'Video {index}').replace('%(ext)s', 'mp4')
+        with open(filename, 'wb') as f:
+            f.write(f'data-{index}'.encode() * 1000)
+        progress_hook({'status': 'finished'})
+        return {'title': f'Video {index}'}, filename
+
+
+class TestPlaylistArchive(unittest.TestCase):
+    """Тестирование потоковой упаковки плейлиста в ZIP"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_archive(self, service, **kwargs):
+        archive = PlaylistArchive('test', **kwargs)
+        archive.work_dir = os.path.join(self.tmp, 'playlist_test')
+        for name, value in (('download_service', service), ('playlist_browser', PlaylistBrowser(service, InfoCache(), workers=1))):
+            patcher = patch.object(playlists, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return archive
+
+    def run_archive(self, archive):
+        result = {}
+        def target():
+            try: result['done'] = archive.run('https://test/list', 'best')
+            except Exception as e: result['error'] = e
+        t = threading.Thread(target=target, daemon=True)
+        t.start()
+        return t, result
+
+    def test_stream_builds_stored_zip(self):
+        archive = self.make_archive(FakeDownloadService(5), parallel=2, buffer_files=1)
+        t, result = self.run_archive(archive)
+        self.assertTrue(archive.attach())
+        data = b''.join(archive.stream(chunk_size=1024))
+        t.join(5)
+
+        self.assertEqual(result.get('done'), 5)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            names = sorted(zf.namelist())
+            self.assertEqual(names, [f'{i:03d} - Video {i}.mp4' for i in range(1, 6)])
+            self.assertTrue(all(i.compress_type == zipfile.ZIP_STORED for i in zf.infolist()))
+            self.assertEqual(zf.read('003 - Video 3.mp4'), b'data-3' * 1000)
+        # Временные файлы удалены вместе с папкой
+        self.assertFalse(os.path.exists(archive.work_dir))
+
+    def test_entries_use_owner_fairness_key(self):
+        service = FakeDownloadService(3)
+        archive = self.make_archive(service, parallel=2, user=7)
+        t, _ = self.run_archive(archive)
+        self.assertTrue(archive.attach())
+        b''.join(archive.stream())
+        t.join(5)
+        # Полоса делится по пользователю, а не по архиву
+        self.assertEqual(service.users, {7})
+
+    def test_worker_released_before_client_reads(self):
+        archive = self.make_archive(FakeDownloadService(2), parallel=1, buffer_files=2)
+        t, result = self.run_archive(archive)
+        # Загрузки закончены — воркер пула свободен, хотя клиент еще не пришел
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(result.get('done'), 2)
+        self.assertTrue(os.path.exists(archive.work_dir))
+        self.assertTrue(archive.attach())
+        data = b''.join(archive.stream())
+        self.assertEqual(len(zipfile.ZipFile(io.BytesIO(data)).namelist()), 2)
+        # Папку убрал тот, кто закончил последним, — отдача архива
+        self.assertFalse(os.path.exists(archive.work_dir))
+
+    def test_abandoned_archive_cleaned_by_reaper_handler(self):
+        archive = self.make_archive(FakeDownloadService(1), parallel=1)
+        t, _ = self.run_archive(archive)
+        t.join(5)
+        self.assertIsNotNone(archive._abandon('test'))
+        self.assertTrue(archive.cancelled.is_set())
+        self.assertFalse(archive.attach())
+        self.assertFalse(os.path.exists(archive.work_dir))
+
+    def test_entry_downloads_counted_in_pool(self):
+        service = FakeDownloadService(4)
+        service.delay = 0.1
+        sched = DownloadScheduler(tasks=TaskManager(), workers=2)
+        # Сам плейлист занимает одного воркера, свободен еще один
+        sched.active = 1
+        patcher = patch.object(playlists, 'download_scheduler', sched)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        archive = self.make_archive(service, parallel=3, buffer_files=4)
+        t, result = self.run_archive(archive)
+        t.join(5)
+        self.assertEqual(result.get('done'), 4)
+        self.assertEqual(service.max_running, 2)
+        self.assertEqual(sched.stats()['active'], 1)
+
+    def test_slow_client_bounds_downloads(self):
+        service = FakeDownloadService(10)
+        archive = self.make_archive(service, parallel=2, buffer_files=1)
+        t, _ = self.run_archive(archive)
+        self.assertTrue(archive.attach())
+        time.sleep(0.5)
+        # Пока клиент не читает: по одному файлу в каждом потоке загрузки и один в очереди
+        self.assertLessEqual(service.calls, 3)
+        self.assertLessEqual(len(os.listdir(archive.work_dir)), 3)
+
+        data = b''.join(archive.stream())
+        t.join(5)
+        self.assertEqual(service.calls, 10)
+        self.assertEqual(len(zipfile.ZipFile(io.BytesIO(data)).namelist()), 10)
+
+    def test_failed_entries_are_reported(self):
+        archive = self.make_archive(FakeDownloadService(3, fail=(2,)), parallel=1, buffer_files=2)
+        t, result = self.run_archive(archive)
+        self.assertTrue(archive.attach())
+        data = b''.join(archive.stream())
+        t.join(5)
+
+        self.assertEqual(result.get('done'), 2)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIn('_errors.txt', zf.namelist())
+            self.assertIn('002 - Video 2', zf.read('_errors.txt').decode())
+            self.assertNotIn('002 - Video 2.mp4', zf.namelist())
+
+    def test_client_disconnect_cancels(self):
+        service = FakeDownloadService(20)
+        archive = self.make_archive(service, parallel=2, buffer_files=1)
+        t, _ = self.run_archive(archive)
+        self.assertTrue(archive.attach())
+        # Второй клиент тот же архив получить не может
+        self.assertFalse(archive.attach())
+        body = archive.stream(chunk_size=1024)
+        next(body)
+        body.close()
+        t.join(5)
+
+        self.assertFalse(t.is_alive())
+        self.assertTrue(archive.cancelled.is_set())
+        self.assertLess(service.calls, 20)
+        self.assertFalse(os.path.exists(archive.work_dir))
+
+
+class TestPlaylistBrowser(unittest.TestCase):
+    """Тестирование постраничного просмотра плейлиста"""
+
+    def setUp(self):
+        self.service = FakeDownloadService(120, fail=(3,))
+        self.browser = PlaylistBrowser(self.service, InfoCache(), workers=2)
+
+    def test_pages_use_playlist_items(self):
+        first = self.browser.page('https://test/list', 1, size=50, enrich=False)
+        self.assertEqual(len(first['entries']), 50)
+        self.assertEqual(first['next_cursor'], 51)
+        last = self.browser.page('https://test/list', 101, size=50, enrich=False)
+        self.assertEqual([e['index'] for e in last['entries']], list(range(101, 121)))
+        self.assertIsNone(last['next_cursor'])
+        self.assertEqual(self.service.lookups, [('https://test/list', '1-50'), ('https://test/list', '101-150')])
+
+        # Повторный запрос страницы берется из кэша
+        self.browser.page('https://test/list', 1, size=50, enrich=False)
+        self.assertEqual(len(self.service.lookups), 2)
+
+    def test_iter_entries_stops_at_limit(self):
+        entries = list(self.browser.iter_entries('https://test/list', 70, size=50))
+        self.assertEqual(entries[0], 'Test list')
+        self.assertEqual(len(entries) - 1, 70)
+        self.assertEqual(len(self.service.lookups), 2)
+
+    def test_enrichment_runs_in_background_and_is_cached(self):
+        listing = {'title': 'Test list', 'count': 3, 'cursor': 1, 'next_cursor': None,
+                   'entries': [{'index': i, 'title': f'Video {i}', 'url': f'https://test/video/{i}', 'duration': ''} for i in (1, 2, 3)]}
+        page = self.browser.enrich(listing)
+        self.assertTrue(all(e.get('pending') for e in page['entries']))
+        # Повторный запрос страницы до окончания не ставит ролики в очередь второй раз
+        self.browser.enrich(listing)
+
+        deadline = time.time() + 5
+        while (self.browser.pending or not self.browser.queue.empty()) and time.time() < deadline:
+            time.sleep(0.01)
+        page = self.browser.enrich(listing)
+        self.assertEqual(page['entries'][0]['duration'], '60 sec')
+        self.assertEqual(page['entries'][1]['sizes'], {'best': '1 MB'})
+        self.assertTrue(page['entries'][2].get('unavailable'))
+        video_lookups = [u for u, _ in self.service.lookups if u.startswith('https://test/video/')]
+        self.assertEqual(sorted(video_lookups), ['https://test/video/1', 'https://test/video/2', 'https://test/video/3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
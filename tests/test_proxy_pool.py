@@ -0,0 +1,97 @@
+import unittest
+import sys
+import os
+import socket
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proxy_pool import ProxyPool
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Локальная замена прокси: на любой запрос отвечает 204, как generate_204"""
+
+    def do_GET(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestProxyPool(unittest.TestCase):
+    """Тестирование пула прокси"""
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), HealthHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.good = f'http://127.0.0.1:{self.server.server_port}'
+        self.dead = f'http://127.0.0.1:{free_port()}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_health_probe(self):
+        pool = ProxyPool([self.good, self.dead], health_url='http://health.check/generate_204', timeout=2, threshold=1)
+        pool.check_all()
+        stats = {s['proxy']: s for s in pool.stats()}
+        self.assertIsNotNone(stats[self.good]['latency'])
+        self.assertEqual(stats[self.dead]['state'], 'open')
+        self.assertEqual({pool.acquire() for _ in range(3)}, {self.good})
+
+    def test_probe_does_not_reset_bot_failures(self):
+        pool = ProxyPool([self.good], health_url='http://health.check/generate_204', timeout=2, threshold=2)
+        pool.record(self.good, False, 'bot')
+        # Прокси отвечает на generate_204, но YouTube через него все равно просит капчу
+        self.assertIsNotNone(pool.probe(self.good))
+        pool.record(self.good, False, 'rate_limit')
+        self.assertEqual(pool.stats()[0]['state'], 'open')
+
+    def test_latency_and_throughput_selection(self):
+        pool = ProxyPool(['http://a:1', 'http://b:1'])
+        pool.record('http://a:1', True, latency=2.0, throughput=5 * 10 ** 6)
+        pool.record('http://b:1', True, latency=0.5, throughput=1 * 10 ** 6)
+        self.assertEqual(pool.acquire('info'), 'http://b:1')
+        self.assertEqual(pool.acquire('download'), 'http://a:1')
+
+    def test_circuit_breaker(self):
+        pool = ProxyPool(['http://a:1', 'http://b:1'], threshold=2, cooldown=0.1)
+        pool.record('http://a:1', True, latency=1.0)
+        pool.record('http://b:1', True, latency=0.1)
+        pool.record('http://b:1', False, 'bot')
+        # Ошибки самого видео прокси не штрафуют
+        pool.record('http://b:1', False, 'unavailable')
+        pool.record('http://b:1', False, 'bot')
+        self.assertEqual(pool.acquire('info'), 'http://b:1')
+
+        pool.record('http://b:1', False, 'rate_limit')
+        pool.record('http://b:1', False, 'bot')
+        self.assertEqual({pool.acquire('info') for _ in range(3)}, {'http://a:1'})
+
+        # После паузы — один пробный запрос, успех возвращает прокси в работу
+        time.sleep(0.15)
+        self.assertEqual(pool.acquire('info'), 'http://b:1')
+        self.assertEqual(pool.acquire('info'), 'http://a:1')
+        pool.record('http://b:1', True, latency=0.1)
+        pool.release('http://b:1')
+        self.assertEqual(pool.stats()[1]['state'], 'closed')
+
+    def test_all_open_still_serves(self):
+        pool = ProxyPool(['http://a:1'], threshold=1, cooldown=60)
+        pool.record('http://a:1', False, 'network')
+        self.assertEqual(pool.acquire(), 'http://a:1')
+        self.assertIsNone(ProxyPool([]).acquire())
+
+
+if __name__ == '__main__':
+    unittest.main()
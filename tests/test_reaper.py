@@ -0,0 +1,82 @@
+import unittest
+import sys
+import os
+import time
+import shutil
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reaper import ExpiryReaper
+from info_cache import InfoCache
+from storage import StorageManager
+from extensions import TaskManager, TASK_TTL
+
+
+class TestExpiryReaper(unittest.TestCase):
+    """Тестирование фонового удаления по сроку"""
+
+    def test_runs_due_items_in_deadline_order(self):
+        reaper = ExpiryReaper(batch=2)
+        calls = []
+        now = time.time() + 3600
+        for key, offset in (('c', 3), ('a', 1), ('b', 2), ('late', 10)):
+            reaper.schedule('test', key, now + offset, lambda k: calls.append(k) or 10)
+        # За один проход не больше batch элементов, срок которых наступил
+        self.assertEqual(reaper.run_due(now + 5), 2)
+        self.assertEqual(reaper.run_due(now + 5), 1)
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        stats = reaper.stats()
+        self.assertEqual((stats['pending'], stats['expired'], stats['bytes_freed']), (1, {'test': 3}, 30))
+
+    def test_stale_items_are_not_counted(self):
+        reaper = ExpiryReaper()
+        reaper.schedule('test', 'x', time.time() - 1, lambda k: None)
+        reaper.schedule('test', 'y', time.time() - 1, lambda k: 1 / 0)
+        self.assertEqual(reaper.run_due(), 0)
+        stats = reaper.stats()
+        self.assertEqual((stats['expired'], stats['errors']), ({}, 1))
+
+    def test_background_thread_wakes_for_earlier_deadline(self):
+        reaper = ExpiryReaper()
+        done = []
+        reaper.schedule('test', 'far', time.time() + 3600, done.append)
+        reaper.schedule('test', 'near', time.time() + 0.05, lambda k: done.append(k) or 0)
+        deadline = time.time() + 2
+        while not done and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(done, ['near'])
+        self.assertGreaterEqual(reaper.stats()['lag_last'], 0)
+
+    def test_tasks_info_and_files(self):
+        reaper = ExpiryReaper()
+        tm = TaskManager(reaper=reaper)
+        tid = tm.create_task()
+        kept = tm.create_task()
+        # Задача "создана" больше часа назад; вторая еще жива, хотя ее срок в куче тоже наступит
+        tm.backend.tasks[tid]['start_time'] -= TASK_TTL + 1
+        cache = InfoCache(ttl=0.01, reaper=reaper)
+        cache.set('key', {'title': 'x'})
+        tmp = tempfile.mkdtemp()
+        try:
+            storage = StorageManager(budget=1000, ttl=0.01, reaper=reaper)
+            path = os.path.join(tmp, 'file.mp4')
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            storage.reserve('owner', 100)
+            storage.commit('owner', path)
+            time.sleep(0.05)
+            reaper.run_due(time.time() + TASK_TTL + 1)
+            self.assertIsNone(tm.get_task(tid))
+            self.assertIsNotNone(tm.get_task(kept))
+            self.assertEqual(cache.entries, {})
+            self.assertFalse(os.path.exists(path))
+            stats = reaper.stats()
+            self.assertEqual(stats['expired'], {'task': 1, 'info': 1, 'file': 1})
+            self.assertGreaterEqual(stats['bytes_freed'], 100)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import services
+from services import DownloadService
+from storage import StorageManager
+from extensions import task_manager
+
+
+class TestResumableDownload(unittest.TestCase):
+    """Тестирование продолжения загрузки после перезапуска"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.service = DownloadService()
+        self.storage = StorageManager(budget=10 ** 9)
+        self.cache = MagicMock()
+        self.cache.put.return_value = None
+        self.patches = [patch.object(services, 'DOWNLOAD_FOLDER', self.tmp),
+                        patch.object(services, 'storage', self.storage),
+                        patch.object(services, 'media_cache', self.cache)]
+        for p in self.patches:
+            p.start()
+        self.task_id = task_manager.create_task()
+        self.work_dir = os.path.join(self.tmp, self.task_id)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def fake_download(self, calls):
+        def download_media(url, quality, limit_height, ratelimit, sleep_interval, outtmpl, progress_hook, user=None):
+            # Загрузка идет в рабочую папку задачи, где лежат остатки прошлого запуска
+            calls.append(sorted(os.listdir(os.path.dirname(outtmpl))))
+            part = os.path.join(self.work_dir, 'Video.mp4.part')
+            filename = outtmpl.replace('%(title)s', 'Video').replace('%(ext)s', 'mp4')
+            if os.path.exists(part):
+                os.replace(part, filename)
+            else:
+                with open(filename, 'wb') as f:
+                    f.write(b'x' * 10)
+            return {'title': 'Video', 'id': 'v', 'extractor_key': 'Test', 'format_id': '18'}, filename
+        return download_media
+
+    def run_download(self):
+        self.service.background_download(self.task_id, 'https://test/v', '720', None, None, None, 0)
+        return task_manager.get_task(self.task_id)
+
+    def test_resumes_in_task_work_dir(self):
+        # Процесс упал посреди загрузки: в рабочей папке остались .part и манифест фрагментов
+        os.makedirs(self.work_dir)
+        for name, data in (('Video.mp4.part', b'x' * 5), ('Video.mp4.ytdl', b'{}')):
+            with open(os.path.join(self.work_dir, name), 'wb') as f:
+                f.write(data)
+        calls = []
+        with patch.object(self.service, 'download_media', side_effect=self.fake_download(calls)):
+            task = self.run_download()
+        self.assertEqual(calls, [['Video.mp4.part', 'Video.mp4.ytdl']])
+        self.assertEqual(task['status'], 'finished')
+        self.assertTrue(task['resumed'])
+        self.assertEqual(task['filename'], os.path.join(self.work_dir, 'Video.mp4'))
+        self.assertEqual(task['download_name'], 'Video.mp4')
+        self.assertEqual(self.storage.stats()['reserved'], 0)
+
+    def test_completed_download_not_repeated(self):
+        calls = []
+        with patch.object(self.service, 'download_media', side_effect=self.fake_download(calls)):
+            self.run_download()
+            # Перезапуск после того, как файл был готов, но задача не успела завершиться
+            task_manager.update_task(self.task_id, status='downloading')
+            task = self.run_download()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(task['status'], 'finished')
+        self.assertTrue(os.path.isfile(task['filename']))
+
+    def test_error_removes_work_dir(self):
+        with patch.object(self.service, 'download_media', side_effect=Exception('Video unavailable')):
+            task = self.run_download()
+        self.assertEqual(task['status'], 'error')
+        self.assertFalse(os.path.exists(self.work_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
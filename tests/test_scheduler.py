@@ -0,0 +1,196 @@
+import unittest
+import sys
+import os
+import threading
+import time
+import uuid
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import TaskManager, JobStore
+from scheduler import DownloadScheduler, QueueFullError
+from fragments import ConnectionBudget
+
+
+class TestDownloadScheduler(unittest.TestCase):
+    """Тестирование пула воркеров и приоритетных очередей"""
+
+    def setUp(self):
+        self.tm = TaskManager()
+        self.gate = threading.Event()
+        self.order = []
+        self.done = threading.Event()
+
+    def job(self, task_id):
+        self.gate.wait(5)
+        self.order.append(task_id)
+        if len(self.order) == self.expected:
+            self.done.set()
+
+    def test_bounded_queue(self):
+        sched = DownloadScheduler(tasks=self.tm, workers=1, max_queue=2)
+        sched.register('job', self.job)
+        self.expected = 3
+        blocker = self.tm.create_task()
+        sched.submit(blocker, 'job')
+        # Ждем, пока единственный воркер заберет первую задачу
+        for _ in range(100):
+            if sched.stats()['active']: break
+            threading.Event().wait(0.01)
+        sched.submit(self.tm.create_task(), 'job')
+        sched.submit(self.tm.create_task(), 'job')
+        with self.assertRaises(QueueFullError):
+            sched.submit(self.tm.create_task(), 'job')
+        self.gate.set()
+        self.assertTrue(self.done.wait(5))
+
+    def test_unknown_kind_fails_job_not_worker(self):
+        sched = DownloadScheduler(tasks=self.tm, workers=1)
+        sched.register('job', self.job)
+        self.expected = 1
+        self.gate.set()
+        orphan = self.tm.create_task()
+        sched.submit(orphan, 'missing')
+        sched.submit(self.tm.create_task(), 'job')
+        # Тот же воркер выполняет следующую задачу
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.tm.get_task(orphan)['status'], 'error')
+
+    def test_premium_priority_and_positions(self):
+        sched = DownloadScheduler(tasks=self.tm, workers=1, max_queue=10, premium_burst=2)
+        sched.register('job', self.job)
+        self.expected = 6
+        blocker = self.tm.create_task()
+        sched.submit(blocker, 'job')
+        for _ in range(100):
+            if sched.stats()['active']: break
+            threading.Event().wait(0.01)
+
+        free = [self.tm.create_task() for _ in range(2)]
+        premium = [self.tm.create_task() for _ in range(3)]
+        for tid in free:
+            sched.submit(tid, 'job')
+        for tid in premium:
+            sched.submit(tid, 'job', premium=True)
+
+        # Две Premium-задачи, затем одна бесплатная, затем снова Premium
+        self.assertEqual(sched.position(premium[0]), 1)
+        self.assertEqual(sched.position(free[0]), 3)
+        self.assertEqual(sched.position(premium[2]), 4)
+        self.assertEqual(sched.with_position(free[1], self.tm.get_task(free[1]))['queue_position'], 5)
+        self.assertEqual(sched.position(blocker), 0)
+        self.assertEqual(self.tm.get_task(free[1])['status'], 'queued')
+
+        self.gate.set()
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.order, [blocker, premium[0], premium[1], free[0], premium[2], free[1]])
+
+    def test_job_saved_outside_scheduler_lock(self):
+        sched = DownloadScheduler(tasks=self.tm, workers=1, max_queue=1)
+        test = self
+        blocked = []
+
+        class SlowJobs:
+            def create(self, *args):
+                # Пока задача пишется в БД, другой поток может обратиться к планировщику
+                t = threading.Thread(target=sched.stats)
+                t.start()
+                t.join(1)
+                blocked.append(t.is_alive())
+                # Место уже занято — параллельный submit получает отказ, а не переполняет очередь
+                with test.assertRaises(QueueFullError):
+                    sched.submit(test.tm.create_task(), 'job')
+
+        sched.jobs = SlowJobs()
+        sched.register('job', self.job)
+        self.expected = 1
+        self.gate.set()
+        sched.submit(self.tm.create_task(), 'job')
+        self.assertEqual(blocked, [False])
+        self.assertTrue(self.done.wait(5))
+
+    def test_slots_for_helper_downloads(self):
+        sched = DownloadScheduler(tasks=self.tm, workers=2)
+        self.assertTrue(sched.acquire_slot(timeout=0.1))
+        self.assertTrue(sched.acquire_slot(timeout=0.1))
+        # Пул занят вспомогательными загрузками
+        self.assertFalse(sched.acquire_slot(timeout=0.05))
+        sched.release_slot()
+        # Задачи в очереди идут раньше вспомогательных загрузок
+        sched.lanes['free'].append(('queued', 'job', ()))
+        self.assertFalse(sched.acquire_slot(timeout=0.05))
+        sched.lanes['free'].clear()
+        self.assertTrue(sched.acquire_slot(timeout=0.1))
+        self.assertEqual(sched.stats()['active'], 2)
+
+    def test_waits_for_free_connections(self):
+        connections = ConnectionBudget(total=2)
+        sched = DownloadScheduler(tasks=self.tm, workers=2, connections=connections)
+        sched.register('job', self.job)
+        self.expected = 1
+        # Все соединения заняты загрузками (например, элементами плейлиста) — задача остается в очереди
+        held = connections.acquire(2)
+        tid = self.tm.create_task()
+        sched.submit(tid, 'job')
+        self.gate.set()
+        time.sleep(0.1)
+        self.assertEqual(self.order, [])
+        self.assertEqual(sched.position(tid), 1)
+        connections.release(held)
+        self.assertTrue(self.done.wait(5))
+
+
+class TestJobRecovery(unittest.TestCase):
+    """Тестирование подбора задач после падения процесса"""
+
+    def setUp(self):
+        # Отдельная временная БД: тест не трогает database.db приложения
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'jobs.db')
+        with self.db() as conn:
+            conn.execute('''CREATE TABLE download_jobs
+                            (task_id TEXT PRIMARY KEY, kind TEXT, params TEXT, lane TEXT, status TEXT, state TEXT,
+                             owner TEXT, heartbeat REAL, created_at REAL, updated_at REAL)''')
+            conn.commit()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @contextmanager
+    def db(self):
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def test_orphan_is_reclaimed_and_rerun(self):
+        self.tid = str(uuid.uuid4())
+        # "Старый" процесс сохранил задачу и умер, не успев ее доделать
+        dead = JobStore(db=self.db)
+        dead.create(self.tid, 'job', ['http://test.com', '720'], 'free', {'status': 'downloading', 'progress': '42'})
+        with self.db() as conn:
+            conn.execute('UPDATE download_jobs SET heartbeat = ? WHERE task_id = ?', (time.time() - 3600, self.tid))
+            conn.commit()
+
+        # Новый процесс видит последнее сохраненное состояние еще до подбора
+        tm = TaskManager(jobs=JobStore(db=self.db))
+        self.assertEqual(tm.get_task(self.tid)['progress'], '42')
+
+        done = threading.Event()
+        calls = []
+        sched = DownloadScheduler(tasks=tm, jobs=tm.jobs, workers=1)
+        sched.register('job', lambda tid, *args: (calls.append((tid, args)), done.set()))
+        self.assertEqual(sched.recover(), 1)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, [(self.tid, ('http://test.com', '720'))])
+        # Повторно ту же задачу никто не заберет
+        self.assertEqual(JobStore(db=self.db).claim_orphans(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+import unittest
+import sys
+import os
+import threading
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import task_manager
+from services import DownloadService, InfoLookupError, ProgressReporter, StrategyMemory, get_friendly_error
+from url_keys import canonical_key, normalize_url
+from proxy_pool import ProxyPool
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Тестирование объединения одинаковых загрузок"""
+
+    def setUp(self):
+        self.ds = DownloadService()
+
+    def test_canonical_key(self):
+        for url in ['https://youtu.be/dQw4w9WgXcQ?si=abc',
+                    'https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=30',
+                    'https://m.youtube.com/watch?v=dQw4w9WgXcQ&si=xyz&feature=share',
+                    'https://youtube.com/shorts/dQw4w9WgXcQ']:
+            self.assertEqual(canonical_key(url), 'Youtube:dQw4w9WgXcQ')
+        self.assertEqual(canonical_key('https://www.youtube.com/playlist?list=PL123'), 'YoutubeTab:PL123')
+
+    def test_normalize_unknown_url(self):
+        self.assertEqual(normalize_url('HTTPS://WWW.Example.com/video/?utm_source=x&b=2&a=1#frag'),
+                         'https://example.com/video?a=1&b=2')
+        self.assertEqual(canonical_key('https://example.com/v.mp4?si=1'), 'url:https://example.com/v.mp4')
+
+    def test_follower_mirrors_leader(self):
+        leader = task_manager.create_task()
+        follower = task_manager.create_task()
+        self.assertIsNone(self.ds.join_inflight(leader, 'https://youtu.be/dQw4w9WgXcQ', '720', 720, 500 * 1024, 1))
+        self.assertEqual(self.ds.join_inflight(follower, 'https://www.youtube.com/watch?v=dQw4w9WgXcQ', '720', 720, 500 * 1024, 2), leader)
+
+        task_manager.update_task(leader, status='downloading', progress='55')
+        self.assertEqual(task_manager.get_task(follower)['progress'], '55')
+
+        task_manager.update_task(leader, status='finished', filename='downloads/x.mp4')
+        self.assertEqual(task_manager.get_task(follower)['filename'], 'downloads/x.mp4')
+        self.assertEqual(self.ds.leave_inflight(leader), [(follower, 2)])
+
+    def test_different_format_or_premium_not_coalesced(self):
+        leader = task_manager.create_task()
+        self.assertIsNone(self.ds.join_inflight(leader, 'https://youtu.be/dQw4w9WgXcQ', '720', 720, 500 * 1024))
+        # Аудио — другой формат
+        self.assertIsNone(self.ds.join_inflight(task_manager.create_task(), 'https://youtu.be/dQw4w9WgXcQ', 'audio', 720, 500 * 1024))
+        # Premium не ждет загрузку с ограничением скорости
+        premium = task_manager.create_task()
+        self.assertIsNone(self.ds.join_inflight(premium, 'https://youtu.be/dQw4w9WgXcQ', '720', None, None))
+        # ...но становится лидером для следующих Premium-запросов (и бесплатных тоже)
+        self.assertEqual(self.ds.join_inflight(task_manager.create_task(), 'https://youtu.be/dQw4w9WgXcQ', '720', None, None), premium)
+        self.assertEqual(self.ds.join_inflight(task_manager.create_task(), 'https://youtu.be/dQw4w9WgXcQ', '720', 720, 500 * 1024), premium)
+
+    def test_followers_restored_with_leader(self):
+        leader = task_manager.create_task()
+        follower = task_manager.create_task()
+        self.ds.join_inflight(leader, 'https://youtu.be/dQw4w9WgXcQ', '720', 720, 500 * 1024, 1)
+        self.ds.join_inflight(follower, 'https://youtu.be/dQw4w9WgXcQ', '720', 720, 500 * 1024, 2)
+        state = dict(task_manager.get_task(leader), status='queued')
+
+        # "Перезапуск": процесс потерял и память задач, и inflight
+        restarted = DownloadService()
+        task_manager.backend.tasks.pop(follower)
+        task_manager.restore_task(leader, state)
+        self.assertEqual(task_manager.get_task(follower)['leader_id'], leader)
+
+        restarted.resume_inflight(leader, 'https://youtu.be/dQw4w9WgXcQ', '720', 720, 500 * 1024)
+        self.assertEqual(restarted.leave_inflight(leader), [(follower, 2)])
+
+
+class TestInfoLookup(unittest.TestCase):
+    """Тестирование объединения запросов информации и негативного кэша"""
+
+    def setUp(self):
+        self.ds = DownloadService()
+
+    def test_concurrent_lookups_coalesced(self):
+        calls = []
+        def slow_info(url, proxy=None, playlist_items=None):
+            calls.append(url)
+            time.sleep(0.2)
+            return {'title': 'Test'}
+
+        results = []
+        with patch.object(self.ds, 'get_video_info', side_effect=slow_info):
+            threads = [threading.Thread(target=lambda u=u: results.append(self.ds.lookup_info(u)))
+                       for u in ['https://youtu.be/dQw4w9WgXcQ'] * 4 + ['https://www.youtube.com/watch?v=dQw4w9WgXcQ']]
+            for t in threads: t.start()
+            for t in threads: t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'title': 'Test'}] * 5)
+
+    def test_negative_cache(self):
+        with patch.object(self.ds, 'get_video_info', side_effect=Exception('ERROR: Private video. Sign in')) as mock_info:
+            for _ in range(3):
+                with self.assertRaises(InfoLookupError) as ctx:
+                    self.ds.lookup_info('https://youtu.be/dQw4w9WgXcQ')
+            self.assertEqual(mock_info.call_count, 1)
+            self.assertEqual(ctx.exception.error_class, 'private')
+            self.assertEqual(get_friendly_error(ctx.exception), 'Это приватное видео. Для скачивания нужен доступ.')
+
+            # Истекший негативный кэш — снова идем в yt-dlp
+            self.ds.info_errors['Youtube:dQw4w9WgXcQ']['expires'] = time.time() - 1
+            with self.assertRaises(InfoLookupError):
+                self.ds.lookup_info('https://youtu.be/dQw4w9WgXcQ')
+            self.assertEqual(mock_info.call_count, 2)
+
+    def test_negative_cache_is_bounded(self):
+        with patch('services.INFO_NEGATIVE_MAX', 3), \
+                patch.object(self.ds, 'get_video_info', side_effect=Exception('ERROR: Private video. Sign in')):
+            for i in range(5):
+                with self.assertRaises(InfoLookupError):
+                    self.ds.lookup_info(f'https://example.com/video/{i}')
+        # Остаются только самые свежие ошибки
+        self.assertEqual(len(self.ds.info_errors), 3)
+        self.assertNotIn(canonical_key('https://example.com/video/0'), self.ds.info_errors)
+        self.assertIn(canonical_key('https://example.com/video/4'), self.ds.info_errors)
+
+
+class FakeYoutubeDL:
+    """Имитация YouTube во время волны бот-проверок: проходят только запросы с минимальными параметрами"""
+    calls = []
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def close(self):
+        pass
+
+    def extract_info(self, url, download=False):
+        strategy = 'full' if 'extractor_args' in self.opts else 'reduced' if 'socket_timeout' in self.opts else 'minimal'
+        FakeYoutubeDL.calls.append(strategy)
+        if strategy != 'minimal':
+            raise Exception('Sign in to confirm you are not a bot')
+        return {'title': 'Test'}
+
+
+class TestStrategyMemory(unittest.TestCase):
+    """Тестирование адаптивного выбора стратегии получения информации"""
+
+    def test_order_prefers_successful(self):
+        memory = StrategyMemory()
+        strategies = ('full', 'reduced', 'minimal')
+        self.assertEqual(memory.order('Youtube', strategies), ['full', 'reduced', 'minimal'])
+        memory.record('Youtube', 'full', False, 30)
+        memory.record('Youtube', 'minimal', True, 1.5)
+        self.assertEqual(memory.order('Youtube', strategies), ['minimal', 'reduced', 'full'])
+        # У другого экстрактора своя история
+        self.assertEqual(memory.order('Vimeo', strategies), ['full', 'reduced', 'minimal'])
+
+    @patch('services.proxy_pool', ProxyPool([]))
+    @patch('services.yt_dlp.YoutubeDL', FakeYoutubeDL)
+    def test_learned_strategy_goes_first(self):
+        ds = DownloadService()
+        FakeYoutubeDL.calls = []
+        ds.get_video_info('https://youtu.be/dQw4w9WgXcQ')
+        self.assertEqual(FakeYoutubeDL.calls, ['full', 'reduced', 'minimal'])
+
+        FakeYoutubeDL.calls = []
+        ds.get_video_info('https://youtu.be/dQw4w9WgXcQ')
+        self.assertEqual(FakeYoutubeDL.calls, ['minimal'])
+
+    @patch('services.proxy_pool', ProxyPool([]))
+    def test_permanent_error_stops_retries(self):
+        ds = DownloadService()
+        with patch('services.yt_dlp.YoutubeDL') as mock_ydl:
+            mock_ydl.return_value.extract_info.side_effect = Exception('ERROR: Video unavailable')
+            with self.assertRaises(Exception):
+                ds.get_video_info('https://youtu.be/dQw4w9WgXcQ')
+            self.assertEqual(mock_ydl.call_count, 1)
+
+
+class TestProgressReporter(unittest.TestCase):
+    """Тестирование хука прогресса"""
+
+    def test_numeric_fields_and_throttling(self):
+        tid = task_manager.create_task()
+        reporter = ProgressReporter(tid, interval=60)
+        with patch.object(task_manager, 'update_task', wraps=task_manager.update_task) as update:
+            for i in range(1, 500):
+                reporter({'status': 'downloading', 'downloaded_bytes': i * 1000, 'total_bytes': 1000000,
+                          'speed': 123456.7, 'eta': 42.5, 'fragment_index': i, 'fragment_count': 500})
+            self.assertEqual(update.call_count, 1)
+            reporter({'status': 'finished'})
+            self.assertEqual(update.call_count, 2)
+
+        task = task_manager.get_task(tid)
+        self.assertEqual(task['status'], 'processing')
+        self.assertEqual((task['downloaded_bytes'], task['total_bytes'], task['speed'], task['eta']), (1000, 1000000, 123457, 42))
+
+    def test_progress_from_fragments(self):
+        fields = ProgressReporter.fields({'downloaded_bytes': 5000, 'fragment_index': 25, 'fragment_count': 100})
+        self.assertEqual(fields['progress'], 25.0)
+        self.assertIsNone(fields['total_bytes'])
+
+
+class TestStreamClaim(unittest.TestCase):
+    """Тестирование одноразовых потоковых ссылок"""
+
+    def setUp(self):
+        self.ds = DownloadService()
+
+    def stream_task(self):
+        tid = task_manager.create_task()
+        task_manager.update_task(tid, status='stream_ready', mode='stream', url='https://youtu.be/x', quality='audio')
+        return tid
+
+    def test_single_use(self):
+        tid = self.stream_task()
+        task, refused = self.ds.claim_stream(tid)
+        self.assertIsNone(refused)
+        self.assertEqual(task_manager.get_task(tid)['status'], 'stream_starting')
+        # Повторный запрос (например, «Поделиться») не запускает вторую загрузку
+        self.assertEqual(self.ds.claim_stream(tid)[1], 'used')
+        self.assertEqual(self.ds.claim_stream(task_manager.create_task())[1], 'missing')
+        self.ds.release_stream()
+        self.assertEqual(self.ds.streams_active, 0)
+
+    def test_limit_of_active_streams(self):
+        with patch('services.STREAM_MAX_ACTIVE', 1):
+            first, second = self.stream_task(), self.stream_task()
+            self.assertIsNone(self.ds.claim_stream(first)[1])
+            self.assertFalse(self.ds.stream_available())
+            self.assertEqual(self.ds.claim_stream(second)[1], 'busy')
+            # Отказ по лимиту не сжигает ссылку
+            self.assertEqual(task_manager.get_task(second)['status'], 'stream_ready')
+            self.ds.release_stream()
+            self.assertIsNone(self.ds.claim_stream(second)[1])
+
+    def test_unopened_stream_link_expires(self):
+        unopened, opened = self.stream_task(), self.stream_task()
+        self.assertIsNone(self.ds.claim_stream(opened)[1])
+        self.assertEqual(self.ds._expire_stream(unopened), 0)
+        self.assertEqual(task_manager.get_task(unopened)['status'], 'error')
+        self.assertEqual(self.ds.claim_stream(unopened)[1], 'used')
+        # Поток уже идет — срок ссылки его не трогает
+        self.assertIsNone(self.ds._expire_stream(opened))
+        self.assertEqual(task_manager.get_task(opened)['status'], 'stream_starting')
+        self.ds.release_stream()
+
+    def test_socks_proxy_disables_streaming(self):
+        with patch('services.proxy_pool', ProxyPool(['http://p1:8080'])):
+            self.assertTrue(self.ds.stream_available())
+        # socks5 ни ffmpeg, ни urllib не поддерживают — поток пошел бы мимо прокси
+        with patch('services.proxy_pool', ProxyPool(['http://p1:8080', 'socks5://p2:1080'])):
+            self.assertFalse(self.ds.stream_available())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+import sys
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import StorageManager
+
+
+class TestStorageManager(unittest.TestCase):
+    """Тестирование учета места под загрузки"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_reserve_and_commit(self):
+        storage = StorageManager(budget=1000, ttl=60)
+        self.assertFalse(storage.fits(1001))
+        self.assertTrue(storage.reserve('a', 600))
+        self.assertFalse(storage.reserve('b', 600))
+        # Фактический размер меньше оценки — резерв пересчитывается
+        storage.commit('a', self.make_file('a.mp4', 100))
+        self.assertEqual((storage.used, storage.reserved), (100, 0))
+        self.assertTrue(storage.reserve('b', 600))
+        storage.cancel('b')
+        self.assertEqual(storage.stats()['reserved'], 0)
+
+    def test_lru_eviction_skips_files_in_use(self):
+        storage = StorageManager(budget=1000, ttl=60)
+        paths = []
+        for name in ('a', 'b', 'c'):
+            storage.reserve(name, 300)
+            paths.append(self.make_file(name, 300))
+            storage.commit(name, paths[-1])
+        # 'a' отдается клиенту, 'b' самый давний из свободных
+        self.assertTrue(storage.acquire('a'))
+        self.assertTrue(storage.reserve('d', 400))
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertTrue(os.path.exists(paths[2]))
+        self.assertEqual(storage.stats()['evicted'], 1)
+        storage.release('a')
+
+    def test_expire_by_index(self):
+        storage = StorageManager(budget=1000, ttl=10)
+        path = self.make_file('old.mp4', 10)
+        storage.reserve('old', 10)
+        storage.commit('old', path)
+        self.assertEqual(storage.expire(time.time() + 5), 0)
+        self.assertEqual(storage.expire(time.time() + 11), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(storage.used, 0)
+
+    def test_adopts_leftovers_once(self):
+        self.make_file('left.mp4', 50)
+        os.makedirs(os.path.join(self.tmp, 'cache'))
+        storage = StorageManager(self.tmp, budget=1000, ttl=60, skip=(os.path.join(self.tmp, 'cache'),))
+        self.assertEqual(storage.used, 50)
+        storage.expire(time.time() + 61)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'left.mp4')))
+        self.assertTrue(os.path.isdir(os.path.join(self.tmp, 'cache')))
+
+    def test_resumed_task_keeps_its_work_dir(self):
+        os.makedirs(os.path.join(self.tmp, 'task1'))
+        self.make_file(os.path.join('task1', 'video.mp4.part'), 400)
+        self.make_file('other.mp4', 400)
+        storage = StorageManager(self.tmp, budget=1000, ttl=60)
+        # Недокачанные 400 байт уже учтены — резервируется только остаток оценки, чужой файл цел
+        self.assertTrue(storage.reserve('task1', 500))
+        self.assertEqual(storage.reserved, 100)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'other.mp4')))
+        # Места не хватает: вытесняется чужой файл, а не остатки самой задачи
+        self.assertTrue(storage.reserve('task2', 300))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'task1', 'video.mp4.part')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'other.mp4')))
+        # Срок остатков снят до завершения загрузки
+        self.assertEqual(storage.expire(time.time() + 3600), 0)
+        self.make_file(os.path.join('task1', 'video.mp4'), 100)
+        storage.commit('task1', os.path.join(self.tmp, 'task1'))
+        self.assertEqual((storage.used, storage.reserved), (500, 300))
+
+    def test_unfinished_task_dir_pinned_until_resumed(self):
+        os.makedirs(os.path.join(self.tmp, 'task1'))
+        self.make_file(os.path.join('task1', 'video.mp4.part'), 400)
+        self.make_file('other.mp4', 400)
+        storage = StorageManager(self.tmp, budget=1000, ttl=60, pinned={'task1'})
+        self.assertEqual(storage.stats()['pinned'], 1)
+        # Задачу еще не подобрали: ни чужой резерв (вытесняет только other.mp4), ни срок не трогают ее остатки
+        self.assertFalse(storage.reserve('big', 700))
+        self.assertEqual(storage.expire(time.time() + 3600), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'task1', 'video.mp4.part')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'other.mp4')))
+        # Задача закончилась ошибкой — остатки удалены и место свободно
+        storage.discard('task1')
+        self.assertTrue(storage.reserve('big', 700))
+        self.assertEqual(storage.stats()['pinned'], 0)
+
+    def test_waits_for_running_download(self):
+        storage = StorageManager(budget=1000, ttl=60)
+        storage.reserve('running', 800)
+        result = {}
+        waiter = threading.Thread(target=lambda: result.update(ok=storage.reserve('next', 500, timeout=5)))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertNotIn('ok', result)
+        # Загрузка упала — резерв снят, ждущая задача стартует
+        storage.discard('running', os.path.join(self.tmp, 'running_*'))
+        waiter.join(2)
+        self.assertTrue(result.get('ok'))
+        self.assertFalse(storage.reserve('late', 600, timeout=0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import sys
+import os
+import io
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import MediaStream, ffmpeg_command, needs_remux, proxy_supported
+
+
+class EndlessSource:
+    """Источник, который отдает данные быстрее любого клиента"""
+    def __init__(self):
+        self.reads = 0
+
+    def read(self, size):
+        self.reads += 1
+        return b'x' * size
+
+    def close(self):
+        pass
+
+
+class FakeStream(MediaStream):
+    def __init__(self, source, **kwargs):
+        super().__init__([{'url': 'http://test/video.mp4', 'protocol': 'https', 'ext': 'mp4'}], **kwargs)
+        self.source = source
+
+    def _open_source(self):
+        if isinstance(self.source, Exception):
+            raise self.source
+        return self.source
+
+
+class TestMediaStream(unittest.TestCase):
+    """Тестирование потоковой отдачи"""
+
+    def test_backpressure_bounds_buffer(self):
+        source = EndlessSource()
+        closed = []
+        stream = FakeStream(source, buffer_chunks=4, chunk_size=1024, on_close=closed.append).start()
+        chunks = iter(stream)
+        for _ in range(3):
+            self.assertEqual(len(next(chunks)), 1024)
+        time.sleep(0.2)
+        # Клиент не читает — источник остановился на размере буфера
+        self.assertLessEqual(source.reads, 4 + 3 + 2)
+        stream.close()
+        self.assertEqual(closed, [stream])
+        self.assertFalse(stream.complete)
+
+    def test_complete_stream(self):
+        stream = FakeStream(io.BytesIO(b'a' * 2500), chunk_size=1000).start()
+        self.assertEqual(b''.join(stream), b'a' * 2500)
+        self.assertTrue(stream.complete)
+        self.assertEqual(stream.bytes_sent, 2500)
+
+    def test_source_error_before_first_byte(self):
+        closed = []
+        with self.assertRaises(ConnectionError):
+            FakeStream(ConnectionError('HTTP Error 403'), on_close=closed.append).start()
+        self.assertEqual(len(closed), 1)
+
+    def test_remux_command(self):
+        video = {'url': 'https://v', 'protocol': 'https', 'vcodec': 'avc1', 'http_headers': {'User-Agent': 'UA'}}
+        audio = {'url': 'https://a', 'protocol': 'https', 'vcodec': 'none'}
+        self.assertFalse(needs_remux([video]))
+        self.assertTrue(needs_remux([video, audio]))
+        self.assertTrue(needs_remux([dict(video, protocol='m3u8_native')]))
+
+        cmd = ffmpeg_command('ffmpeg', [video, audio], proxy='http://proxy:8080')
+        self.assertEqual(cmd[cmd.index('-headers') + 1], 'User-Agent: UA\r\n')
+        self.assertEqual(cmd.count('-http_proxy'), 2)
+        self.assertTrue(proxy_supported(None))
+        self.assertTrue(proxy_supported('https://user:pw@proxy:8443'))
+        self.assertFalse(proxy_supported('socks5://proxy:1080'))
+        self.assertIn('frag_keyframe+empty_moov+default_base_moof', cmd)
+        self.assertEqual(cmd[-1], 'pipe:1')
+        self.assertEqual(FakeStream(None).ext, 'mp4')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+import sys
+import os
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import TaskManager
+from task_backends import SQLiteTaskBackend, RedisTaskBackend
+
+
+class FakeRedis:
+    """Минимальная замена Redis-клиента (только команды, которые использует бэкенд)"""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def hset(self, key, mapping):
+        self.data.setdefault(key, {}).update({k.encode(): v.encode() for k, v in mapping.items()})
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def expire(self, key, ttl):
+        self.ttls[key] = ttl
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, source):
+        # Единственный скрипт бэкенда: HSET, только если ключ существует
+        def update(keys, args):
+            if keys[0] not in self.data:
+                return 0
+            self.hset(keys[0], mapping=dict(zip(args[::2], args[1::2])))
+            return 1
+        return update
+
+
+class FakePipeline:
+    """Команды копятся и выполняются разом в execute()"""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class SharedStateMixin:
+    """Две копии TaskManager с общим бэкендом имитируют два процесса gunicorn"""
+
+    def make_backend(self):
+        raise NotImplementedError
+
+    def test_progress_visible_from_other_worker(self):
+        web_a = TaskManager(backend=self.make_backend())
+        web_b = TaskManager(backend=self.make_backend())
+
+        tid = web_a.create_task()
+        web_a.update_task(tid, status='downloading', progress='37.5')
+
+        task = web_b.get_task(tid)
+        self.assertEqual(task['status'], 'downloading')
+        self.assertEqual(task['progress'], '37.5')
+
+        web_b.update_task(tid, status='finished', filename='downloads/x.mp4')
+        self.assertEqual(web_a.get_task(tid)['filename'], 'downloads/x.mp4')
+
+    def test_unknown_task(self):
+        tm = TaskManager(backend=self.make_backend())
+        tm.update_task('missing', status='finished')
+        self.assertIsNone(tm.get_task('missing'))
+
+
+class TestSQLiteTaskBackend(SharedStateMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'tasks.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_backend(self):
+        return SQLiteTaskBackend(self.path)
+
+    def test_expire(self):
+        backend = self.make_backend()
+        backend.create('old', {'status': 'finished', 'start_time': time.time() - 7200})
+        backend.create('new', {'status': 'finished', 'start_time': time.time()})
+        self.assertEqual(backend.expire(time.time() - 3600), ['old'])
+        self.assertIsNone(backend.get('old'))
+        self.assertIsNotNone(backend.get('new'))
+
+    def test_discard_one(self):
+        backend = self.make_backend()
+        backend.create('old', {'status': 'finished', 'start_time': time.time() - 7200})
+        backend.create('new', {'status': 'finished', 'start_time': time.time()})
+        self.assertTrue(backend.discard('old', time.time() - 3600))
+        self.assertFalse(backend.discard('new', time.time() - 3600))
+        self.assertIsNone(backend.get('old'))
+        self.assertIsNotNone(backend.get('new'))
+
+
+class TestRedisTaskBackend(SharedStateMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeRedis()
+
+    def make_backend(self):
+        return RedisTaskBackend(client=self.client)
+
+    def test_update_of_expired_task_leaves_no_hash(self):
+        backend = self.make_backend()
+        backend.create('t1', {'status': 'queued'})
+        self.assertEqual(self.client.ttls['task:t1'], 3600)
+        # Ключ истек по TTL, а загрузчик еще присылает прогресс
+        del self.client.data['task:t1']
+        self.assertIsNone(backend.update('t1', {'progress': '50'}))
+        self.assertNotIn('task:t1', self.client.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import sys
+import os
+import time
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from task_events import TaskEventPublisher
+from extensions import TaskManager
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event, data, room=None):
+        self.events.append((room, data))
+
+
+class TestTaskEvents(unittest.TestCase):
+    """Тестирование отправки прогресса задач через Socket.IO"""
+
+    def setUp(self):
+        self.socketio = FakeSocketIO()
+        self.events = TaskEventPublisher(self.socketio, interval=0.1)
+
+    def test_updates_coalesced(self):
+        self.events.publish('t1', {'status': 'downloading', 'progress': '1'})
+        for p in range(2, 50):
+            self.events.publish('t1', {'progress': str(p)})
+        # Первое событие уходит сразу, остальные склеиваются в одно
+        self.assertEqual(len(self.socketio.events), 1)
+        time.sleep(0.3)
+        self.assertEqual(len(self.socketio.events), 2)
+        room, data = self.socketio.events[1]
+        self.assertEqual(room, 'task_t1')
+        self.assertEqual(data, {'task_id': 't1', 'progress': '49'})
+
+    def test_final_status_sent_immediately(self):
+        self.events.publish('t1', {'status': 'downloading', 'progress': '10'})
+        self.events.publish('t1', {'progress': '99'})
+        self.events.publish('t1', {'status': 'finished', 'filename': 'x.mp4'})
+        self.assertEqual(self.socketio.events[-1][1], {'task_id': 't1', 'progress': '99', 'status': 'finished', 'filename': 'x.mp4'})
+        time.sleep(0.2)
+        self.assertEqual(len(self.socketio.events), 2)
+
+    def test_final_status_not_overtaken_by_older_batch(self):
+        self.events.publish('t1', {'status': 'downloading', 'progress': '10'})
+        self.events.publish('t1', {'progress': '50'})
+        # Фоновый поток забрал пачку, но еще не успел ее отправить
+        with self.events.cond:
+            batch = self.events.pending.pop('t1')
+            seq = self.events._next_seq('t1')
+        final = threading.Thread(target=self.events.publish, args=('t1', {'status': 'finished'}))
+        final.start()
+        time.sleep(0.05)
+        self.assertEqual(len(self.socketio.events), 1)
+        self.events._emit('t1', batch, seq)
+        final.join(1)
+        statuses = [data.get('status', data.get('progress')) for _, data in self.socketio.events]
+        self.assertEqual(statuses, ['downloading', '50', 'finished'])
+        self.assertNotIn('t1', self.events.seq)
+
+    def test_unknown_task_not_published(self):
+        tasks = TaskManager(events=self.events)
+        tasks.update_task('missing', status='downloading')
+        self.assertEqual(self.socketio.events, [])
+        tid = tasks.create_task()
+        tasks.update_task(tid, status='downloading')
+        self.assertEqual(len(self.socketio.events), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ydl_pool import YdlPool
+
+
+class TestYdlPool(unittest.TestCase):
+    """Тестирование пула экземпляров YoutubeDL"""
+
+    def setUp(self):
+        self.pool = YdlPool(size=2)
+        self.opts = {'quiet': True, 'format': 'best'}
+
+    def test_instance_reused_per_profile(self):
+        with self.pool.checkout('free', self.opts) as first:
+            pass
+        with self.pool.checkout('free', self.opts) as second:
+            self.assertIs(first, second)
+        # Другие базовые параметры (например, прокси) — другой профиль
+        with self.pool.checkout('free', dict(self.opts, proxy='http://127.0.0.1:1')) as third:
+            self.assertIsNot(first, third)
+        self.assertEqual(self.pool.stats()['created'], 2)
+        self.assertEqual(self.pool.stats()['reused'], 1)
+
+    def test_overrides_restored(self):
+        hook = lambda d: None
+        overrides = {'outtmpl': 'downloads/abc_%(title)s.%(ext)s', 'format': 'bestaudio', 'ratelimit': 1024, 'progress_hooks': [hook]}
+        with self.pool.checkout('free', self.opts, overrides) as ydl:
+            self.assertEqual(ydl.params['outtmpl']['default'], 'downloads/abc_%(title)s.%(ext)s')
+            self.assertEqual(ydl.params['ratelimit'], 1024)
+            self.assertEqual(ydl._progress_hooks, [hook])
+            task_selector = ydl.format_selector
+
+        with self.pool.checkout('free', self.opts) as ydl:
+            self.assertNotEqual(ydl.params['outtmpl']['default'], 'downloads/abc_%(title)s.%(ext)s')
+            self.assertNotIn('ratelimit', ydl.params)
+            self.assertEqual(ydl.params['format'], 'best')
+            self.assertIsNot(ydl.format_selector, task_selector)
+            self.assertEqual(ydl._progress_hooks, [])
+
+    def test_failed_instance_not_returned(self):
+        with self.assertRaises(RuntimeError):
+            with self.pool.checkout('free', self.opts) as broken:
+                raise RuntimeError('download failed')
+        with self.pool.checkout('free', self.opts) as ydl:
+            self.assertIsNot(ydl, broken)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
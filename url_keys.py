@@ -0,0 +1,59 @@
+import threading
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from yt_dlp.extractor import gen_extractor_classes
+
+# Параметры ссылок, которые не влияют на сам ролик (трекинг, таймкод, источник перехода)
+TRACKING_PARAMS = {'si', 'feature', 'pp', 't', 'start', 'fbclid', 'gclid', 'igshid', 'ref', 'ref_src', 'share'}
+
+_extractors = None
+_extractors_lock = threading.Lock()
+
+
+def _get_extractors():
+    global _extractors
+    with _extractors_lock:
+        if _extractors is None:
+            # Generic подходит под любую ссылку, поэтому для ключей он бесполезен
+            _extractors = [ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic']
+        return _extractors
+
+
+def normalize_url(url):
+    """Нормализует ссылку без знания экстрактора: хост в нижнем регистре, без www./m., трекинга и якоря."""
+    parts = urlsplit((url or '').strip())
+    host = (parts.hostname or '').lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if parts.port:
+        host = f'{host}:{parts.port}'
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if k not in TRACKING_PARAMS and not k.startswith('utm_'))
+    return urlunsplit(((parts.scheme or 'https').lower(), host, parts.path.rstrip('/'), urlencode(query), ''))
+
+
+@lru_cache(maxsize=4096)
+def canonicalize(url):
+    """Возвращает (ключ экстрактора, id ролика) по ссылке, без сетевых запросов.
+
+    Используются регулярные выражения экстракторов yt-dlp, поэтому youtu.be/X,
+    watch?v=X&t=30, m.youtube.com/...&si=... и shorts/X дают один и тот же ключ.
+    Если экстрактор не найден, вместо id возвращается нормализованная ссылка.
+    """
+    url = (url or '').strip()
+    for ie in _get_extractors():
+        try:
+            if ie.suitable(url):
+                video_id = ie.get_temp_id(url)
+                if video_id:
+                    return ie.ie_key(), video_id
+        except Exception:
+            continue
+    return 'url', normalize_url(url)
+
+
+def canonical_key(url):
+    """Строковый ключ для кэшей, дедупликации и статистики."""
+    extractor, video_id = canonicalize(url)
+    return f'{extractor}:{video_id}'
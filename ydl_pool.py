@@ -0,0 +1,141 @@
+import os
+import copy
+import json
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+import yt_dlp
+
+logger = logging.getLogger(__name__)
+
+# Сколько простаивающих экземпляров держать на один профиль и сколько профилей всего
+YDL_POOL_SIZE = int(os.getenv('YDL_POOL_SIZE', 4))
+YDL_POOL_MAX_PROFILES = int(os.getenv('YDL_POOL_MAX_PROFILES', 32))
+
+_MISSING = object()
+
+
+class YdlPool:
+    """Пул заранее созданных экземпляров yt_dlp.YoutubeDL, сгруппированных по профилю параметров.
+
+    Создание YoutubeDL каждый раз разбирает параметры, загружает cookies, собирает
+    список экстракторов и открывает новые HTTP-сессии. Экземпляр из пула уже «прогрет»:
+    экстракторы созданы, кэши плеера YouTube заполнены, соединения keep-alive открыты.
+
+    Экземпляр выдается одному потоку за раз. Параметры конкретной задачи (шаблон имени,
+    формат, хуки прогресса, ограничение скорости) накладываются на время выдачи и
+    откатываются при возврате. Если во время работы было исключение, экземпляр закрывается
+    и в пул не возвращается.
+    """
+    def __init__(self, size=YDL_POOL_SIZE, max_profiles=YDL_POOL_MAX_PROFILES, factory=None):
+        self.size = size
+        self.max_profiles = max_profiles
+        self.factory = factory
+        self.idle = OrderedDict()   # ключ профиля -> простаивающие экземпляры
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    @staticmethod
+    def profile_key(profile, opts, generation=None):
+        # generation — версия внешнего состояния, которое YoutubeDL читает только при создании
+        # (например, mtime файла cookies): после ее смены берутся новые экземпляры
+        raw = json.dumps([opts, generation], sort_keys=True, default=repr)
+        return f"{profile}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+    def _create(self, opts):
+        # Фабрика берется в момент вызова, чтобы ее можно было подменить в тестах
+        factory = self.factory or yt_dlp.YoutubeDL
+        self.created += 1
+        return factory(copy.deepcopy(opts))
+
+    @contextmanager
+    def checkout(self, profile, opts, overrides=None, generation=None):
+        key = self.profile_key(profile, opts, generation)
+        ydl = None
+        with self.lock:
+            instances = self.idle.get(key)
+            if instances:
+                ydl = instances.pop()
+                self.idle.move_to_end(key)
+                self.reused += 1
+        if ydl is None:
+            ydl = self._create(opts)
+
+        saved = self._apply(ydl, overrides or {})
+        try:
+            yield ydl
+        except BaseException:
+            self._close(ydl)
+            raise
+        self._restore(ydl, saved)
+        self._release(key, ydl)
+
+    def _apply(self, ydl, overrides):
+        saved = {
+            'params': {},
+            'format_selector': getattr(ydl, 'format_selector', None),
+            'progress_hooks': getattr(ydl, '_progress_hooks', None),
+        }
+        for name, value in overrides.items():
+            if name == 'progress_hooks':
+                ydl._progress_hooks = list(value)
+                continue
+            saved['params'][name] = ydl.params.get(name, _MISSING)
+            if name == 'outtmpl' and isinstance(value, str):
+                # Остальные шаблоны (субтитры, миниатюры и т.д.) остаются от исходных параметров
+                value = dict(ydl.params.get('outtmpl') or {}, default=value)
+            ydl.params[name] = value
+            if name == 'format':
+                # Селектор формата YoutubeDL компилирует в конструкторе — пересобираем вручную
+                ydl.format_selector = ydl.build_format_selector(value) if value else None
+        return saved
+
+    def _restore(self, ydl, saved):
+        for name, value in saved['params'].items():
+            if value is _MISSING:
+                ydl.params.pop(name, None)
+            else:
+                ydl.params[name] = value
+        if 'format' in saved['params']:
+            ydl.format_selector = saved['format_selector']
+        if saved['progress_hooks'] is not None:
+            ydl._progress_hooks = saved['progress_hooks']
+        # Счетчики одного запуска не должны влиять на следующий
+        if hasattr(ydl, '_download_retcode'):
+            ydl._download_retcode = 0
+            ydl._playlist_urls = set()
+            ydl._printed_messages = set()
+
+    def _release(self, key, ydl):
+        evicted = []
+        with self.lock:
+            instances = self.idle.setdefault(key, [])
+            self.idle.move_to_end(key)
+            if len(instances) < self.size:
+                instances.append(ydl)
+            else:
+                evicted.append(ydl)
+            # Профили, которыми давно не пользовались (старый прокси, старые cookies), закрываем
+            while len(self.idle) > self.max_profiles:
+                _, old = self.idle.popitem(last=False)
+                evicted.extend(old)
+        for old in evicted:
+            self._close(old)
+
+    def _close(self, ydl):
+        try:
+            ydl.close()
+        except Exception as e:
+            logger.warning(f"YoutubeDL close error: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'profiles': len(self.idle),
+                'idle': sum(len(v) for v in self.idle.values()),
+                'created': self.created,
+                'reused': self.reused,
+            }